@@ -0,0 +1,117 @@
+import numpy as np
+from sklearn.neighbors import KDTree
+
+"""
+A spatial index over the atoms of the open structures, to resolve focus
+coordinates on the client.
+
+There is one KDTree per structure, built from the bulk coordinate array of
+its atoms the first time it is queried. Coordinates are model coordinates,
+the frame of Phenix focus positions, so moving a model in the scene does
+not change which atom a position resolves to. Structures are added and removed as
+ChimeraX opens and closes models, so the other trees are kept. Each atom
+also has the index of its residue in structure.residues, so query results
+map to residues with numpy indexing instead of per-atom Python calls.
+"""
+
+
+class _StructureIndex(object):
+
+  def __init__(self, structure):
+    atoms = structure.atoms
+    self.structure = structure
+    self.atoms = atoms
+    self.tree = KDTree(atoms.coords) # model coordinates, as in Phenix
+    self.residue_index = structure.residues.indices(atoms.residues)
+
+
+class AtomIndex(object):
+
+  def __init__(self, session=None):
+    self.structures = {}  # structure -> _StructureIndex, None until queried
+    self.handlers = []
+    if session is not None:
+      for model in session.models:
+        self.add(model)
+      ts = session.triggers
+      self.handlers = [ts.add_handler("add models", self._models_added),
+                       ts.add_handler("remove models", self._models_removed)]
+      self.session = session
+
+  def _models_added(self, trigger, models):
+    for model in models:
+      self.add(model)
+
+  def _models_removed(self, trigger, models):
+    for model in models:
+      self.remove(model)
+
+  def add(self, model):
+    if hasattr(model, "atoms") and hasattr(model, "residues"):
+      self.structures[model] = None
+
+  def remove(self, model):
+    self.structures.pop(model, None)
+
+  def invalidate(self, model=None):
+    """
+    Rebuild the tree of a structure (all structures if None) on the next
+    query, after its coordinates changed.
+    """
+    for structure in self.structures:
+      if model is None or structure is model:
+        self.structures[structure] = None
+
+  def close(self):
+    for h in self.handlers:
+      self.session.triggers.remove_handler(h)
+    self.handlers = []
+    self.structures = {}
+
+  def _indices(self):
+    for structure, index in list(self.structures.items()):
+      if structure.deleted:
+        self.remove(structure)
+        continue
+      if index is None:
+        if structure.num_atoms == 0:
+          continue
+        index = _StructureIndex(structure)
+        self.structures[structure] = index
+      yield index
+
+  def nearest(self, xyz):
+    """
+    Return (structure, atom index) of the atom nearest to xyz, or
+    (None, None) if no structure is open.
+    """
+    xyz = np.asarray(xyz, dtype=np.float64).reshape(1, 3)
+    best = (None, None, np.inf)
+    for index in self._indices():
+      dists, inds = index.tree.query(xyz, k=1)
+      if dists[0, 0] < best[2]:
+        best = (index, int(inds[0, 0]), dists[0, 0])
+    if best[0] is None:
+      return None, None
+    return best[0].structure, best[1]
+
+  def nearest_residue(self, xyz):
+    structure, i = self.nearest(xyz)
+    if structure is None:
+      return None
+    residue_index = self.structures[structure].residue_index
+    return structure.residues[int(residue_index[i])]
+
+  def residues_within(self, xyz, radius):
+    """
+    The residues with an atom within radius of xyz, as a list with one
+    Residues collection per structure.
+    """
+    xyz = np.asarray(xyz, dtype=np.float64).reshape(1, 3)
+    found = []
+    for index in self._indices():
+      inds = index.tree.query_radius(xyz, radius)[0]
+      if len(inds) > 0:
+        residues = np.unique(index.residue_index[inds])
+        found.append(index.structure.residues.filter(residues))
+    return found
@@ -0,0 +1,160 @@
+import os
+import json
+import tempfile
+
+import numpy as np
+
+from .payload_utils import payload_bytes
+
+"""
+A persistent cache of data payloads on the client, keyed by the content hash
+the server puts in each payload ("content_hash").
+
+Each entry is a header file <hash>.json (the payload without its body) and a
+body file: <hash>.npy for map values, <hash>.txt for model strings, <hash>.bin
+for models in the columnar encoding. Map
+values are memory-mapped when read back, so even large maps reopen instantly.
+Reading an entry marks it as recently used, and the least recently used
+entries are removed when the cache grows past max_bytes.
+
+The header of an entry is the one of the first payload stored under the hash.
+Other payloads with the same body can have another layout (e.g. the origin of
+a map), so only the body of an entry is reused, with the header the server
+sends (see payload_utils.payload_from_content).
+"""
+
+
+class DiskCache(object):
+
+  def __init__(self, root, max_bytes=4 * 1024**3):
+    self.root = root
+    self.max_bytes = max_bytes
+    if not os.path.isdir(root):
+      os.makedirs(root)
+    self.entries = {} # content hash -> [last use, bytes on disk]
+    for name in os.listdir(root):
+      content_hash, ext = os.path.splitext(name)
+      if ext not in [".json", ".npy", ".txt", ".bin"]:
+        continue
+      stat = os.stat(os.path.join(root, name))
+      entry = self.entries.setdefault(content_hash, [0., 0])
+      entry[0] = max(entry[0], stat.st_mtime)
+      entry[1] += stat.st_size
+
+  @property
+  def total_bytes(self):
+    return sum(entry[1] for entry in self.entries.values())
+
+  def _path(self, content_hash, ext):
+    return os.path.join(self.root, content_hash + ext)
+
+  def __contains__(self, content_hash):
+    return content_hash in self.entries
+
+  def get(self, content_hash):
+    """
+    The cached payload, or None. Map values come back as a read-only memory
+    map in source["binary"]["bytes"].
+    """
+    if content_hash not in self.entries:
+      return None
+    header_path = self._path(content_hash, ".json")
+    try:
+      with open(header_path) as fh:
+        data_payload = json.load(fh)
+      if data_payload["object"] == "map":
+        array = np.load(self._path(content_hash, ".npy"), mmap_mode="r")
+        data_payload["source"]["binary"]["bytes"] = array
+      elif data_payload["source"]["filestring"]["suffix"] == ".columns":
+        with open(self._path(content_hash, ".bin"), "rb") as fh:
+          data_payload["source"]["columns"]["bytes"] = fh.read()
+      else:
+        with open(self._path(content_hash, ".txt"), encoding="utf-8") as fh:
+          data_payload["source"]["filestring"]["string"] = fh.read()
+    except (IOError, OSError, ValueError, KeyError):
+      self.remove(content_hash) # incomplete or corrupt entry
+      return None
+    os.utime(header_path, None)
+    self.entries[content_hash][0] = os.path.getmtime(header_path)
+    return data_payload
+
+  def put(self, data_payload):
+    """
+    Store a payload under its content hash. Maps are stored in the binary
+    encoding.
+    """
+    content_hash = data_payload.get("content_hash")
+    if content_hash is None or content_hash in self.entries:
+      return
+    # bodies (bytes, arrays) are not JSON serializable and become None
+    header = json.loads(json.dumps(data_payload, default=lambda o: None))
+    if data_payload["object"] == "map":
+      source = data_payload["source"]
+      if (source.get("encoding", "list") == "binary" and
+          source["binary"]["bytes"] is not None):
+        binary = dict(source["binary"])
+        array = np.frombuffer(payload_bytes(binary["bytes"]),
+                              dtype=np.dtype(binary["dtype"]))
+        array = array.reshape(tuple(binary["shape"]))
+      elif source["list"]["list_rep"] is not None:
+        l = source["list"]
+        array = np.array(l["list_rep"], dtype="<f4").reshape(tuple(l["shape"]))
+        binary = {"dtype": array.dtype.str, "shape": tuple(array.shape),
+                  "origin": (0, 0, 0), "pixel_sizes": tuple(l["pixel_sizes"])}
+        header["source"]["list"]["list_rep"] = None
+      else:
+        return
+      binary["bytes"] = None
+      header["source"]["encoding"] = "binary"
+      header["source"]["binary"] = binary
+      self._write(content_hash, ".npy", lambda fh: np.save(fh, array))
+    elif data_payload["source"]["filestring"]["suffix"] == ".columns":
+      body = payload_bytes(data_payload["source"]["columns"]["bytes"])
+      if body is None:
+        return
+      self._write(content_hash, ".bin", lambda fh: fh.write(body))
+    else:
+      string = data_payload["source"]["filestring"]["string"]
+      if string is None:
+        return
+      header["source"]["filestring"]["string"] = None
+      self._write(content_hash, ".txt",
+                  lambda fh: fh.write(string.encode("utf-8")))
+    # the header is written last, it marks the entry as complete
+    self._write(content_hash, ".json",
+                lambda fh: fh.write(json.dumps(header).encode("utf-8")))
+    size = sum(os.path.getsize(self._path(content_hash, ext))
+               for ext in [".json", ".npy", ".txt", ".bin"]
+               if os.path.exists(self._path(content_hash, ext)))
+    self.entries[content_hash] = [os.path.getmtime(
+      self._path(content_hash, ".json")), size]
+    self.evict()
+
+  def _write(self, content_hash, ext, write):
+    # write to a temporary file and rename, so readers never see partial files
+    fd, tmp = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+    try:
+      with os.fdopen(fd, "wb") as fh:
+        write(fh)
+      os.replace(tmp, self._path(content_hash, ext))
+    except Exception:
+      os.remove(tmp)
+      raise
+
+  def remove(self, content_hash):
+    for ext in [".json", ".npy", ".txt", ".bin"]:
+      path = self._path(content_hash, ext)
+      if os.path.exists(path):
+        os.remove(path)
+    self.entries.pop(content_hash, None)
+
+  def evict(self):
+    """
+    Remove least recently used entries until the cache fits in max_bytes.
+    """
+    total = self.total_bytes
+    for content_hash in sorted(self.entries, key=lambda h: self.entries[h][0]):
+      if total <= self.max_bytes:
+        break
+      total -= self.entries[content_hash][1]
+      self.remove(content_hash)
@@ -0,0 +1,245 @@
+import tempfile
+
+import numpy as np
+
+from .payload_utils import payload_bytes
+
+"""
+Build ChimeraX structures from ModelAPI payloads in the columnar encoding
+(filestring suffix ".columns"). The layout is defined on the server, in
+phenix.api.model_columns.
+
+The columns are written as PDB text with whole-array numpy operations (no
+Python loop over atoms) and read by the PDB reader of ChimeraX, which makes
+the atoms, residues and bonds in C++. Models that do not fit the PDB format
+(chain ids longer than one character, coordinates beyond the column widths)
+are built atom by atom instead, which is much slower for large models.
+"""
+
+
+def unpack_columns(columns):
+  buf = payload_bytes(columns["bytes"])
+  arrays = {}
+  for name, dtype, shape, offset in columns["arrays"]:
+    dtype = np.dtype(dtype)
+    count = int(np.prod(shape)) if len(shape) > 0 else 1
+    array = np.frombuffer(buf, dtype=dtype, count=count, offset=offset)
+    if dtype.kind == "S":
+      array = array.astype(np.str_)
+    arrays[name] = array.reshape(tuple(shape))
+  return arrays
+
+
+def _seq_number(resseq, default):
+  try:
+    return int(resseq)
+  except ValueError: # hybrid-36 numbers of very large models
+    return default
+
+
+def _fixed(values, width, decimals=0):
+  """
+  (n, width) ASCII codes of integers values printed as %<width>.<decimals>f
+  of values / 10**decimals, or None if a value does not fit.
+  """
+  values = np.asarray(values, dtype=np.int64)
+  negative = values < 0
+  magnitude = np.abs(values)
+  point = 1 if decimals > 0 else 0
+  digits = np.full(len(values), decimals + 1)
+  for k in range(decimals + 1, width + 1):
+    digits += magnitude >= 10**k
+  used = digits + point + negative
+  if len(values) and used.max() > width:
+    return None
+  out = np.full((len(values), width), ord(" "), dtype=np.uint8)
+  for k in range(width - point):
+    position = width - 1 - k - (point if k >= decimals else 0)
+    shown = k < digits
+    out[shown, position] = ord("0") + (magnitude[shown] // 10**k) % 10
+  if point:
+    out[:, width - 1 - decimals] = ord(".")
+  rows = np.flatnonzero(negative)
+  out[rows, width - used[rows]] = ord("-")
+  return out
+
+
+def _text(labels, width, right=False, strip=True):
+  """
+  (n, width) ASCII codes of labels justified to width, or None if a label is
+  wider or not ASCII.
+  """
+  labels = np.asarray(labels, dtype=np.str_)
+  if strip:
+    labels = np.char.strip(labels)
+  if len(labels) and np.char.str_len(labels).max() > width:
+    return None
+  labels = np.char.rjust(labels, width) if right else np.char.ljust(labels,
+                                                                   width)
+  # UCS4 code points, one per character
+  codes = np.ascontiguousarray(labels, dtype="<U%d" % width).view(
+    "<u4").reshape(len(labels), width)
+  if len(labels) and codes.max() > 127:
+    return None
+  return codes.astype(np.uint8)
+
+
+def _atom_names(names):
+  # PDB columns 13-16: names of 1 to 3 characters start in column 14
+  stripped = np.char.strip(names)
+  short = np.char.str_len(stripped) < 4
+  return np.where(short, np.char.add(" ", stripped), stripped)
+
+
+def pdb_from_columns(arrays, crystal_symmetry=None):
+  """
+  The PDB text (bytes) of unpacked columns, or None if the model does not
+  fit the PDB format.
+  """
+  n_atoms = len(arrays["b"])
+  n_residues = len(arrays["residue_starts"])
+  residue_of = np.repeat(np.arange(n_residues), np.diff(
+    np.append(arrays["residue_starts"], n_atoms)))
+  chain_of = np.repeat(np.arange(len(arrays["chain_starts"])), np.diff(
+    np.append(arrays["chain_starts"], n_residues)))[residue_of]
+  xyz = arrays["xyz"]
+  # (first column, labels, width, right justified, atom -> label index)
+  fields = [
+    (12, _atom_names(arrays["name"]), 4, False, None),
+    (16, arrays["altloc"], 1, False, None),
+    (17, arrays["resname"], 3, True, residue_of),
+    (21, arrays["chain"], 1, False, chain_of),
+    (22, arrays["resseq"], 4, True, residue_of),
+    (26, arrays["icode"], 1, False, residue_of),
+    (76, arrays["element"], 2, True, None),
+    (78, arrays["charge"], 2, False, None),
+  ]
+  lines = np.full((n_atoms, 81), ord(" "), dtype=np.uint8)
+  lines[:, 80] = ord("\n")
+  records = np.frombuffer(b"ATOM  HETATM", dtype=np.uint8).reshape(2, 6)
+  lines[:, 0:6] = records[arrays["hetero"].astype(bool).astype(int)]
+  lines[:, 6:11] = _fixed(np.arange(1, n_atoms + 1) % 100000, 5)
+  for start, labels, width, right, index in fields:
+    block = _text(labels, width, right=right, strip=start != 12)
+    if block is None:
+      return None
+    lines[:, start:start + width] = block if index is None else block[index]
+  numbers = [(30, xyz[:, 0], 8, 3), (38, xyz[:, 1], 8, 3),
+             (46, xyz[:, 2], 8, 3),
+             (54, np.round(arrays["occ"].astype(np.float64) * 100), 6, 2),
+             (60, np.round(arrays["b"].astype(np.float64) * 100), 6, 2)]
+  for start, values, width, decimals in numbers:
+    block = _fixed(values, width, decimals)
+    if block is None:
+      return None
+    lines[:, start:start + width] = block
+
+  header = b""
+  if crystal_symmetry is not None:
+    cell = tuple(crystal_symmetry["unit_cell"])
+    header = ("CRYST1%9.3f%9.3f%9.3f%7.2f%7.2f%7.2f %-11s\n" % (
+      cell + (crystal_symmetry["space_group"],))).encode("ascii")
+  models = np.char.strip(np.asarray(arrays["model"], dtype=np.str_))
+  if len(models) == 0 or (models == "").all():
+    return header + lines.tobytes() + b"END\n"
+  # one MODEL block per run of chains with the same model id
+  chain_model = np.flatnonzero(np.append(True, models[1:] != models[:-1]))
+  atom_starts = np.append(
+    arrays["residue_starts"][arrays["chain_starts"][chain_model]], n_atoms)
+  blocks = [header]
+  for m, start, stop in zip(chain_model, atom_starts[:-1], atom_starts[1:]):
+    blocks.append(("MODEL     %4s\n" % models[m]).encode("ascii"))
+    blocks.append(lines[start:stop].tobytes())
+    blocks.append(b"ENDMDL\n")
+  blocks.append(b"END\n")
+  return b"".join(blocks)
+
+
+def structures_from_columns(session, data_payload):
+  """
+  One AtomicStructure per model of the payload, not added to the session.
+  """
+  columns = data_payload["source"]["columns"]
+  arrays = unpack_columns(columns)
+  text = pdb_from_columns(arrays, columns.get("crystal_symmetry"))
+  if text is None:
+    return build_structures(session, data_payload["name"], arrays)
+  with tempfile.NamedTemporaryFile(mode="w+b", suffix=".pdb") as tmp:
+    tmp.write(text)
+    tmp.flush()
+    models, status_message = session.open_command.open_data(tmp.name)
+  return models
+
+
+def build_structures(session, name, arrays):
+  """
+  One AtomicStructure per model of unpacked columns, made atom by atom.
+  """
+  from chimerax.atomic import AtomicStructure
+  n_atoms = len(arrays["b"])
+  xyz = arrays["xyz"].astype(np.float64) / 1000.
+  residue_stops = np.append(arrays["residue_starts"][1:], n_atoms)
+  chain_stops = np.append(arrays["chain_starts"][1:],
+                          len(arrays["residue_starts"]))
+  names = np.char.strip(arrays["name"])
+  elements = np.char.strip(arrays["element"])
+
+  structures = []
+  by_model = {}
+  for c, model_id in enumerate(arrays["model"]):
+    if model_id not in by_model:
+      s = AtomicStructure(session, name=name)
+      by_model[model_id] = [s, [], []] # structure, atom indices, atoms
+      structures.append(s)
+    s, indices, atoms = by_model[model_id]
+    chain_id = arrays["chain"][c]
+    for r in range(arrays["chain_starts"][c], chain_stops[c]):
+      residue = s.new_residue(arrays["resname"][r].strip(), chain_id,
+                              _seq_number(arrays["resseq"][r], r),
+                              insert=arrays["icode"][r].strip() or " ")
+      made = {} # atom name -> atom, alternate locations share one atom
+      for i in range(arrays["residue_starts"][r], residue_stops[r]):
+        if names[i] in made:
+          continue
+        element = elements[i] or names[i][:1]
+        atom = s.new_atom(names[i], element)
+        residue.add_atom(atom)
+        made[names[i]] = atom
+        indices.append(i)
+        atoms.append(atom)
+
+  from chimerax.atomic import Atoms
+  for s, indices, atom_list in by_model.values():
+    atoms = Atoms(atom_list)
+    atoms.coords = xyz[indices]
+    atoms.bfactors = arrays["b"][indices]
+    atoms.occupancies = arrays["occ"][indices]
+    _add_alt_locs(arrays, xyz, indices, atom_list)
+    s.connect_structure()
+  return structures
+
+
+def _add_alt_locs(arrays, xyz, indices, atom_list):
+  # the other conformers of atoms with alternate locations
+  altloc = np.char.strip(arrays["altloc"])
+  with_alt = np.flatnonzero(altloc != "")
+  if len(with_alt) == 0:
+    return
+  first = dict(zip(indices, atom_list))
+  names = arrays["name"]
+  residue_of = np.searchsorted(arrays["residue_starts"], with_alt,
+                               side="right")
+  atom_of = {}
+  for i, r in zip(with_alt, residue_of):
+    key = (r, names[i])
+    if i in first:
+      atom_of[key] = (first[i], altloc[i])
+    elif key not in atom_of: # first conformer had no alternate location
+      continue
+    atom, first_loc = atom_of[key]
+    atom.set_alt_loc(altloc[i], True)
+    atom.coord = xyz[i]
+    atom.bfactor = arrays["b"][i]
+    atom.occupancy = arrays["occ"][i]
+  for atom, first_loc in atom_of.values():
+    atom.set_alt_loc(first_loc, False)
@@ -0,0 +1,216 @@
+import zlib
+
+import numpy as np
+
+try:
+  import lz4.frame as lz4_frame
+except ImportError:
+  lz4_frame = None
+
+"""
+Helpers to turn the data bodies of api payloads back into numpy arrays on the
+client. The payload layouts are defined by the api objects on the server
+(phenix.api.api_objects).
+"""
+
+
+def payload_bytes(data):
+  """
+  Bytes sent over Pyro arrive as bytes with msgpack/pickle/marshal, but as a
+  base64 dict with serpent.
+  """
+  if isinstance(data, dict) and data.get("encoding") == "base64":
+    import serpent
+    return serpent.tobytes(data)
+  return data
+
+
+def array_from_binary(binary):
+  """
+  Rebuild the array from a MapAPI "binary" block without copying it.
+  The result is read-only and indexed like the cctbx map_data (x,y,z).
+  """
+  buf = payload_bytes(binary["bytes"])
+  dtype = np.dtype(binary["dtype"])
+  return np.frombuffer(buf, dtype=dtype).reshape(tuple(binary["shape"]))
+
+
+def map_array(data_payload):
+  """
+  Return (array, origin_xyz, step) for a map payload carrying its values,
+  or None if the map has to be read from a file.
+  """
+  source = data_payload["source"]
+  encoding = source.get("encoding", "list")
+  if encoding == "binary" and source["binary"]["bytes"] is not None:
+    binary = source["binary"]
+    array = array_from_binary(binary)
+    step = tuple(binary["pixel_sizes"])
+    origin_index = tuple(binary["origin"]) or (0, 0, 0)
+  elif source["list"]["list_rep"] is not None:
+    l = source["list"]
+    array = np.array(l["list_rep"], dtype=l["dtype"]).reshape(
+      tuple(l["shape"]))
+    step = tuple(l["pixel_sizes"])
+    origin_index = (0, 0, 0)
+  else:
+    return None
+  # binned levels have their voxel centers half a bin past the grid index
+  offset = source.get("lod", {}).get("offset") or (0., 0., 0.)
+  origin = tuple(i * s + d for i, s, d in zip(origin_index, step, offset))
+  return array, origin, step
+
+
+def read_shared_memory(data_payload):
+  """
+  Copy the body of a payload sent with the "shared_memory" transport out of
+  its segment, and put it back where the payload layout expects it.
+  The segment itself is owned by the server and is not unlinked here.
+  """
+  handle = data_payload["source"].get("shared_memory")
+  if handle is None:
+    return data_payload
+  from multiprocessing import shared_memory
+  shm = shared_memory.SharedMemory(name=handle["name"])
+  try:
+    # attaching registers the segment for cleanup at exit in this process,
+    # which would unlink it under the server
+    from multiprocessing import resource_tracker
+    resource_tracker.unregister(shm._name, "shared_memory")
+  except Exception:
+    pass
+  try:
+    body = bytes(shm.buf[:handle["nbytes"]])
+  finally:
+    shm.close()
+  source = dict(data_payload["source"])
+  if handle["field"] == "filestring":
+    source["filestring"] = dict(source["filestring"],
+                                string=body.decode("utf-8"))
+  elif handle["field"] == "columns":
+    source["columns"] = dict(source["columns"], bytes=body)
+  else:
+    source["binary"] = dict(source["binary"], bytes=body)
+  del source["shared_memory"]
+  data_payload = dict(data_payload)
+  data_payload["source"] = source
+  return data_payload
+
+
+def payload_from_content(header, content_payload):
+  """
+  The payload of header (PhenixServer.retrieve_data_header) with the body of
+  content_payload, a payload with the same content hash. Everything else
+  comes from header: the content hash only covers the body, so payloads that
+  share it can still differ in layout (the origin or pixel sizes of a map).
+  """
+  source = dict(header["source"])
+  content = content_payload["source"]
+  if header["object"] == "map":
+    encoding = source.get("encoding", "list")
+    if encoding == content.get("encoding", "list"):
+      key, field = (("binary", "bytes") if encoding == "binary" else
+                    ("list", "list_rep"))
+      source[key] = dict(source[key])
+      source[key][field] = content[key][field]
+    else: # the disk cache keeps list encoded maps in the binary encoding
+      l = source["list"]
+      source["encoding"] = "binary"
+      source["binary"] = {"dtype": content["binary"]["dtype"],
+                          "shape": tuple(l["shape"]), "origin": (0, 0, 0),
+                          "pixel_sizes": tuple(l["pixel_sizes"]),
+                          "bytes": content["binary"]["bytes"]}
+      source["list"] = dict(l, list_rep=None)
+  elif source["filestring"]["suffix"] == ".columns":
+    source["columns"] = dict(source["columns"],
+                             bytes=content["columns"]["bytes"])
+  else:
+    source["filestring"] = dict(source["filestring"],
+                                string=content["filestring"]["string"])
+  data_payload = dict(header)
+  data_payload["source"] = source
+  return data_payload
+
+
+def coordinates_arrays(data_payload):
+  """
+  The arrays of a CoordinatesAPI payload: {"xyz": (n,3) float64,
+  "b": (n,) or None, "occ": (n,) or None, "indices": (n,) or None}.
+  """
+  source = data_payload["source"]
+  arrays = {}
+  for key, dtype in [("xyz", "<f4"), ("b", "<f4"), ("occ", "<f4"),
+                     ("indices", "<i4")]:
+    if source.get(key) is None:
+      arrays[key] = None
+    else:
+      array = np.frombuffer(payload_bytes(source[key]), dtype=dtype)
+      arrays[key] = array.astype(np.float64 if key != "indices" else np.int64)
+  if arrays["xyz"] is not None:
+    arrays["xyz"] = arrays["xyz"].reshape(-1, 3)
+  return arrays
+
+
+def _seq_number(resseq):
+  try:
+    return int(resseq)
+  except ValueError: # hybrid-36 numbers of very large models
+    return None
+
+
+def match_atoms(labels, chain_ids, numbers, icodes, names):
+  """
+  Map the atoms of a model on the server to the atoms of a structure.
+  labels: the server atom labels (PhenixServer.atom_labels)
+  chain_ids, numbers, icodes, names: per atom of the structure
+  Returns (targets, altlocs): for each server atom, the index of the atom
+  with the same chain, residue number, insertion code and name (-1 if there
+  is none), and its alternate location. The conformers of an atom on the
+  server are one atom with several alternate locations in ChimeraX.
+  """
+  index = {}
+  for j, key in enumerate(zip(chain_ids, (int(n) for n in numbers),
+                              (i.strip() for i in icodes), names)):
+    index.setdefault(key, j)
+  keys = zip(labels["chain"], (_seq_number(r) for r in labels["resseq"]),
+             labels["icode"], labels["name"])
+  targets = np.array([index.get(key, -1) for key in keys], dtype=np.int64)
+  return targets, np.array(labels["altloc"], dtype=np.str_)
+
+
+def available_codecs():
+  """
+  The compression codecs this client can decode, passed to the server's
+  retrieve_data.
+  """
+  if lz4_frame is None:
+    return ["zlib"]
+  return ["zlib", "lz4"]
+
+
+def decode_payload(data_payload):
+  """
+  Decompress a body compressed by the server (source["codec"], see
+  phenix.api.payload_codecs) and put it back where the payload expects it.
+  """
+  codec = data_payload["source"].get("codec")
+  if codec is None:
+    return data_payload
+  path = codec["path"]
+  data_payload = dict(data_payload)
+  d = data_payload
+  for key in path[:-1]:
+    d[key] = dict(d[key])
+    d = d[key]
+  body = payload_bytes(d[path[-1]])
+  if codec["name"] == "zlib":
+    body = zlib.decompress(body)
+  elif codec["name"] == "lz4":
+    body = lz4_frame.decompress(body)
+  else:
+    raise ValueError("Codec not supported:", codec["name"])
+  if codec["text"]:
+    body = body.decode("utf-8")
+  d[path[-1]] = body
+  del data_payload["source"]["codec"]
+  return data_payload
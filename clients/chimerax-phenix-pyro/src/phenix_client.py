@@ -1,13 +1,19 @@
 import tempfile
+import threading
 import mrcfile
 from chimerax.std_commands import clip
 from chimerax.core.commands import run
 from chimerax.geometry import Place
 
-from .pyro_utils import  find_server, detect_server_version
+from .pyro_utils import connect, make_proxy
+from .payload_utils import (map_array, read_shared_memory,
+                            payload_from_content, coordinates_arrays,
+                            match_atoms, available_codecs, decode_payload)
+from .disk_cache import DiskCache
+from .atom_index import AtomIndex
+from .model_columns import structures_from_columns
 
 import numpy as np
-from sklearn.neighbors import KDTree
 from collections import defaultdict
 
 
@@ -17,12 +23,27 @@ from collections import defaultdict
 #TODO: Refresh after changing model composition not implemented
 
 
+def scene_delta(old,new):
+  # the changes from scene old to scene new, as SceneAPI.delta on the server
+  changes = {}
+  for key in ["id","focus","environment"]:
+    if old.get(key) != new.get(key):
+      changes[key] = new.get(key)
+  for key in ["data","colors","styles"]:
+    old_list, new_list = old.get(key,[]), new.get(key,[])
+    if old_list != new_list:
+      changes[key] = {
+        "added": [entry for entry in new_list if entry not in old_list],
+        "removed": [entry for entry in old_list if entry not in new_list]}
+  return changes
+
+
 class PhenixClient():
   """
-  Connects to a Phenix Pyro server, monitors the server.current_scene attribute.
-  If the server.current_scene is different from the client.current_scene,
-  the scene is updated.
-
+  Connects to a Phenix Pyro server, and waits for changes of the
+  server.current_scene. A background thread long-polls
+  server.wait_for_scene_change, the new frame handler applies a changed
+  scene without any remote call of its own.
   """
   def __init__(self,tool,uri=None):
 
@@ -34,39 +55,50 @@ class PhenixClient():
     self.session = session
 
     # connection properties
-    self.pyro_version = detect_server_version()
-    self.update_freq = 10
-    self.elapsed_frames = 0
+    self.wait_timeout = 30. # seconds per long poll while idle
     self.failed_connections = 0
     self.max_failed_connects = 5
     self.current_scene = {"id":-1}
-    self.server, self.server_name, self.server_uri, failed = find_server(uri=uri,
-                                                                         PYRO_VERSION=self.pyro_version)
+    # rendezvous file or last connect first, name server lookup if stale
+    (self.server, self.server_name, self.server_uri, self.pyro_version,
+     failed) = connect(uri=uri)
     if failed:
       session.logger.warning("Unable to connect to Phenix.")
       self._on_close()
       del self
     else:
-      """
-      Currently, the client works by pinging the server in multiples of new_frame
-      triggers. Tristan pointed out that there is a better way to do this, 
-      but it works for now.
-      """
       ts = self.session.triggers
       h_new_frame = ts.add_handler('new frame', self.server_update)
       self.handlers = [h_new_frame]
+      self.start_scene_watch()
+
+      # payload bodies go through shared memory if the server is local
+      self.transport = self.detect_transport()
 
       # data cache and dictionary to map api id to Chimera model d
       self.data = {}
+      self.content = {} # content hash -> payload, to reuse identical bodies
+      self.disk_cache = self.open_disk_cache()
       self.model_id_mapper = {}
+      self.atom_maps = {} # data id -> (structure, match_atoms result)
+
+      # atom coordinates for focus, follows models being opened and closed
+      self.atom_index = AtomIndex(session)
+
+      # maps are first shown binned by this factor, then replaced with the
+      # full map on a following frame. None to always load the full map.
+      self.first_paint_level = 8
+      self.coarse_models = {}
+      self.refine_queue = []
+
+      # intermediate results of server tasks, see watch_task
+      self.task_events = {} # task id -> newest event not shown yet
+      self.task_models = {} # task id -> models showing the newest event
 
       # hard_coded initial defaults
       run(self.session,"set bgColor white",log=False)
       run(self.session,"lighting full",log=False)
 
-      # properties to delete when changing scene composition (not implemented)
-      self.delete_on_refresh = ["_atom_kdtree","_atom_list"]
-
   @property
   def log(self):
     if "debug" in self.settings and self.settings["debug"] ==True:
@@ -74,97 +106,390 @@ class PhenixClient():
     else:
       return False
 
-  @property
-  def atom_list(self):
-    if not hasattr(self,"_atom_list"):
-      atoms = []
-      for model in self.session.models:
-        if hasattr(model,"atoms"):
-          atoms+=list(model.atoms)
-      self._atoms = atoms
-    return self._atoms
-
-  @property
-  def atom_kdtree(self):
-    if not hasattr(self,"_atom_kdtree"):
-      xyz = np.vstack([atom.coord for atom in self.atom_list])
-      self._atom_kdtree = KDTree(xyz)
-    return self._atom_kdtree
-
   def coord_to_atomspec(self,coord):
     # used for focusing when provided a 3d coordinate so you can focus on nearest residue
-    dists,inds = self.atom_kdtree.query(coord,k=1)
-    ind = inds.flatten()[0]
-    atom = self.atom_list[ind]
-    return atom.residue.atomspec
+    residue = self.atom_index.nearest_residue(coord)
+    if residue is None:
+      return None
+    return residue.atomspec
+
+  def resolved_to_atomspec(self,resolved):
+    # atomspec of a focus resolved by the server (focus["resolved"])
+    if resolved["id"] not in self.model_id_mapper:
+      return None
+    atomspec = "#" + str(self.model_id_mapper[resolved["id"]])
+    if resolved["expand"] == "model":
+      return atomspec
+    atomspec += "/" + resolved["chain"]
+    if resolved["expand"] == "chain":
+      return atomspec
+    atomspec += ":" + resolved["resseq"].strip() + resolved["icode"].strip()
+    if resolved["expand"] == "residue":
+      return atomspec
+    return atomspec + "@" + resolved["name"].strip()
+
+  def detect_transport(self):
+    location = str(self.server_uri).split("@")[-1]
+    host = location.rsplit(":",1)[0].strip("[]")
+    local = location.startswith("./u:") or host in ["localhost","127.0.0.1",
+                                                    "::1"]
+    try:
+      if local and self.server.shared_memory_available():
+        return "shared_memory"
+    except Exception:
+      pass
+    return None
+
+  def open_disk_cache(self):
+    # payloads kept across sessions, None if the cache can't be created
+    import os
+    from chimerax.core import app_dirs
+    try:
+      return DiskCache(os.path.join(app_dirs.user_cache_dir,"phenix_payloads"))
+    except (IOError, OSError):
+      return None
+
+  def retrieve_data(self,data_id):
+    return self.retrieve_data_many([data_id])[0]
+
+  def retrieve_data_many(self,data_ids,headers=None):
+    """
+    Get payloads from the server in two calls at most: one for the headers,
+    one for the bodies. Bodies already held under another id (same content
+    hash), in memory or in the disk cache, are reused instead of downloaded
+    again.
+    headers: the headers of data_ids, if they were already retrieved
+    """
+    if headers is None:
+      headers = self.server.retrieve_data_many(data_ids,fields="header")
+    payloads = {}
+    missing = []
+    for data_id,header in zip(data_ids,headers):
+      if header is None:
+        continue
+      data_payload = self.cached_payload(header)
+      if data_payload is not None:
+        payloads[data_id] = data_payload
+      else:
+        missing.append(data_id)
+    if len(missing)>0:
+      for data_id,data_payload in zip(missing,self.download_data(missing)):
+        if data_payload is None:
+          continue
+        payloads[data_id] = data_payload
+        content_hash = data_payload.get("content_hash")
+        if content_hash is not None:
+          self.content[content_hash] = data_payload
+          if self.disk_cache is not None:
+            self.disk_cache.put(data_payload)
+    return [payloads.get(data_id) for data_id in data_ids]
+
+  def cached_payload(self,header):
+    """
+    The payload of a header with its body from the memory or disk cache, or
+    None if the body has to be downloaded.
+    """
+    content_hash = header.get("content_hash")
+    if content_hash is None:
+      # no body (e.g. coordinates), the header is the whole payload
+      return header
+    if content_hash not in self.content and self.disk_cache is not None:
+      cached = self.disk_cache.get(content_hash)
+      if cached is not None:
+        self.content[content_hash] = cached
+    if content_hash in self.content:
+      return payload_from_content(header,self.content[content_hash])
+    return None
+
+  def download_data(self,data_ids):
+    if self.transport is not None:
+      try:
+        return [read_shared_memory(data_payload)
+                if data_payload is not None else None
+                for data_payload in self.server.retrieve_data_many(
+                  data_ids,transport=self.transport)]
+      except Exception:
+        # e.g. "localhost" reached through a tunnel, fall back to Pyro
+        self.transport = None
+    # large bodies come compressed with a codec chosen by the server
+    return [decode_payload(data_payload)
+            if data_payload is not None else None
+            for data_payload in self.server.retrieve_data_many(
+              data_ids,codecs=available_codecs())]
+
+  def start_scene_watch(self):
+    self.pending_changes = []
+    self.watch_failed = False
+    self._scene_lock = threading.Lock()
+    self._stop_watch = threading.Event()
+    t = threading.Thread(target=self._watch_scene, daemon=True)
+    t.start()
+    self._watch_thread = t
+
+  def _watch_scene(self):
+    # background thread, blocks on the server until the scene changes
+    proxy = make_proxy(self.server_uri, PYRO_VERSION=self.pyro_version)
+    version = -1
+    while not self._stop_watch.is_set():
+      try:
+        result = proxy.wait_for_scene_change(version, self.wait_timeout,
+                                             delta=True)
+      except Exception:
+        self.failed_connections+=1
+        if self.failed_connections >= self.max_failed_connects:
+          self.watch_failed = True
+          return
+        self._stop_watch.wait(1.)
+        continue
+      self.failed_connections = 0
+      if result["version"] != version:
+        version = result["version"]
+        with self._scene_lock:
+          self.pending_changes.append(result)
+
+  def take_pending_changes(self):
+    with self._scene_lock:
+      changes, self.pending_changes = self.pending_changes, []
+    return changes
 
   def server_update(self, trigger, triggerdata):
-    # triggered every frame, decides whether or not to update from server
-    self.elapsed_frames+=1
-    if (
-            (self.elapsed_frames <self.update_freq or
-            self.elapsed_frames % self.update_freq ==0) and
-            self.failed_connections<self.max_failed_connects
-      ):
-      #self.session.logger.info("New frame:"+str(self.elapsed_frames+=))
+    # triggered every frame, applies changes pushed by the watch thread
+    if self.watch_failed:
+      self.session.logger.warning(
+        "Unable to update scene. Likely the connection to Phenix was lost.")
+      self.tool.delete()
+      return
+    pending = self.take_pending_changes()
+    if len(pending)>0:
       if "debug" in self.settings and self.settings["debug"] !=True:
         try:
-          self.update()
+          for changes in pending:
+            self.apply_changes(changes)
         except:
           self.session.logger.warning(
             "Unable to update scene. Likely the connection to Phenix was lost.")
-          self.failed_connections+=1
           self.tool.delete()
       else:
-        self.update(log=self.log)
+        for changes in pending:
+          self.apply_changes(changes,log=self.log)
+    elif len(self.refine_queue)>0:
+      refine_queue, self.refine_queue = self.refine_queue, []
+      self.refine_maps(refine_queue,log=self.log)
+    if len(self.task_events)>0:
+      self.apply_task_events(log=self.log)
+
+  def watch_task(self,task_id):
+    """
+    Show the intermediate results a server task publishes while it runs. A
+    background thread long-polls server.task_events, events that arrive
+    faster than frames are drawn are skipped.
+    """
+    t = threading.Thread(target=self._watch_task, args=(task_id,),
+                         daemon=True)
+    t.start()
+
+  def _watch_task(self,task_id):
+    proxy = make_proxy(self.server_uri, PYRO_VERSION=self.pyro_version)
+    seq = -1
+    while not self._stop_watch.is_set():
+      try:
+        result = proxy.task_events(task_id, seq, self.wait_timeout)
+      except Exception:
+        return
+      if result is None: # unknown task
+        return
+      seq = result["seq"]
+      if len(result["events"])>0:
+        with self._scene_lock:
+          self.task_events[task_id] = result["events"][-1]
+      if result["state"] not in ["queued","running"]:
+        return
 
+  def apply_task_events(self,log=False):
+    # replace the models of each task with its newest event
+    with self._scene_lock:
+      events, self.task_events = self.task_events, {}
+    for task_id, event in events.items():
+      if event["payload"]["object"] == "coordinates":
+        self.apply_coordinates(event["payload"],log=log)
+        continue
+      old_models = self.task_models.pop(task_id,None)
+      if old_models is not None:
+        self.session.models.close(old_models)
+      models = self.add_model(event["payload"],log=log)
+      if models is not None:
+        self.task_models[task_id] = models
 
-  def update(self,log=False):
+  def apply_changes(self,changes,log=False):
     """
-    We are going to update the scene from the server.
-    1. Check for changes
-    2. If changes, check each component of scene and apply changes
+    Apply a result of server.scene_changes_since: either a full scene, or
+    only the fields that changed.
     """
-    if (
-        self.server != None and
-        self.server.current_scene != None and
-        self.server.current_scene["id"] != self.current_scene["id"]
+    if changes["full"]:
+      if changes["scene"] is not None:
+        self.update(changes["scene"],log=log)
+      return
+    delta = changes["changes"]
+    scene = dict(self.current_scene)
+    if "data" in delta:
+      for data in delta["data"]["removed"]:
+        self.remove_scene_data(data,log=log)
+      self.add_scene_data(delta["data"]["added"],log=log)
+    for key in ["data","colors","styles"]:
+      if key in delta:
+        scene[key] = [entry for entry in scene.get(key,[])
+                      if entry not in delta[key]["removed"]]
+        scene[key] += delta[key]["added"]
+    if "colors" in delta:
+      self.apply_colors(delta["colors"]["added"],log=log)
+    if "styles" in delta:
+      self.apply_styles(delta["styles"]["added"],log=log)
+    for key in ["id","focus","environment"]:
+      if key in delta:
+        scene[key] = delta[key]
+    if "focus" in delta:
+      self.apply_focus(delta["focus"])
+    self.current_scene = scene
 
-      ):
-        scene = self.server.current_scene
+  def update(self,scene,log=False):
+    """
+    We are going to update the client from a full server scene.
+    1. A new scene id: load each component of the scene
+    2. The same scene id: the server sends the whole scene when this client
+       is too far behind for a delta, apply what differs from the scene shown
+    """
+    if scene["id"] != self.current_scene["id"]:
         if log:
           self.session.logger.info("Loading scene:"+scene["id"])
 
-        for data in scene["data"]:
-          data_id = data["id"]
-          data_type = data["object"]
-          data_payload = None
-          if data_id in self.data: # check local cache
-            pass
-          else:
-            if self.server.has_data(id=data_id): # check server
-              data_payload = self.server.retrieve_data(id=data_id)
-            else:
-              data_payload = None # server doesn't have the data, an error
-          if data_payload is not None:
-            if data_type in ["model","map"]:
-              self.add_model(data_payload,log=self.log)
-              self.data[data_payload["id"]] = data_payload
-
+        self.add_scene_data(scene["data"],log=log)
+        self.apply_colors(scene.get("colors",[]),log=log)
+        self.apply_styles(scene.get("styles",[]),log=log)
         if "focus" in scene:
-          if "xyz" in scene["focus"]:
-            xyz = scene["focus"]["xyz"]
-            if xyz is not None and len(xyz) == 3:
-              xyz = np.array(xyz)[np.newaxis, :]
-              atomspec = self.coord_to_atomspec(xyz)
-              run(self.session, "sel " + atomspec, log=False)
-              run(self.session, "show sel", log=False)
-              run(self.session, "color byhetero",
-                  log=False)  # this needs to not be hardcoded
-              run(self.session, "view sel", log=False)
+          self.apply_focus(scene["focus"])
 
         self.current_scene = scene
+    else:
+      self.apply_changes({"full":False,
+                          "changes":scene_delta(self.current_scene,scene)},
+                         log=log)
+
+  def add_scene_data(self,data_list,log=False):
+    """
+    Load the data entries of a scene that are not loaded yet, with one call
+    for the headers, one for the coarse levels of maps (first paint) and
+    one for the bodies not in the cache. Maps whose full values are cached
+    are shown at once, without a coarse level.
+    """
+    batch = []
+    for data in data_list:
+      data_id = data["id"]
+      if data_id in self.data: # check local cache
+        pass
+      elif data_id in self.coarse_models: # waiting for refinement
+        pass
+      elif data["object"] in ["model","map","coordinates"]:
+        batch.append(data_id)
+    if len(batch)==0:
+      return
+    headers = dict(zip(batch,
+                       self.server.retrieve_data_many(batch,fields="header")))
+    coarse = [data_id for data_id in batch
+              if headers[data_id] is not None and
+              headers[data_id]["object"] == "map" and
+              self.first_paint_level is not None and
+              self.cached_payload(headers[data_id]) is None]
+    if len(coarse)>0:
+      coarse_payloads = self.server.retrieve_data_level_many(
+        coarse,self.first_paint_level)
+      for data_id,coarse_payload in zip(coarse,coarse_payloads):
+        if coarse_payload is None: # map read from file, no levels
+          continue
+        self.coarse_models[data_id] = self.add_model(coarse_payload,log=log)
+        self.refine_queue.append(data_id)
+    full = [data_id for data_id in batch
+            if headers[data_id] is not None and
+            data_id not in self.coarse_models]
+    if len(full)==0:
+      return
+    for data_payload in self.retrieve_data_many(
+        full,headers=[headers[data_id] for data_id in full]):
+      if data_payload is None: # the server doesn't have it
+        continue
+      if data_payload["object"] == "coordinates":
+        self.apply_coordinates(data_payload,log=log)
+      else:
+        self.add_model(data_payload,log=self.log)
+      self.data[data_payload["id"]] = data_payload
+
+  def remove_scene_data(self,data,log=False):
+    data_id = data["id"]
+    if data_id in self.model_id_mapper:
+      model_id = self.model_id_mapper.pop(data_id)
+      run(self.session,"close #"+str(model_id),log=log)
+    self.data.pop(data_id,None)
+    coarse_models = self.coarse_models.pop(data_id,None)
+    if coarse_models is not None:
+      self.session.models.close(coarse_models)
+
+  def apply_colors(self,colors,log=False):
+    for color in colors:
+      if color["id"] in self.model_id_mapper and color["color"] is not None:
+        model_id = self.model_id_mapper[color["id"]]
+        command = "color #" + str(model_id) + " " + color["color"]
+        run(self.session, command, log=log)
+
+  def apply_styles(self,styles,log=False):
+    # style keywords of the api: ["ribbon","sphere","stick"]
+    for style in styles:
+      if style["id"] in self.model_id_mapper and style["style"] is not None:
+        model_id = str(self.model_id_mapper[style["id"]])
+        if style["style"] == "ribbon":
+          command = "cartoon #" + model_id
+        else:
+          command = "style #" + model_id + " " + style["style"]
+        run(self.session, command, log=log)
+
+  def apply_focus(self,focus):
+    if "xyz" in focus:
+      xyz = focus["xyz"]
+      if xyz is not None and len(xyz) == 3:
+        atomspec = None
+        if focus.get("resolved") is not None:
+          atomspec = self.resolved_to_atomspec(focus["resolved"])
+        if atomspec is None:
+          atomspec = self.coord_to_atomspec(xyz)
+        if atomspec is None:
+          return
+        run(self.session, "sel " + atomspec, log=False)
+        run(self.session, "show sel", log=False)
+        run(self.session, "color byhetero",
+            log=False)  # this needs to not be hardcoded
+        run(self.session, "view sel", log=False)
+
 
+  def refine_maps(self,data_ids,log=False):
+    # replace coarse maps with the full resolution maps, in one batch
+    data_ids = [data_id for data_id in data_ids
+                if data_id in self.coarse_models] # not removed meanwhile
+    if len(data_ids)==0:
+      return
+    for data_id,data_payload in zip(data_ids,
+                                    self.retrieve_data_many(data_ids)):
+      coarse_models = self.coarse_models.pop(data_id,None)
+      if coarse_models is not None:
+        self.session.models.close(coarse_models)
+      if data_payload is not None:
+        self.add_model(data_payload,log=log)
+        self.data[data_id] = data_payload
+        self.apply_depiction(data_id,log=log)
+
+  def apply_depiction(self,data_id,log=False):
+    # the colors and styles of the current scene for one data entry
+    self.apply_colors([color for color in self.current_scene.get("colors",[])
+                       if color["id"] == data_id],log=log)
+    self.apply_styles([style for style in self.current_scene.get("styles",[])
+                       if style["id"] == data_id],log=log)
 
   def add_model(self,data_payload,log=False):
     """
@@ -179,21 +504,17 @@ class PhenixClient():
       models, status_message = self.session.open_command.open_data(
         read_filepath)
     else:
-      if data_payload["object"]=="model":
+      if (data_payload["object"]=="model" and
+          data_payload["source"]["filestring"]["suffix"]==".columns"):
+        models = structures_from_columns(self.session,data_payload)
+      elif data_payload["object"]=="model":
         with tempfile.NamedTemporaryFile(mode="w+t",suffix=data_payload["source"]["filestring"]["suffix"]) as tmp:
           tmp.write(data_payload["source"]["filestring"]["string"])
           tmp.seek(0)
           models, status_message = self.session.open_command.open_data(
             tmp.name)
-      # map data from list is under construction.
-      # elif data_payload["object"]=="map":
-      #   l=data_payload["source"]["list"]["list_rep"]
-      #   shape = data_payload["data"][1]['source']["list"]["shape"]
-      #   a = np.array(l).reshape(shape).astype("float32")
-      #   with tempfile.NamedTemporaryFile("w+t", suffix=".mrc") as tmp:
-      #     with mrcfile.new(tmp.name, overwrite=True) as fh:
-      #       fh.set_data(a)
-      #     models, status_message = self.session.open_command.open_data(tmp.name)
+      elif data_payload["object"]=="map":
+        models = self.open_map_array(data_payload)
     if models is not None:
       for model in models:
         model.name = data_payload["name"]
@@ -213,11 +534,117 @@ class PhenixClient():
       if data_payload["object"]=="map":
         run(self.session,"volume #"+str(model_id)+" rmsLevel 2.5",log=False)
         run(self.session,"transparency #"+str(model_id)+" 60",log=False)
+    return models
+
+  def apply_coordinates(self,data_payload,log=False):
+    """
+    Move the atoms of a loaded model to the coordinates of a CoordinatesAPI
+    payload, in place. The server sends atoms in hierarchy order, where each
+    alternate conformer is an atom of its own, they are matched to the atoms
+    of the structure by their labels (see atom_map).
+    """
+    model_id = self.model_id_mapper.get(data_payload["model_id"])
+    if model_id is None:
+      return
+    structures = [m for m in self.session.models.list(model_id=(model_id,))
+                  if hasattr(m,"atoms")]
+    if len(structures) == 0:
+      return
+    structure = structures[0]
+    arrays = coordinates_arrays(data_payload)
+    n_atoms = data_payload["source"]["n_atoms"]
+    targets, altlocs = self.atom_map(data_payload["model_id"],structure)
+    indices = arrays["indices"]
+    if indices is None:
+      indices = np.arange(len(targets))
+    if len(indices) != n_atoms or (n_atoms > 0 and
+                                   indices.max() >= len(targets)):
+      self.session.logger.warning("Coordinates do not match the atoms of: "+
+                                  structure.name)
+      return
+    targets = targets[indices]
+    altlocs = altlocs[indices]
+    values = [(key,arrays[key]) for key in ["xyz","b","occ"]
+              if arrays[key] is not None]
+    found = targets >= 0
+
+    # atoms without alternate locations in bulk
+    single = found & (altlocs == "")
+    atoms = structure.atoms.filter(targets[single])
+    for key,array in values:
+      if key == "xyz":
+        atoms.coords = array[single]
+      elif key == "b":
+        atoms.bfactors = array[single]
+      else:
+        atoms.occupancies = array[single]
+
+    # conformers one by one, switching the location of the atom
+    for k in np.flatnonzero(found & (altlocs != "")):
+      atom = structure.atoms[int(targets[k])]
+      current = atom.alt_loc
+      switch = altlocs[k] in atom.alt_locs
+      if switch:
+        atom.set_alt_loc(altlocs[k],False)
+      elif len(atom.alt_locs) > 0:
+        continue # a conformer ChimeraX did not keep
+      for key,array in values:
+        if key == "xyz":
+          atom.coord = array[k]
+        elif key == "b":
+          atom.bfactor = array[k]
+        else:
+          atom.occupancy = array[k]
+      if switch:
+        atom.set_alt_loc(current,False)
+    if arrays["xyz"] is not None:
+      self.atom_index.invalidate(structure)
+
+  def atom_map(self,data_id,structure):
+    """
+    (targets, altlocs) mapping the server atoms of model data_id to the atoms
+    of structure (see match_atoms), fetched once per structure. Atoms are
+    matched by their order if the server has no atom labels for the model
+    (e.g. a model read from a file by the client).
+    """
+    cached = self.atom_maps.get(data_id)
+    if cached is not None and cached[0] is structure:
+      return cached[1]
+    labels = self.server.atom_labels(data_id)
+    atoms = structure.atoms
+    if labels is not None:
+      residues = atoms.residues
+      atom_map = match_atoms(labels,residues.chain_ids,residues.numbers,
+                             residues.insertion_codes,atoms.names)
+    else:
+      atom_map = (np.arange(len(atoms)),np.full(len(atoms),"",dtype=np.str_))
+    self.atom_maps[data_id] = (structure,atom_map)
+    return atom_map
+
+  def open_map_array(self,data_payload):
+    """
+    Make a volume directly from the map values in the payload, no tempfile.
+    cctbx arrays are indexed (x,y,z), ChimeraX expects (z,y,x).
+    """
+    from chimerax.map_data import ArrayGridData
+    from chimerax.map import volume_from_grid_data
+    result = map_array(data_payload)
+    if result is None:
+      return None
+    array, origin, step = result
+    grid = ArrayGridData(array.transpose(), origin=origin, step=step,
+                         name=data_payload["name"])
+    volume = volume_from_grid_data(grid, self.session, open_model=False)
+    return [volume]
 
   def _on_close(self, *_):
+    if hasattr(self, "_stop_watch"):
+      self._stop_watch.set()
     if hasattr(self, "handlers"):
       for h in self.handlers:
         self.session.triggers.remove_handler(h)
+    if hasattr(self, "atom_index"):
+      self.atom_index.close()
     del self.tool
     delattr(self.session, 'phenix_client')
 
@@ -1,94 +1,279 @@
-def detect_server_version():
-  PYRO_VERSION = None
+import os
+import sys
+import json
+
+"""
+Finding the Phenix server.
+
+Looking for a name server by broadcast can take seconds per Pyro version, so
+connect() first tries what is already known: the services listed in the
+rendezvous file written by the server's PyroManager, then the name server of
+the last successful connect. Only if both fail is the name server located
+the slow way. Proxies are made for the chosen service only.
+
+The rendezvous file (rendezvous_path, the same path as in
+phenix.api.pyro_manager):
+  {"pyro_version": 5,
+   "ns_uri": "PYRO:Pyro.NameServer@localhost:9090",
+   "pid": 12345,
+   "services": {"phenix.server.16990000001234": "PYRO:obj_...@localhost:40001"}}
+The connect cache (connect_cache_path) keeps pyro_version and ns_uri only.
+Both are in a directory of the user (private_dir, mode 0700), and are only
+read if owned by the user and not writable by group or others.
+"""
+
+connect_timeout = 1. # seconds to wait for a known server or name server
+
+
+def private_dir(create=False):
+  # as phenix.api.pyro_manager.private_dir: a directory of this user only,
+  # not the shared temporary directory where another user could make the
+  # files first
+  runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+  if runtime_dir:
+    path = os.path.join(runtime_dir, "phenix-pyro")
+  else:
+    path = os.path.join(os.path.expanduser("~"), ".phenix", "pyro")
+  if create:
+    if not os.path.isdir(path):
+      os.makedirs(path, 0o700)
+    if not sys.platform.startswith("win"):
+      os.chmod(path, 0o700)
+  return path
+
+
+def rendezvous_path():
+  path = os.environ.get("PHENIX_PYRO_RENDEZVOUS")
+  if path:
+    return path
+  return os.path.join(private_dir(), "rendezvous.json")
+
+
+def connect_cache_path(create=False):
+  return os.path.join(private_dir(create=create), "client.json")
+
+
+def _trusted(path):
+  """
+  Whether path is a file of this user that nobody else can write. Other files
+  are not read, they could send the client to someone else's server.
+  """
+  if sys.platform.startswith("win"):
+    return True # the profile directory is private
   try:
-    import Pyro4
-    with Pyro4.locateNS() as ns:
-      PYRO_VERSION = 4
-  except:
-    pass
+    st = os.stat(path)
+  except OSError:
+    return False
+  return st.st_uid == os.getuid() and not st.st_mode & 0o022
+
+
+def _read_json(path):
+  if not _trusted(path):
+    return None
   try:
-    import Pyro5
-    with Pyro5.api.locate_ns() as ns:
-      if "5" in ns._pyroUri.__class__.__module__:
-        PYRO_VERSION=5
-  except:
-    pass
-  if PYRO_VERSION == None:
-    PYRO_VERSION = 5
-  return PYRO_VERSION
+    with open(path) as fh:
+      return json.load(fh)
+  except (IOError, OSError, ValueError):
+    return None
 
 
+def _process_alive(pid):
+  if pid is None or sys.platform.startswith("win"):
+    return True # checked by binding the proxy instead
+  try:
+    os.kill(pid, 0)
+  except OSError as e:
+    return e.errno == 1 # EPERM, alive but not ours
+  return True
 
 
+def last_connection():
+  """
+  The rendezvous file of a running server, else the connect cache, else
+  None.
+  """
+  rendezvous = _read_json(rendezvous_path())
+  if rendezvous is not None and _process_alive(rendezvous.get("pid")):
+    return rendezvous
+  return _read_json(connect_cache_path())
 
-def find_server(prefix="", uri=None, return_index=None, try_most_recent=True,PYRO_VERSION=4):
 
-  if PYRO_VERSION ==4:
+def remember_connection(pyro_version, ns_uri):
+  try:
+    path = connect_cache_path(create=True)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    if hasattr(os, "fchmod"):
+      os.fchmod(fd, 0o600) # a file others can write is not read back
+    with os.fdopen(fd, "w") as fh:
+      json.dump({"pyro_version": pyro_version, "ns_uri": str(ns_uri)}, fh)
+  except (IOError, OSError):
+    pass
+
+
+def _locate_ns(PYRO_VERSION, ns_uri=None):
+  if PYRO_VERSION == 4:
     import Pyro4
     import Pyro4.naming
+    if ns_uri is not None:
+      return Pyro4.Proxy(ns_uri)
+    return Pyro4.naming.locateNS()
   else:
-    import Pyro5
-    import Pyro5.client
     import Pyro5.api
+    if ns_uri is not None:
+      return Pyro5.api.Proxy(ns_uri)
+    return Pyro5.api.locate_ns()
+
+
+def detect_server_version(connection=None):
+  """
+  The Pyro version of the name server: the one of connection (see
+  last_connection) if known, else the first version whose name server can
+  be located, Pyro5 first.
+  """
+  if connection is None:
+    connection = last_connection()
+  if connection and connection.get("pyro_version") in [4, 5]:
+    return connection["pyro_version"]
+  for PYRO_VERSION in [5, 4]:
+    try:
+      with _locate_ns(PYRO_VERSION) as ns:
+        return PYRO_VERSION
+    except Exception:
+      pass
+  return 5
+
+
+def newest_name(service_names):
+  """
+  The most recently started service, by the time stamp ending its name.
+  """
+  times = []
+  for name in service_names:
+    t = str(name).split(".")[-1]
+    try:
+      times.append(float(t))
+    except ValueError:
+      times.append(0)
+  return [x for _, x in sorted(zip(times, service_names), reverse=True)][0]
 
+
+def find_server(prefix="", uri=None, return_index=None, try_most_recent=True,
+                PYRO_VERSION=4, ns_uri=None):
+  """
+  Look up services in the name server (at ns_uri, or located by Pyro). Names
+  are listed without making proxies, the proxy is made for the chosen
+  service only (for all of them only if neither uri, try_most_recent nor
+  return_index pick one).
+  """
   failed = False
-  services = []
-  service_names = []
-  service_uris = []
   service, service_name, service_uri = None, None, None
 
   if uri is not None:
     prefix = ""
 
-  if PYRO_VERSION == 4:
-    with Pyro4.naming.locateNS() as ns:
-      for service, service_uri in ns.list(prefix=prefix).items():
-        # print("found service:", service)
-        services.append(Pyro4.Proxy(service_uri))
-        service_names.append(service)
-        service_uris.append(service_uri)
-  else:
-    with Pyro5.api.locate_ns() as ns:
-      for service, service_uri in ns.list(prefix=prefix).items():
-        # print("found service:", service)
-        services.append(Pyro5.api.Proxy(service_uri))
-        service_names.append(service)
-        service_uris.append(service_uri)
-
-  if len(services) == 0:
+  with _locate_ns(PYRO_VERSION, ns_uri=ns_uri) as ns:
+    if ns_uri is not None:
+      ns._pyroTimeout = connect_timeout
+    listed = ns.list(prefix=prefix)
+    found_ns_uri = ns._pyroUri
+  service_names = list(listed.keys())
+  service_uris = [listed[name] for name in service_names]
+
+  if len(service_names) == 0:
     failed = True
+  else:
+    remember_connection(PYRO_VERSION, found_ns_uri)
 
   if uri != None:
     service_uri_strings = [str(service_uri) for service_uri in service_uris]
-    try:
+    if uri in service_uri_strings:
       service_index = service_uri_strings.index(uri)
-      service = services[service_index]
       service_name = service_names[service_index]
       service_uri = service_uris[service_index]
-      return service, service_name, service_uri, failed
-    except:
-      pass
+      service = make_proxy(service_uri, PYRO_VERSION=PYRO_VERSION)
+    return service, service_name, service_uri, failed
+
+  elif failed:
+    return service, service_name, service_uri, failed
 
   elif try_most_recent:
-    times = []
-    for name in service_names:
-      name = str(name)
-      split = name.split(".")
-      t = split[-1]
-      try:
-        times.append(float(t))
-      except:
-        times.append(0)
-    sorted_names = [x for _, x in
-                    sorted(zip(times, service_names), reverse=True)]
-    name = sorted_names[0]
-    name_index = service_names.index(name)
-    service = services[name_index]
-    service_uri = service_uris[name_index]
+    name = newest_name(service_names)
+    service_uri = listed[name]
+    service = make_proxy(service_uri, PYRO_VERSION=PYRO_VERSION)
     return service, name, service_uri, failed
 
   elif return_index is not None:
-    return services[return_index], service_names[return_index], service_uris[
-      return_index], failed
+    service_uri = service_uris[return_index]
+    return make_proxy(service_uri, PYRO_VERSION=PYRO_VERSION), service_names[
+      return_index], service_uri, failed
   else:
+    services = [make_proxy(u, PYRO_VERSION=PYRO_VERSION) for u in service_uris]
     return services, service_names, service_uris, failed
+
+
+def _bind(uri, PYRO_VERSION):
+  # a proxy connected to uri, or None if nothing answers there
+  proxy = make_proxy(uri, PYRO_VERSION=PYRO_VERSION)
+  timeout = proxy._pyroTimeout
+  proxy._pyroTimeout = connect_timeout
+  try:
+    proxy._pyroBind()
+  except Exception:
+    proxy._pyroRelease()
+    return None
+  proxy._pyroTimeout = timeout
+  return proxy
+
+
+def connect(uri=None, prefix=""):
+  """
+  Find the server (the one at uri, or the most recent one) and make a proxy
+  for it, trying the fast paths first (see above).
+  Returns (proxy, service name, service uri, pyro version, failed)
+  """
+  connection = last_connection() or {}
+  PYRO_VERSION = connection.get("pyro_version")
+  if PYRO_VERSION in [4, 5]:
+    services = dict((name, service_uri) for name, service_uri in
+                    (connection.get("services") or {}).items()
+                    if name.startswith(prefix))
+    name = None
+    if uri is None and services:
+      name = newest_name(list(services.keys()))
+    elif uri is not None:
+      names = [n for n, u in services.items() if u == uri]
+      name = names[0] if names else None
+    if name is not None:
+      proxy = _bind(services[name], PYRO_VERSION)
+      if proxy is not None:
+        return proxy, name, services[name], PYRO_VERSION, False
+    if connection.get("ns_uri"):
+      try:
+        service, name, service_uri, failed = find_server(
+          prefix=prefix, uri=uri, PYRO_VERSION=PYRO_VERSION,
+          ns_uri=connection["ns_uri"])
+        if not failed and service is not None:
+          return service, name, service_uri, PYRO_VERSION, failed
+      except Exception:
+        pass
+
+  PYRO_VERSION = detect_server_version(connection={})
+  try:
+    service, name, service_uri, failed = find_server(
+      prefix=prefix, uri=uri, PYRO_VERSION=PYRO_VERSION)
+  except Exception:
+    return None, None, None, PYRO_VERSION, True
+  return service, name, service_uri, PYRO_VERSION, failed or service is None
+
+
+def make_proxy(uri, PYRO_VERSION=5):
+  """
+  A new proxy for uri. Pyro proxies belong to the thread that made them, so
+  each thread talking to the server needs its own.
+  """
+  if PYRO_VERSION == 4:
+    import Pyro4
+    return Pyro4.Proxy(uri)
+  else:
+    import Pyro5.api
+    return Pyro5.api.Proxy(uri)
@@ -2,9 +2,7 @@ from uuid import uuid4
 import sys
 import copy
 
-from mmtbx.model.model import manager as model_manager
-from iotbx.map_manager import map_manager
-from iotbx.map_model_manager import map_model_manager
+import numpy as np
 
 if sys.version_info.major == 2:
   from pathlib2 import Path
@@ -27,9 +25,32 @@ payload_init = {"name":"model 1",
                 }
 model_api = ModelAPI(model,payload_init=payload_init)
 payload = model_api.payload # a dict to send somewhere
+
+With lazy=True the body of the payload (model string, map values) is not
+encoded at initialization. It is encoded once, on the first call to
+materialize(), which PhenixServer does when the data is first requested.
 """
 
 
+# module and class name of the cctbx objects api objects are made from
+cctbx_classes = {"model": ("mmtbx.model.model", "manager"),
+                 "map": ("iotbx.map_manager", "map_manager"),
+                 "map_model": ("iotbx.map_model_manager", "map_model_manager")}
+
+
+def is_cctbx_object(obj, kind):
+  """
+  isinstance for the cctbx classes, without importing cctbx. An object can
+  only be an instance of a class whose module is already imported, so if it
+  is not, the answer is False and nothing is imported.
+  """
+  module_name, class_name = cctbx_classes[kind]
+  module = sys.modules.get(module_name)
+  if module is None:
+    return False
+  return isinstance(obj, getattr(module, class_name))
+
+
 class ObjectAPI(object):
   _payload_template = {"id": None,
                        "object": "object"}
@@ -45,13 +66,53 @@ class ObjectAPI(object):
       self.obj = args[0]
 
     self.payload_working = payload_init
+    self.lazy = kwargs.get("lazy", False)
+    self._body_encoded = False
 
     if "id" not in self.payload_working:
       self.payload_working["id"] = str(uuid4())
 
+  def materialize(self):
+    """
+    Encode the payload body if that has not been done yet, and return the
+    payload. The encoded body is kept, so this is only expensive once.
+    """
+    if not self._body_encoded:
+      self._encode_body()
+      self._body_encoded = True
+      self._working_changed()
+    return self.payload
+
+  def _encode_body(self):
+    # Subclasses with a payload body fill it in here
+    pass
+
+  @property
+  def payload_working(self):
+    # changing it in place must be followed by _working_changed()
+    return self._payload_working
+
+  @payload_working.setter
+  def payload_working(self, value):
+    self._payload_cache = None
+    self._payload_working = value
+
+  def _working_changed(self):
+    # the merged payload is stale after payload_working changed in place
+    self._payload_cache = None
+
   @property
   def payload(self):
-    return self.mergedicts(self.payload_template, self.payload_working)
+    """
+    The working values merged into the template. The merge is done once and
+    cached until payload_working changes. Returns a shallow copy: its keys
+    can be set, but the nested dicts and lists are shared with the cache, so
+    treat them as read-only.
+    """
+    if self._payload_cache is None:
+      self._payload_cache = self.mergedicts(self.payload_template,
+                                            self._payload_working)
+    return dict(self._payload_cache)
 
   @property
   def payload_template(self):
@@ -94,7 +155,12 @@ class ModelAPI(ObjectAPI):
       "fetch": None,
       "filestring": {
         "string": None,
-        "suffix": ".pdb"
+        "suffix": ".pdb"  # ".columns" to send the columns block instead
+      },
+      "columns": {
+        "bytes": None,  # packed arrays of the atom table, see model_columns
+        "arrays": (),  # (name, dtype, shape, offset) of each array
+        "crystal_symmetry": None,
       },
     },
     "destination": {
@@ -103,7 +169,7 @@ class ModelAPI(ObjectAPI):
     },
   }
 
-  known_suffixes = [".pdb", ".cif", ".mmcif", ".mol"]
+  known_suffixes = [".pdb", ".cif", ".mmcif", ".mol", ".columns"]
 
   def __init__(self, *args, **kwargs):
     super(ModelAPI, self).__init__(*args, **kwargs)
@@ -116,7 +182,7 @@ class ModelAPI(ObjectAPI):
 
     # deal with the object type
     if self.obj is not None:
-      if not isinstance(self.obj, model_manager):
+      if not is_cctbx_object(self.obj, "model"):
         raise ValueError("Object type not supported")
 
     # deal with read filepath suffix
@@ -149,6 +215,10 @@ class ModelAPI(ObjectAPI):
     self.payload_working = self.mergedicts(self.payload_template,
                                            self.payload_working)
 
+    if not self.lazy:
+      self.materialize()
+
+  def _encode_body(self):
     # decide if we need to represent the model as a string
     string_needed = False
     if (
@@ -158,14 +228,33 @@ class ModelAPI(ObjectAPI):
     ):
       string_needed = True
     if string_needed:
-      if self.obj is not None:
+      suffix = self.payload_working["source"]["filestring"]["suffix"]
+      if self.obj is not None and suffix == ".columns":
+        self.payload_working["source"]["columns"] = self.columns_rep
+      elif self.obj is not None:
         self.payload_working["source"]["filestring"]["string"] = self.str_rep
 
+  @property
+  def columns_rep(self):
+    """
+    The model as packed columns (see model_columns), no text formatting.
+    """
+    from phenix.api.atom_table import atom_table_from_model
+    from phenix.api.model_columns import columns_from_table
+    crystal_symmetry = None
+    cs = self.obj.crystal_symmetry()
+    if cs is not None and cs.unit_cell() is not None:
+      crystal_symmetry = {
+        "unit_cell": tuple(cs.unit_cell().parameters()),
+        "space_group": cs.space_group_info().type().lookup_symbol()}
+    return columns_from_table(atom_table_from_model(self.obj),
+                              crystal_symmetry=crystal_symmetry)
+
   @property
   def str_rep(self):
     model_obj = self.obj
     suffix = self.payload_working["source"]["filestring"]["suffix"]
-    if isinstance(model_obj, model_manager):
+    if is_cctbx_object(model_obj, "model"):
       if suffix in [".cif", ".mmcif"]:
         str_rep = model_obj.model_as_mmcif(do_not_shift_back = True)
       else:
@@ -183,12 +272,27 @@ class MapAPI(ObjectAPI):
       "read_filepath": None,
       "read_url": None,
       "fetch": None,
+      "encoding": "list",  # how the map values are sent, one of known_encodings
       "list": {
         "list_rep": None,  # flattened in row-major (C-style) order
         "dtype": "float32",
         "shape": tuple(),
         "pixel_sizes": tuple(),
       },
+      "binary": {
+        "bytes": None,  # one contiguous buffer in row-major (C-style) order
+        "dtype": "<f4",  # numpy dtype string, always little-endian
+        "shape": tuple(),
+        "origin": tuple(),  # grid index of the first voxel
+        "pixel_sizes": tuple(),
+      },
+      "lod": {
+        "level": 1,  # binning factor of the values in this payload
+        "levels": (1, 2, 4, 8),  # levels the server can provide
+        # Cartesian offset of the voxel centers from origin * pixel_sizes,
+        # half a bin for binned levels
+        "offset": (0., 0., 0.),
+      },
       "shift_cart": tuple(),
     },
     "destination": {
@@ -198,6 +302,7 @@ class MapAPI(ObjectAPI):
   }
 
   known_suffixes = [".ccp4", ".mrc", ".map"]
+  known_encodings = ["list", "binary"]
 
   def __init__(self, *args,**kwargs):
     super(MapAPI, self).__init__(*args, **kwargs)
@@ -211,7 +316,7 @@ class MapAPI(ObjectAPI):
 
     # deal with the object type
     if self.obj is not None:
-      if not isinstance(self.obj, map_manager):
+      if not is_cctbx_object(self.obj, "map"):
         raise ValueError("Map object type not supported")
 
     # deal with read filepath suffix
@@ -228,6 +333,20 @@ class MapAPI(ObjectAPI):
    # merge in defaults
     self.payload_working = self.mergedicts(self.payload_template,
                                            self.payload_working)
+
+    # deal with the encoding
+    encoding = self.payload_working["source"]["encoding"]
+    if encoding not in self.known_encodings:
+      raise ValueError("Encoding type not supported:", encoding)
+    dtype = np.dtype(self.payload_working["source"]["binary"]["dtype"])
+    self.payload_working["source"]["binary"]["dtype"] = dtype.newbyteorder(
+      "<").str
+
+    if not self.lazy:
+      self.materialize()
+
+  def _encode_body(self):
+    encoding = self.payload_working["source"]["encoding"]
     # decide if we need to represent the map as a list
     list_needed = False
     if (
@@ -237,7 +356,13 @@ class MapAPI(ObjectAPI):
     ):
       list_needed = True
     if list_needed:
-      if self.obj is not None:
+      if self.obj is not None and encoding == "binary":
+        binary = self.payload_working["source"]["binary"]
+        binary["bytes"] = self.binary_rep
+        binary["shape"] = tuple(self.obj.map_data().all())
+        binary["origin"] = tuple(self.obj.map_data().origin())
+        binary["pixel_sizes"] = tuple(self.obj.pixel_sizes())
+      elif self.obj is not None:
         self.payload_working["source"]["list"]["list_rep"] = self.list_rep
         self.payload_working["source"]["list"][
           "shape"] = self.obj.map_data().all()
@@ -247,9 +372,166 @@ class MapAPI(ObjectAPI):
   @property
   def list_rep(self):
     map_obj = self.obj
-    if isinstance(map_obj, map_manager):
+    if is_cctbx_object(map_obj, "map"):
       return list(map_obj.map_data())
 
+  @property
+  def binary_rep(self):
+    """
+    The map values as one little-endian buffer. The array is converted
+    in bulk, there is no per-voxel Python work.
+    """
+    map_obj = self.obj
+    if is_cctbx_object(map_obj, "map"):
+      dtype = self.payload_working["source"]["binary"]["dtype"]
+      array = map_obj.map_data().as_numpy_array()
+      return np.ascontiguousarray(array, dtype=dtype).tobytes()
+
+
+class CoordinatesAPI(ObjectAPI):
+  """
+  New coordinates for the atoms of a model a client already has, to update
+  it in place instead of sending the whole model again. B-factors and
+  occupancies are optional, and an update can be restricted to some atoms.
+  Atoms are in hierarchy order.
+
+  Usage:
+  coordinates_api = CoordinatesAPI(model, payload_init={"model_id": model_id})
+  server.update_coordinates(coordinates_api.payload)
+
+  The arrays can also be given in payload_init (as numpy arrays or lists),
+  without a model object.
+  """
+  _payload_template = {
+    "object": "coordinates",
+    "name": "coordinates",
+    "model_id": None,  # id of the model payload to update
+    "fields": ("xyz",),  # the arrays to send, from known_fields
+    "source": {
+      "n_atoms": 0,  # number of atoms updated
+      "xyz": None,  # (n_atoms, 3) little-endian float32 bytes
+      "b": None,  # (n_atoms,) little-endian float32 bytes
+      "occ": None,  # (n_atoms,) little-endian float32 bytes
+      "indices": None,  # (n_atoms,) little-endian int32 bytes, None for all
+    },
+  }
+
+  known_fields = ["xyz", "b", "occ"]
+  dtypes = {"xyz": "<f4", "b": "<f4", "occ": "<f4", "indices": "<i4"}
+
+  def __init__(self, *args, **kwargs):
+    super(CoordinatesAPI, self).__init__(*args, **kwargs)
+    if "payload_init" in kwargs:
+      payload_init = kwargs["payload_init"]
+    else:
+      payload_init = {}
+
+    # arrays given in payload_init, encoded before any merge compares them
+    source = payload_init.get("source", {})
+    for key in self.known_fields + ["indices"]:
+      if source.get(key) is not None and not isinstance(source[key], bytes):
+        array = np.asarray(source[key])
+        source[key] = np.ascontiguousarray(array,
+                                           dtype=self.dtypes[key]).tobytes()
+        if key == "xyz":
+          source["n_atoms"] = array.size // 3
+        else:
+          source["n_atoms"] = array.size
+
+    self.payload_working = self.mergedicts(self.payload_working,payload_init)
+
+    # deal with the object type
+    if self.obj is not None:
+      if not is_cctbx_object(self.obj, "model"):
+        raise ValueError("Object type not supported")
+
+    # merge in default template values
+    self.payload_working = self.mergedicts(self.payload_template,
+                                           self.payload_working)
+    if self.payload_working["model_id"] is None:
+      raise ValueError("A model_id is required")
+    for field in self.payload_working["fields"]:
+      if field not in self.known_fields:
+        raise ValueError("Field not supported:", field)
+
+    if not self.lazy:
+      self.materialize()
+
+  def _encode_body(self):
+    if self.obj is None:
+      return
+    source = self.payload_working["source"]
+    atoms = self.obj.get_hierarchy().atoms()
+    indices = None
+    if source["indices"] is not None:
+      indices = np.frombuffer(source["indices"], dtype="<i4")
+    arrays = {"xyz": atoms.extract_xyz,
+              "b": atoms.extract_b,
+              "occ": atoms.extract_occ}
+    for field in self.payload_working["fields"]:
+      array = arrays[field]().as_numpy_array()
+      if indices is not None:
+        array = array[indices]
+      source[field] = np.ascontiguousarray(array,
+                                           dtype=self.dtypes[field]).tobytes()
+      source["n_atoms"] = len(array)
+
+  @classmethod
+  def fields_of(cls, payload):
+    # the arrays a coordinates payload sets
+    return [key for key in cls.known_fields
+            if payload["source"].get(key) is not None]
+
+  @classmethod
+  def _array(cls, source, key):
+    array = np.frombuffer(source[key], dtype=cls.dtypes[key])
+    return array.reshape(-1, 3) if key == "xyz" else array
+
+  @classmethod
+  def merge(cls, earlier, later):
+    """
+    One partial update with the changes of coordinates payload later applied
+    on top of earlier, for the id of later, or None if they can not be
+    merged. Both must be partial updates (indices set) of the same arrays.
+    Arrays must be bytes.
+    """
+    fields = cls.fields_of(later)
+    if (earlier["source"]["indices"] is None or
+        later["source"]["indices"] is None or
+        not fields or fields != cls.fields_of(earlier)):
+      return None
+    old, new = earlier["source"], later["source"]
+    old_indices = cls._array(old, "indices")
+    new_indices = cls._array(new, "indices")
+    keep = ~np.isin(old_indices, new_indices)
+    merged = dict(later)
+    merged["fields"] = tuple(fields)
+    source = dict(new)
+    source["indices"] = np.concatenate(
+      [old_indices[keep], new_indices]).astype("<i4").tobytes()
+    for key in fields:
+      array = np.concatenate([cls._array(old, key)[keep],
+                              cls._array(new, key)])
+      source[key] = np.ascontiguousarray(array, dtype=cls.dtypes[key]).tobytes()
+    source["n_atoms"] = int(np.count_nonzero(keep)) + len(new_indices)
+    merged["source"] = source
+    return merged
+
+  @classmethod
+  def covers(cls, later, earlier):
+    """
+    True if coordinates payload later sets every value earlier sets, so
+    earlier has no effect after later. Arrays must be bytes.
+    """
+    if not set(cls.fields_of(earlier)) <= set(cls.fields_of(later)):
+      return False
+    if later["source"]["indices"] is None:
+      return True
+    if earlier["source"]["indices"] is None:
+      return False
+    return bool(np.isin(cls._array(earlier["source"], "indices"),
+                        cls._array(later["source"], "indices")).all())
+
 
 class SceneAPI(ObjectAPI):
   _payload_template = {
@@ -278,7 +560,7 @@ class SceneAPI(ObjectAPI):
     "id": None,  # A model to focus on
     "selection": None,  # Optionally a selection of that model
     "xyz": (0., 0., 0.),  # Alternatively, focus on a point
-    "xyz_expand": None}  # Focus on the nearest entity to the xyz point. One of [None,"model","chain","residue","atom"]
+    "xyz_expand": "residue"}  # Focus on the nearest entity to the xyz point. One of ["model","chain","residue","atom"], None for "residue"
   # environment
   # TODO: this needs a lot more attention
   environment_template = {"background_color": "#FFFFFF",
@@ -292,6 +574,31 @@ class SceneAPI(ObjectAPI):
     scene.payload_working["id"] = scene_id
     return scene
 
+  # fields compared by delta
+  _delta_list_fields = ("data", "colors", "styles")
+  _delta_value_fields = ("id", "focus", "environment")
+
+  @classmethod
+  def delta(cls, old, new):
+    """
+    The changes from scene payload old to scene payload new. List fields
+    (data, colors, styles) give the added and removed entries, the other
+    fields their new value. Unchanged fields are left out.
+
+    Example: {"focus": {...}, "colors": {"added": [...], "removed": []}}
+    """
+    changes = {}
+    for key in cls._delta_value_fields:
+      if old.get(key) != new.get(key):
+        changes[key] = new.get(key)
+    for key in cls._delta_list_fields:
+      old_list, new_list = old.get(key, []), new.get(key, [])
+      if old_list != new_list:
+        changes[key] = {
+          "added": [entry for entry in new_list if entry not in old_list],
+          "removed": [entry for entry in old_list if entry not in new_list]}
+    return changes
+
   @classmethod
   def from_objects(cls, *objects,**kwargs):
     if "payload_init" in kwargs:
@@ -302,19 +609,20 @@ class SceneAPI(ObjectAPI):
     maps = []
     models = []
     for obj in objects:
-      if isinstance(obj, map_manager):
+      if is_cctbx_object(obj, "map"):
         maps.append(obj)
-      elif isinstance(obj, map_model_manager):
+      elif is_cctbx_object(obj, "map_model"):
         models.append(obj.model())
         maps.append(obj.map_manager())
-      elif isinstance(obj, model_manager):
+      elif is_cctbx_object(obj, "model"):
         models.append(obj)
       else:
         print(
           "ERROR: Only high level CCTBX map/model objects are supported by this function, not",
           type(obj))
-    model_api_objects = [ModelAPI(obj) for obj in models]
-    map_api_objects = [MapAPI(obj) for obj in maps]
+    lazy = kwargs.get("lazy", False)
+    model_api_objects = [ModelAPI(obj, lazy=lazy) for obj in models]
+    map_api_objects = [MapAPI(obj, lazy=lazy) for obj in maps]
     api_objects = tuple(model_api_objects + map_api_objects)
     return cls.from_api_objects(*api_objects, payload_init=payload_init)
 
@@ -332,7 +640,9 @@ class SceneAPI(ObjectAPI):
                          api_object.__class__)
 
     payloads = (api_object.payload for api_object in api_objects)
-    return cls.from_api_payloads(*payloads, payload_init=payload_init)
+    scene = cls.from_api_payloads(*payloads, payload_init=payload_init)
+    scene.api_objects = api_objects
+    return scene
 
   @classmethod
   def from_api_payloads(cls, *data_api_payloads, **kwargs):
@@ -356,6 +666,8 @@ class SceneAPI(ObjectAPI):
                                            payload_init)
 
     self.payload_working["data"] += list(data)
+    self._working_changed()
+    self.api_objects = () # set when made from api objects
 
     if apply_defaults:
       self.apply_default_colors()
@@ -363,6 +675,7 @@ class SceneAPI(ObjectAPI):
   def add_color(self, object_id, color, selection=""):
     self.payload_working["colors"].append(
       {"id": object_id, "color": color, "selection": selection})
+    self._working_changed()
 
   def apply_default_colors(self):
     preferred_model_colors = set(["#3465A4", "#761c94"])
@@ -392,5 +705,5 @@ class SceneAPI(ObjectAPI):
 
   @property
   def objects(self):
-    return [payload["uuid"] for payload in self.api_objects]
+    return [api_object.payload["id"] for api_object in self.api_objects]
 
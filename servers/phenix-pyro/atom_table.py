@@ -0,0 +1,190 @@
+import shlex
+
+import numpy as np
+
+"""
+Atom tables: the atoms of a model as numpy columns, one entry per atom in
+hierarchy order.
+
+  xyz      (n,3) float64 coordinates
+  name, altloc, resname, chain, resseq, icode, element, charge, model
+           (n,) unicode strings in the PDB format column widths, except
+           chain which is stripped
+  b, occ   (n,) float64
+  hetero   (n,) bool
+
+A table can be made from a cctbx model manager, or from the PDB/mmCIF string
+or the columns block of a ModelAPI payload. Residues and chains are consecutive runs of atoms,
+see residue_starts and chain_starts.
+"""
+
+string_columns = ["name", "altloc", "resname", "chain", "resseq", "icode",
+                  "element", "charge", "model"]
+float_columns = ["b", "occ"]
+
+
+def _table(rows, xyz):
+  table = {}
+  for key in string_columns:
+    table[key] = np.array(rows[key], dtype=np.str_)
+  for key in float_columns:
+    table[key] = np.array(rows[key], dtype=np.float64)
+  table["hetero"] = np.array(rows["hetero"], dtype=bool)
+  table["xyz"] = np.array(xyz, dtype=np.float64).reshape(-1, 3)
+  return table
+
+
+def atom_table_from_model(model):
+  """
+  Columns from a cctbx mmtbx.model.manager. Per-atom values are extracted in
+  bulk, only the residue and chain labels are looped over.
+  """
+  hierarchy = model.get_hierarchy()
+  atoms = hierarchy.atoms()
+  rows = dict((key, []) for key in string_columns + float_columns + ["hetero"])
+  for m in hierarchy.models():
+    for chain in m.chains():
+      for rg in chain.residue_groups():
+        for ag in rg.atom_groups():
+          n = ag.atoms_size()
+          rows["altloc"] += [ag.altloc or " "] * n
+          rows["resname"] += [ag.resname] * n
+          rows["chain"] += [chain.id.strip()] * n
+          rows["resseq"] += [rg.resseq] * n
+          rows["icode"] += [rg.icode] * n
+          rows["model"] += [m.id] * n
+  rows["name"] = list(atoms.extract_name())
+  rows["element"] = list(atoms.extract_element())
+  rows["charge"] = list(atoms.extract_charge())
+  rows["b"] = atoms.extract_b().as_numpy_array()
+  rows["occ"] = atoms.extract_occ().as_numpy_array()
+  rows["hetero"] = atoms.extract_hetero().as_numpy_array() \
+    if hasattr(atoms, "extract_hetero") else [a.hetero for a in atoms]
+  return _table(rows, atoms.extract_xyz().as_numpy_array())
+
+
+def atom_table_from_pdb_string(string):
+  rows = dict((key, []) for key in string_columns + float_columns + ["hetero"])
+  xyz = []
+  model_id = ""
+  for line in string.splitlines():
+    record = line[:6]
+    if record.startswith("MODEL"):
+      model_id = line[10:14].strip()
+    elif record == "ATOM  " or record == "HETATM":
+      line = line.ljust(80)
+      rows["name"].append(line[12:16])
+      rows["altloc"].append(line[16])
+      rows["resname"].append(line[17:20])
+      rows["chain"].append(line[20:22].strip())
+      rows["resseq"].append(line[22:26])
+      rows["icode"].append(line[26])
+      rows["occ"].append(float(line[54:60] or 1.))
+      rows["b"].append(float(line[60:66] or 0.))
+      rows["element"].append(line[76:78])
+      rows["charge"].append(line[78:80])
+      rows["hetero"].append(record == "HETATM")
+      rows["model"].append(model_id)
+      xyz.append((float(line[30:38]), float(line[38:46]), float(line[46:54])))
+  return _table(rows, xyz)
+
+
+# mmCIF _atom_site items for each column
+_cif_items = {
+  "name": "auth_atom_id",
+  "altloc": "label_alt_id",
+  "resname": "auth_comp_id",
+  "chain": "auth_asym_id",
+  "resseq": "auth_seq_id",
+  "icode": "pdbx_PDB_ins_code",
+  "element": "type_symbol",
+  "charge": "pdbx_formal_charge",
+  "model": "pdbx_PDB_model_num",
+  "b": "B_iso_or_equiv",
+  "occ": "occupancy",
+}
+
+
+def atom_table_from_mmcif_string(string):
+  """
+  Columns from the _atom_site loop of an mmCIF string. Values are put in the
+  PDB column widths, so tables from both formats compare equal.
+  """
+  rows = dict((key, []) for key in string_columns + float_columns + ["hetero"])
+  xyz = []
+  items = []
+  in_loop = False
+  for line in string.splitlines():
+    if line.startswith("_atom_site."):
+      items.append(line.split(".", 1)[1].strip())
+      in_loop = True
+      continue
+    if not in_loop or len(items) == 0:
+      continue
+    if line.startswith("#") or line.startswith("loop_") or \
+        line.startswith("_"):
+      break
+    tokens = shlex.split(line) if ("'" in line or '"' in line) \
+      else line.split()
+    values = dict(zip(items, tokens))
+    for key, item in _cif_items.items():
+      value = values.get(item, "?")
+      if value in ["?", "."]:
+        value = "" if key not in float_columns else \
+          ("1" if key == "occ" else "0")
+      rows[key].append(value)
+    rows["hetero"].append(values.get("group_PDB") == "HETATM")
+    xyz.append((float(values["Cartn_x"]), float(values["Cartn_y"]),
+                float(values["Cartn_z"])))
+  table = _table(rows, xyz)
+  # PDB widths: atom names of 1-3 characters start in the second column
+  name = np.char.strip(table["name"])
+  pad = (np.char.str_len(name) < 4) & (np.char.str_len(table["element"]) < 2)
+  table["name"] = np.where(pad, np.char.ljust(np.char.add(" ", name), 4),
+                           np.char.ljust(name, 4))
+  table["altloc"] = np.char.ljust(table["altloc"], 1)
+  table["resname"] = np.char.rjust(table["resname"], 3)
+  table["resseq"] = np.char.rjust(table["resseq"], 4)
+  table["icode"] = np.char.ljust(table["icode"], 1)
+  table["element"] = np.char.rjust(table["element"], 2)
+  return table
+
+
+def atom_table_from_payload(payload):
+  """
+  Columns from the model string or the columns block (see model_columns) of
+  a ModelAPI payload, or None if the payload carries neither.
+  """
+  filestring = payload["source"]["filestring"]
+  if filestring["suffix"] == ".columns":
+    columns = payload["source"].get("columns")
+    if columns is None or columns["bytes"] is None:
+      return None
+    from phenix.api.model_columns import table_from_columns # imports us
+    return table_from_columns(columns)
+  if filestring["string"] is None:
+    return None
+  if filestring["suffix"] in [".cif", ".mmcif"]:
+    return atom_table_from_mmcif_string(filestring["string"])
+  return atom_table_from_pdb_string(filestring["string"])
+
+
+def run_starts(*columns):
+  # indices where any of the columns changes value
+  n = len(columns[0])
+  if n == 0:
+    return np.zeros(0, dtype=np.int64)
+  changed = np.zeros(n, dtype=bool)
+  changed[0] = True
+  for column in columns:
+    changed[1:] |= column[1:] != column[:-1]
+  return np.flatnonzero(changed)
+
+
+def residue_starts(table):
+  return run_starts(table["model"], table["chain"], table["resseq"],
+                     table["icode"])
+
+
+def chain_starts(table):
+  return run_starts(table["model"], table["chain"])
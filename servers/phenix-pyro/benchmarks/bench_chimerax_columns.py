@@ -0,0 +1,82 @@
+"""
+Time opening a model in ChimeraX from the columnar encoding against opening
+its PDB text, the two ways the ChimeraX client can receive a model.
+
+Runs inside ChimeraX, with phenix.api importable and the ChimeraX-Phenix
+bundle installed. The model of the file is tiled (see roundtrip_columns) to
+make a large one, then opened as PDB text (the client path for ".pdb"
+payloads), from the columns (structures_from_columns, PDB text made from
+the arrays and read by ChimeraX), and atom by atom (build_structures, used
+for models that do not fit the PDB format). The check fails if the
+structures differ in atom count.
+
+Usage:
+  chimerax --nogui --exit --script "bench_chimerax_columns.py [pdb file]
+                                    [--copies N] [--repeat N]"
+"""
+from __future__ import print_function
+
+import os
+import sys
+import argparse
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from roundtrip_columns import default_file, tiled_pdb_string
+from phenix.api.atom_table import atom_table_from_pdb_string
+from phenix.api.model_columns import columns_from_table
+
+
+def open_text(session, string):
+  # as PhenixClient.add_model does for ".pdb" payloads
+  with tempfile.NamedTemporaryFile(mode="w+t", suffix=".pdb") as tmp:
+    tmp.write(string)
+    tmp.flush()
+    models, status_message = session.open_command.open_data(tmp.name)
+  return models
+
+
+def run(session, path, copies=100, repeat=3):
+  from chimerax.phenix.model_columns import (structures_from_columns,
+                                             build_structures, unpack_columns)
+  with open(path) as fh:
+    string = tiled_pdb_string(fh.read(), copies)
+  columns = columns_from_table(atom_table_from_pdb_string(string))
+  payload = {"name": "columns", "source": {"columns": columns}}
+
+  def timed(function):
+    structures = []
+    def call():
+      structures[:] = function()
+    seconds = min(timeit.repeat(call, number=1, repeat=repeat))
+    n_atoms = sum(s.num_atoms for s in structures)
+    for s in structures:
+      s.delete()
+    return seconds, n_atoms
+
+  results = [
+    ("PDB text", timed(lambda: open_text(session, string))),
+    ("columns", timed(lambda: structures_from_columns(session, payload))),
+    ("atom by atom", timed(lambda: build_structures(
+      session, "columns", unpack_columns(columns)))),
+  ]
+  print("%d copies: %.1f MB text, %.1f MB columns" % (
+    copies, len(string) / 1e6, len(columns["bytes"]) / 1e6))
+  for name, (seconds, n_atoms) in results:
+    print("  %-13s %9.1f ms, %d atoms" % (name, seconds * 1e3, n_atoms))
+  if len(set(n_atoms for name, (seconds, n_atoms) in results)) != 1:
+    print("FAILED, atom counts differ")
+    return False
+  return True
+
+
+if __name__ in ("__main__", "ChimeraX_sandbox_1"):
+  parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+  parser.add_argument("path", nargs="?", default=default_file)
+  parser.add_argument("--copies", type=int, default=100)
+  parser.add_argument("--repeat", type=int, default=3)
+  args = parser.parse_args(sys.argv[1:])
+  ok = run(session, args.path, copies=args.copies, repeat=args.repeat)
+  if not ok:
+    sys.exit(1)
@@ -0,0 +1,121 @@
+"""
+Import time of the server side API layer, and a check that it does not
+import cctbx.
+
+Each target is imported in a fresh interpreter, --repeat times. The time of
+the import, of starting a PhenixServer, and of the whole process (interpreter
+startup included) are reported. The check fails (exit status 1) if a cctbx
+package is imported or the process takes longer than --max-seconds, so it
+can guard against regressions.
+
+Usage:
+  python bench_import.py [--repeat N] [--max-seconds S] [--importtime]
+                         [--json out.json]
+"""
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_suite import metadata
+
+heavy_packages = ["cctbx", "iotbx", "mmtbx", "scitbx", "libtbx",
+                  "boost_adaptbx"]
+
+targets = ["phenix.api.api_objects", "phenix.api.pyro_manager",
+           "phenix.api.phenix_server"]
+
+child_code = """
+import sys, time, json
+t = time.perf_counter()
+import %(target)s
+t_import = time.perf_counter() - t
+t_start = None
+if %(start)s:
+  from phenix.api.phenix_server import PhenixServer
+  t = time.perf_counter()
+  PhenixServer().close()
+  t_start = time.perf_counter() - t
+heavy = sorted(set(m.split(".")[0] for m in sys.modules) & set(%(heavy)r))
+print(json.dumps({"import": t_import, "start": t_start, "heavy": heavy}))
+"""
+
+
+def run_child(target, importtime=False):
+  code = child_code % {"target": target,
+                       "start": target == "phenix.api.phenix_server",
+                       "heavy": heavy_packages}
+  command = [sys.executable]
+  if importtime:
+    command += ["-X", "importtime"]
+  t = time.perf_counter()
+  process = subprocess.run(command + ["-c", code], stdout=subprocess.PIPE,
+                           stderr=subprocess.PIPE, universal_newlines=True)
+  seconds = time.perf_counter() - t
+  if process.returncode != 0:
+    raise RuntimeError("Importing %s failed:\n%s" % (target, process.stderr))
+  result = json.loads(process.stdout.strip().splitlines()[-1])
+  result["process"] = seconds
+  return result, process.stderr
+
+
+def slowest_imports(importtime_log, n=10):
+  # (cumulative microseconds, module) from python -X importtime
+  found = []
+  for line in importtime_log.splitlines():
+    if not line.startswith("import time:") or "cumulative" in line:
+      continue
+    fields = line[len("import time:"):].split("|")
+    found.append((int(fields[1]), fields[2].rstrip()))
+  return sorted(found, reverse=True)[:n]
+
+
+def run(repeat=5, max_seconds=1., importtime=False):
+  ok = True
+  results = {}
+  print("%-28s %12s %12s %12s  %s" % ("target", "import", "start", "process",
+                                      "cctbx imported"))
+  for target in targets:
+    runs = [run_child(target)[0] for i in range(repeat)]
+    summary = {"heavy": runs[0]["heavy"]}
+    for key in ["import", "start", "process"]:
+      values = [r[key] for r in runs if r[key] is not None]
+      summary[key] = float(np.median(values)) if values else None
+    results[target] = summary
+    print("%-28s %9.1f ms %12s %9.1f ms  %s" % (
+      target, summary["import"] * 1e3,
+      "%9.1f ms" % (summary["start"] * 1e3) if summary["start"] else "",
+      summary["process"] * 1e3, ", ".join(summary["heavy"]) or "no"))
+    if summary["heavy"]:
+      print("  FAILED, imports", ", ".join(summary["heavy"]))
+      ok = False
+    if summary["process"] > max_seconds:
+      print("  FAILED, slower than %.2f s" % max_seconds)
+      ok = False
+    if importtime:
+      for microseconds, module in slowest_imports(run_child(target, True)[1]):
+        print("    %9.1f ms %s" % (microseconds / 1e3, module))
+  return ok, {"meta": metadata(), "results": results}
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+  parser.add_argument("--repeat", type=int, default=5)
+  parser.add_argument("--max-seconds", type=float, default=1.)
+  parser.add_argument("--importtime", action="store_true",
+                      help="list the slowest imports of each target")
+  parser.add_argument("--json", help="write the results to this file")
+  args = parser.parse_args()
+  ok, report = run(repeat=args.repeat, max_seconds=args.max_seconds,
+                   importtime=args.importtime)
+  if args.json:
+    with open(args.json, "w") as fh:
+      json.dump(report, fh, indent=1)
+  sys.exit(0 if ok else 1)
@@ -0,0 +1,51 @@
+"""
+Micro-benchmark of ObjectAPI.payload access as the payload body grows.
+
+"first" is the first access after the working payload changed (template
+copy and merge), "cached" is every following access.
+
+Usage:
+  python bench_payload.py [--repeat N]
+"""
+from __future__ import print_function
+
+import argparse
+import timeit
+
+from phenix.api.api_objects import ModelAPI, SceneAPI
+
+body_sizes = [2**10, 2**16, 2**20, 2**24, 2**26]
+
+
+def time_access(api_object, repeat):
+  def first():
+    api_object._working_changed() # invalidates the cached payload
+    return api_object.payload
+
+  def cached():
+    return api_object.payload
+
+  t_first = min(timeit.repeat(first, number=1, repeat=repeat))
+  t_cached = min(timeit.repeat(cached, number=1, repeat=repeat))
+  return t_first, t_cached
+
+
+def run(repeat=20):
+  print("%12s %14s %14s %14s" % ("body bytes", "first (us)", "cached (us)",
+                                 "scene (us)"))
+  for size in body_sizes:
+    payload_init = {"source": {"filestring": {"string": "A" * size}}}
+    model_api = ModelAPI(payload_init=payload_init)
+    t_first, t_cached = time_access(model_api, repeat)
+    t_scene = min(timeit.repeat(
+      lambda: SceneAPI.from_api_objects(model_api, model_api, model_api),
+      number=1, repeat=repeat))
+    print("%12d %14.1f %14.1f %14.1f" % (size, t_first * 1e6, t_cached * 1e6,
+                                         t_scene * 1e6))
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+  parser.add_argument("--repeat", type=int, default=20)
+  args = parser.parse_args()
+  run(repeat=args.repeat)
@@ -0,0 +1,171 @@
+"""
+Snapshot and restore of PhenixServer state (PhenixServer.save_snapshot and
+restore_snapshot).
+
+A server is filled with many small models, a few large maps, coordinates
+updates of larger models (as refinement sends them), and a scene using them.
+The snapshot is saved, saved again (nothing new to write), and restored into
+a new PhenixServer. Restoring only reads the manifest, the first
+retrieve_data of a payload reads its body (or its coordinates arrays). The
+check fails (exit status 1) if the restored ids, payloads or current scene
+differ from the saved ones, or if coordinates arrays are in the manifest.
+
+Usage:
+  python bench_snapshot.py [--models N] [--atoms N] [--maps 128,256]
+                           [--updates N] [--update-atoms N]
+                           [--repeat N] [--json out.json]
+"""
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import synthetic
+from bench_suite import measure, metadata
+
+
+def filled_server(models, atoms, maps, updates=0, update_atoms=5000):
+  from phenix.api.phenix_server import PhenixServer
+  from phenix.api.api_objects import CoordinatesAPI
+  server = PhenixServer()
+  for i in range(models):
+    server.add_data(synthetic.model_payload(atoms, seed=i,
+                                            data_id="model_%d" % i))
+  for i in range(updates):
+    model_id = "refined_%d" % i
+    server.add_data(synthetic.model_payload(update_atoms, seed=i,
+                                            data_id=model_id))
+    xyz = synthetic.model_xyz(update_atoms, seed=i) + 0.1
+    server.update_coordinates(CoordinatesAPI(payload_init={
+      "model_id": model_id, "fields": ("xyz", "b", "occ"),
+      "source": {"xyz": xyz, "b": np.full(update_atoms, 30.),
+                 "occ": np.ones(update_atoms)}}).payload)
+  for n in maps:
+    server.add_data(synthetic.map_payload(n, data_id="map_%d" % n))
+  server.add_scene({"id": "snapshot_scene",
+                    "data": [{"id": "model_0", "object": "model"}] +
+                            [{"id": "map_%d" % n, "object": "map"}
+                             for n in maps]})
+  return server
+
+
+def plain(value):
+  # tuples come back as lists, as they do through any Pyro serializer
+  if isinstance(value, dict):
+    return dict((k, plain(v)) for k, v in value.items())
+  if isinstance(value, (list, tuple)):
+    return [plain(v) for v in value]
+  return value
+
+
+def compare(server, restored):
+  """
+  Error messages for the differences between server and restored.
+  """
+  errors = []
+  if sorted(server.data) != sorted(restored.data):
+    errors.append("restored ids differ")
+    return errors
+  for id in server.data:
+    if plain(server.retrieve_data(id)) != plain(restored.retrieve_data(id)):
+      errors.append("payload %s differs" % id)
+  if restored.current_scene != server.current_scene:
+    errors.append("current scene differs")
+  if restored.scene_version <= server.scene_version:
+    errors.append("scene_version not above the saved one")
+  return errors
+
+
+def run(models=2000, atoms=50, maps=(128, 256), updates=20, update_atoms=5000,
+        repeat=3):
+  from phenix.api.phenix_server import PhenixServer
+  path = tempfile.mkdtemp(prefix="phenix_snapshot_")
+  results = {"models": models, "atoms": atoms, "maps": list(maps),
+             "updates": updates, "update_atoms": update_atoms}
+  server = filled_server(models, atoms, maps, updates=updates,
+                         update_atoms=update_atoms)
+  try:
+    t = time.perf_counter()
+    summary = server.save_snapshot(path)
+    results["save"] = time.perf_counter() - t
+    results["bodies_written"] = summary["bodies_written"]
+    results["nbytes"] = sum(os.path.getsize(os.path.join(root, name))
+                            for root, dirs, names in os.walk(path)
+                            for name in names)
+    results["manifest_nbytes"] = os.path.getsize(
+      os.path.join(path, "manifest.json"))
+    resave = server.save_snapshot(path)
+    results["resave"] = measure(lambda: server.save_snapshot(path), repeat)
+    results["resave_bodies_written"] = resave["bodies_written"]
+
+    def restore():
+      restored = PhenixServer()
+      restored.restore_snapshot(path)
+      return restored
+    results["restore"] = measure(lambda: restore().close(), repeat)
+    restored = restore()
+    first = {}
+    coordinates = [id for id in server.data
+                   if server.data.header(id).get("object") == "coordinates"]
+    for id in ["model_0"] + ["map_%d" % n for n in maps] + coordinates[:1]:
+      t = time.perf_counter()
+      restored.retrieve_data(id)
+      first[id] = time.perf_counter() - t
+    results["first_retrieve"] = first
+    errors = compare(server, restored)
+    # coordinates arrays are body files, 12 bytes per atom for xyz alone
+    if updates and results["manifest_nbytes"] > 12 * update_atoms * updates:
+      errors.append("coordinates arrays are in the manifest")
+    if resave["bodies_written"]:
+      errors.append("saving again wrote %d bodies" % resave["bodies_written"])
+    restored.close()
+  finally:
+    server.close()
+    shutil.rmtree(path, ignore_errors=True)
+
+  print("%d models of %d atoms, maps %s, %d coordinates of %d atoms" % (
+    models, atoms, ", ".join("%d^3" % n for n in maps), updates, update_atoms))
+  print("  save            %9.1f ms, %d bodies, %.1f MB" % (
+    results["save"] * 1e3, results["bodies_written"], results["nbytes"] / 1e6))
+  print("  manifest        %9.2f MB" % (results["manifest_nbytes"] / 1e6))
+  print("  save again      %9.1f ms, %d bodies" % (
+    results["resave"]["min"] * 1e3, results["resave_bodies_written"]))
+  print("  restore         %9.1f ms" % (results["restore"]["min"] * 1e3))
+  for id, seconds in first.items():
+    print("  first retrieve  %9.2f ms  %s" % (seconds * 1e3, id))
+  for error in errors:
+    print("ERROR:", error)
+  print("FAILED" if errors else "ok")
+  return not errors, {"meta": metadata(), "results": results}
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+  parser.add_argument("--models", type=int, default=2000)
+  parser.add_argument("--atoms", type=int, default=50,
+                      help="atoms per model")
+  parser.add_argument("--maps", default="128,256",
+                      help="map sizes (n for n^3 float32 maps)")
+  parser.add_argument("--updates", type=int, default=20,
+                      help="models with a coordinates update")
+  parser.add_argument("--update-atoms", type=int, default=5000,
+                      help="atoms per updated model")
+  parser.add_argument("--repeat", type=int, default=3)
+  parser.add_argument("--json", help="write the results to this file")
+  args = parser.parse_args()
+  ok, report = run(models=args.models, atoms=args.atoms,
+                   maps=[int(n) for n in args.maps.split(",")],
+                   updates=args.updates, update_atoms=args.update_atoms,
+                   repeat=args.repeat)
+  if args.json:
+    with open(args.json, "w") as fh:
+      json.dump(report, fh, indent=1)
+  sys.exit(0 if ok else 1)
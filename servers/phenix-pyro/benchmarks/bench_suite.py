@@ -0,0 +1,325 @@
+"""
+Benchmark suite: api object construction, serializer cost, Pyro round trips
+and scaling with model/map size.
+
+All data is synthetic (see synthetic.py) and everything runs on this
+machine: the round trips go through a PyroManager daemon on localhost.
+Times are the minimum and median of --repeat runs, so results from
+different commits can be compared with --compare.
+
+Usage:
+  python bench_suite.py [--groups construction,serializers,roundtrip,scaling]
+                        [--quick] [--repeat N] [--json out.json]
+                        [--compare old.json]
+"""
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import pickle
+import marshal
+import platform
+import argparse
+import subprocess
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import synthetic
+
+groups = ["construction", "serializers", "roundtrip", "scaling"]
+
+model_sizes = [1000, 10000, 100000]
+map_sizes = [32, 64, 128, 256]
+quick_model_sizes = [1000, 10000]
+quick_map_sizes = [32, 64]
+
+
+def measure(function, repeat):
+  times = []
+  for i in range(repeat):
+    t = time.perf_counter()
+    function()
+    times.append(time.perf_counter() - t)
+  return {"min": min(times), "median": float(np.median(times)),
+          "repeat": repeat}
+
+
+class Results(object):
+
+  def __init__(self):
+    self.rows = []
+
+  def add(self, group, name, size=None, nbytes=None, timing=None, error=None):
+    row = {"group": group, "name": name, "size": size, "bytes": nbytes}
+    if timing is not None:
+      row.update(timing)
+    if error is not None:
+      row["error"] = error
+    self.rows.append(row)
+    if error is not None:
+      print("  %-44s %10s  %s" % (name, size if size is not None else "",
+                                  error))
+    else:
+      print("  %-44s %10s %12.3f ms %12.3f ms %12s" % (
+        name, size if size is not None else "", row["min"] * 1e3,
+        row["median"] * 1e3, nbytes if nbytes is not None else ""))
+
+
+# construction
+
+def bench_construction(results, repeat, quick):
+  from phenix.api.api_objects import ModelAPI, MapAPI, SceneAPI
+  n_atoms = quick_model_sizes[-1] if quick else model_sizes[1]
+  n = quick_map_sizes[-1] if quick else map_sizes[2]
+  model_payload = synthetic.model_payload(n_atoms)
+  map_payload = synthetic.map_payload(n)
+  results.add("construction", "ModelAPI(payload_init)", n_atoms,
+              timing=measure(lambda: ModelAPI(payload_init=dict(
+                model_payload, source=dict(model_payload["source"]))),
+                repeat))
+  results.add("construction", "MapAPI(payload_init) binary", n,
+              timing=measure(lambda: MapAPI(payload_init=dict(
+                map_payload, source=dict(map_payload["source"]))), repeat))
+  apis = [ModelAPI(payload_init={"id": "m%d" % i}) for i in range(10)]
+  results.add("construction", "SceneAPI.from_api_objects x10", 10,
+              timing=measure(lambda: SceneAPI.from_api_objects(*apis), repeat))
+  try:
+    model = synthetic.model_manager(n_atoms)
+    map_manager = synthetic.map_manager(n)
+  except ImportError as e:
+    results.add("construction", "ModelAPI/MapAPI(cctbx objects)",
+                error="skipped, %s" % e)
+    return
+  for suffix in [".pdb", ".cif", ".columns"]:
+    results.add("construction", "ModelAPI(model) %s" % suffix, n_atoms,
+                timing=measure(lambda: ModelAPI(model, payload_init={
+                  "source": {"filestring": {"suffix": suffix}}}), repeat))
+  results.add("construction", "ModelAPI(model, lazy=True)", n_atoms,
+              timing=measure(lambda: ModelAPI(model, lazy=True), repeat))
+  for encoding in MapAPI.known_encodings:
+    results.add("construction", "MapAPI(map_manager) %s" % encoding, n,
+                timing=measure(lambda: MapAPI(map_manager, payload_init={
+                  "source": {"encoding": encoding}}), repeat))
+
+
+# serializers
+
+def serializers():
+  """
+  name -> (dumps, loads), Pyro's own serializer classes when available.
+  pickle is only a Pyro4 serializer, it is measured with the stdlib.
+  """
+  found = {}
+  try:
+    import Pyro5.serializers
+    for name, serializer in Pyro5.serializers.serializers.items():
+      found[name] = (serializer.dumps, serializer.loads)
+  except ImportError:
+    pass
+  if "json" not in found:
+    found["json"] = (lambda d: json.dumps(d).encode("utf-8"),
+                     lambda b: json.loads(b.decode("utf-8")))
+  if "marshal" not in found:
+    found["marshal"] = (marshal.dumps, marshal.loads)
+  found["pickle"] = (lambda d: pickle.dumps(d, protocol=2), pickle.loads)
+  for name in ["serpent", "msgpack"]:
+    if name not in found:
+      try:
+        module = __import__(name)
+        found[name] = ((module.dumps, module.loads) if name == "serpent" else
+                       (module.packb, module.unpackb))
+      except ImportError:
+        pass
+  return found
+
+
+def real_payloads(quick):
+  from phenix.api.api_objects import SceneAPI
+  n_atoms = quick_model_sizes[-1] if quick else model_sizes[1]
+  n = quick_map_sizes[-1] if quick else map_sizes[1]
+  model = synthetic.model_payload(n_atoms)
+  map_binary = synthetic.map_payload(n)
+  map_list = synthetic.map_payload(n, encoding="list")
+  scene = SceneAPI.from_api_payloads(model, map_binary).payload
+  return [("scene", scene), ("model %d atoms" % n_atoms, model),
+          ("map %d^3 binary" % n, map_binary), ("map %d^3 list" % n, map_list)]
+
+
+def bench_serializers(results, repeat, quick):
+  for payload_name, payload in real_payloads(quick):
+    for name, (dumps, loads) in sorted(serializers().items()):
+      label = "%s %s" % (name, payload_name)
+      try:
+        data = dumps(payload)
+      except Exception as e:
+        results.add("serializers", label + " dumps",
+                    error="%s: %s" % (type(e).__name__, str(e)[:40]))
+        continue
+      results.add("serializers", label + " dumps", nbytes=len(data),
+                  timing=measure(lambda: dumps(payload), repeat))
+      results.add("serializers", label + " loads", nbytes=len(data),
+                  timing=measure(lambda: loads(data), repeat))
+
+
+# round trips through a local daemon
+
+def start_server():
+  from phenix.api.pyro_manager import PyroManager
+  from phenix.api.phenix_server import PhenixServer
+  manager = PyroManager()
+  server = PhenixServer()
+  uri = manager.register_service(server, prefix="phenix.bench.%d" % os.getpid())
+  return manager, server, uri
+
+
+def proxy_for(uri, serializer):
+  import Pyro5.api
+  proxy = Pyro5.api.Proxy(uri)
+  proxy._pyroSerializer = serializer
+  return proxy
+
+
+def bench_roundtrip(results, repeat, quick):
+  from phenix.api.api_objects import SceneAPI
+  manager, server, uri = start_server()
+  n_atoms = quick_model_sizes[-1] if quick else model_sizes[1]
+  n = quick_map_sizes[-1] if quick else map_sizes[1]
+  model = synthetic.model_payload(n_atoms, data_id="model")
+  map_payload = synthetic.map_payload(n, data_id="map")
+  server.add_data(model)
+  server.add_data(map_payload)
+  server.add_scene(SceneAPI.from_api_payloads(model, map_payload).payload)
+  version = server.scene_version
+  try:
+    for serializer in ["msgpack", "serpent", "marshal"]:
+      proxy = proxy_for(uri, serializer)
+      proxy._pyroBind()
+      calls = [
+        ("has_data", lambda: proxy.has_data("model")),
+        ("retrieve_data_header model", lambda: proxy.retrieve_data_header(
+          "model")),
+        ("scene_changes_since", lambda: proxy.scene_changes_since(version)),
+        ("retrieve_data model", lambda: proxy.retrieve_data("model")),
+        ("retrieve_data map", lambda: proxy.retrieve_data("map")),
+        ("retrieve_data map codecs", lambda: proxy.retrieve_data(
+          "map", codecs=["zlib", "lz4"])),
+        ("retrieve_data_many x2", lambda: proxy.retrieve_data_many(
+          ["model", "map"])),
+      ]
+      for name, call in calls:
+        label = "%s %s" % (serializer, name)
+        try:
+          call()
+        except Exception as e:
+          results.add("roundtrip", label,
+                      error="%s: %s" % (type(e).__name__, str(e)[:40]))
+          continue
+        results.add("roundtrip", label, timing=measure(call, repeat))
+      proxy._pyroRelease()
+  finally:
+    server.close()
+    manager.__del__()
+
+
+# scaling
+
+def bench_scaling(results, repeat, quick):
+  from phenix.api.api_objects import ModelAPI, MapAPI
+  from phenix.api.payload_store import PayloadStore
+  dumps, loads = serializers()["msgpack"]
+  for n_atoms in (quick_model_sizes if quick else model_sizes):
+    payload = synthetic.model_payload(n_atoms)
+    results.add("scaling", "ModelAPI(payload_init)", n_atoms,
+                timing=measure(lambda: ModelAPI(payload_init=dict(
+                  payload, source=dict(payload["source"]))), repeat))
+    results.add("scaling", "PayloadStore add + read model", n_atoms,
+                timing=measure(lambda: store_round_trip(PayloadStore(),
+                                                        payload), repeat))
+    data = dumps(payload)
+    results.add("scaling", "msgpack dumps+loads model", n_atoms,
+                nbytes=len(data),
+                timing=measure(lambda: loads(dumps(payload)), repeat))
+  for n in (quick_map_sizes if quick else map_sizes):
+    payload = synthetic.map_payload(n)
+    results.add("scaling", "MapAPI(payload_init) binary", n,
+                timing=measure(lambda: MapAPI(payload_init=dict(
+                  payload, source=dict(payload["source"]))), repeat))
+    results.add("scaling", "PayloadStore add + read map", n,
+                timing=measure(lambda: store_round_trip(PayloadStore(),
+                                                        payload), repeat))
+    data = dumps(payload)
+    results.add("scaling", "msgpack dumps+loads map", n, nbytes=len(data),
+                timing=measure(lambda: loads(dumps(payload)), repeat))
+
+
+def store_round_trip(store, payload):
+  store[payload["id"]] = payload
+  return store[payload["id"]]
+
+
+# reports
+
+def metadata():
+  here = os.path.dirname(os.path.abspath(__file__))
+  try:
+    commit = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=here,
+                                     stderr=subprocess.STDOUT).decode().strip()
+  except Exception:
+    commit = None
+  return {"commit": commit, "python": platform.python_version(),
+          "platform": platform.platform(), "numpy": np.__version__,
+          "time": time.strftime("%Y-%m-%d %H:%M:%S")}
+
+
+def compare(rows, old_path):
+  with open(old_path) as fh:
+    old = json.load(fh)
+  old_rows = dict(((r["group"], r["name"], r["size"]), r)
+                  for r in old["results"] if "min" in r)
+  print("\nCompared to %s (commit %s):" % (old_path, old["meta"]["commit"]))
+  for row in rows:
+    key = (row["group"], row["name"], row["size"])
+    if "min" in row and key in old_rows:
+      ratio = row["min"] / max(old_rows[key]["min"], 1e-12)
+      print("  %-12s %-44s %10s %8.2fx" % (row["group"], row["name"],
+                                           row["size"] or "", ratio))
+
+
+benchmarks = {"construction": bench_construction,
+              "serializers": bench_serializers,
+              "roundtrip": bench_roundtrip,
+              "scaling": bench_scaling}
+
+
+def run(selected=groups, repeat=5, quick=False):
+  results = Results()
+  print("  %-44s %10s %15s %15s %12s" % ("benchmark", "size", "min",
+                                         "median", "bytes"))
+  for group in selected:
+    print(group)
+    benchmarks[group](results, repeat, quick)
+  return {"meta": metadata(), "results": results.rows}
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+  parser.add_argument("--groups", default=",".join(groups))
+  parser.add_argument("--quick", action="store_true",
+                      help="smaller sizes only")
+  parser.add_argument("--repeat", type=int, default=5)
+  parser.add_argument("--json", help="write the results to this file")
+  parser.add_argument("--compare", help="results of an earlier run")
+  args = parser.parse_args()
+  selected = [g for g in args.groups.split(",") if g]
+  for group in selected:
+    if group not in benchmarks:
+      parser.error("unknown group: %s" % group)
+  report = run(selected, repeat=args.repeat, quick=args.quick)
+  if args.json:
+    with open(args.json, "w") as fh:
+      json.dump(report, fh, indent=1)
+  if args.compare:
+    compare(report["results"], args.compare)
@@ -0,0 +1,126 @@
+"""
+Round-trip latency and throughput of PhenixServer calls over TCP (loopback)
+and over a Unix domain socket (PyroManager(local=True)).
+
+The servers run in a separate process, so client and server do not share
+the interpreter lock. Each transport gets its own PhenixServer holding the
+same synthetic maps.
+
+Usage:
+  python bench_transport.py [--repeat N] [--calls N] [--sizes 64,128,256]
+                            [--json out.json]
+"""
+from __future__ import print_function
+
+import os
+import sys
+import json
+import socket
+import argparse
+import tempfile
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import synthetic
+from bench_suite import measure, metadata
+
+
+def serve(connection, sizes):
+  # the server process: one PhenixServer per transport
+  from phenix.api.pyro_manager import PyroManager
+  from phenix.api.phenix_server import PhenixServer
+  managers, uris = [], {}
+  for transport, kwargs in [("tcp", {}), ("unix", {"local": True})]:
+    manager = PyroManager(**kwargs)
+    server = PhenixServer()
+    for n in sizes:
+      server.add_data(synthetic.map_payload(n, data_id="map_%d" % n))
+    uris[transport] = str(manager.register_service(
+      server, prefix="phenix.bench.%s.%d" % (transport, os.getpid())))
+    managers.append((manager, server))
+  connection.send(uris)
+  connection.recv() # until the client is done
+  for manager, server in managers:
+    server.close()
+    manager.__del__()
+
+
+def bench(uri, sizes, repeat, calls):
+  import Pyro5.api
+  proxy = Pyro5.api.Proxy(uri)
+  proxy._pyroSerializer = "msgpack" # as set by PyroManager
+  result = {"uri": uri}
+  result["bind"] = measure(lambda: (proxy._pyroRelease(), proxy._pyroBind()),
+                           repeat)
+
+  def small_calls():
+    for i in range(calls):
+      proxy.has_data("map_%d" % sizes[0])
+  timing = measure(small_calls, repeat)
+  result["has_data"] = dict((k, v / calls if k != "repeat" else v)
+                            for k, v in timing.items())
+
+  result["retrieve_data"] = {}
+  for n in sizes:
+    data_id = "map_%d" % n
+    nbytes = 4 * n ** 3
+    timing = measure(lambda: proxy.retrieve_data(data_id), repeat)
+    timing["bytes"] = nbytes
+    timing["mb_per_s"] = nbytes / timing["min"] / 1e6
+    result["retrieve_data"][n] = timing
+  proxy._pyroRelease()
+  return result
+
+
+def run(sizes, repeat=5, calls=200):
+  if not hasattr(socket, "AF_UNIX"):
+    print("Unix domain sockets are not available on this platform")
+    return None
+  # keep the rendezvous file of a running Phenix out of this
+  os.environ["PHENIX_PYRO_RENDEZVOUS"] = os.path.join(
+    tempfile.gettempdir(), "phenix_pyro_bench_%d.json" % os.getpid())
+  context = multiprocessing.get_context("spawn")
+  parent, child = context.Pipe()
+  process = context.Process(target=serve, args=(child, sizes))
+  process.start()
+  try:
+    uris = parent.recv()
+    results = {}
+    for transport in ["tcp", "unix"]:
+      results[transport] = bench(uris[transport], sizes, repeat, calls)
+  finally:
+    parent.send("done")
+    process.join(30)
+
+  print("%-26s %14s %14s %8s" % ("", "tcp", "unix", "unix/tcp"))
+  def row(label, tcp, unix, unit, scale):
+    print("%-26s %11.3f %s %11.3f %s %7.2fx" % (label, tcp * scale, unit,
+                                                  unix * scale, unit,
+                                                  unix / tcp))
+  row("bind", results["tcp"]["bind"]["min"], results["unix"]["bind"]["min"],
+      "ms", 1e3)
+  row("has_data", results["tcp"]["has_data"]["min"],
+      results["unix"]["has_data"]["min"], "us", 1e6)
+  for n in sizes:
+    tcp = results["tcp"]["retrieve_data"][n]
+    unix = results["unix"]["retrieve_data"][n]
+    label = "retrieve_data %.0f MB" % (tcp["bytes"] / 1e6)
+    row(label, tcp["min"], unix["min"], "ms", 1e3)
+    row("  throughput", tcp["mb_per_s"], unix["mb_per_s"], "MB/s", 1.)
+  return {"meta": metadata(), "results": results}
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+  parser.add_argument("--repeat", type=int, default=5)
+  parser.add_argument("--calls", type=int, default=200,
+                      help="small calls per repeat")
+  parser.add_argument("--sizes", default="64,128,256",
+                      help="map sizes (n for n^3 float32 maps)")
+  parser.add_argument("--json", help="write the results to this file")
+  args = parser.parse_args()
+  sizes = [int(n) for n in args.sizes.split(",")]
+  report = run(sizes, repeat=args.repeat, calls=args.calls)
+  if report is not None and args.json:
+    with open(args.json, "w") as fh:
+      json.dump(report, fh, indent=1)
@@ -0,0 +1,166 @@
+"""
+Round trip check of the columnar model encoding (model_columns) against a
+PDB file, and timing of the encoding against PDB text parsing.
+
+The atom table read from the file must come back from the columns with the
+same labels, and the same numbers when written in the PDB formats
+(%8.3f coordinates, %6.2f occupancies and B-factors). The same is checked
+for a ".columns" payload added to a PhenixServer, whose atoms must be found
+by nearest_to_xyz and atoms_within, and, when cctbx is available, for the
+columns made by ModelAPI from a model manager (columns_rep).
+
+Usage:
+  python roundtrip_columns.py [pdb file] [--copies N]
+"""
+from __future__ import print_function
+
+import os
+import sys
+import argparse
+import timeit
+
+import numpy as np
+
+from phenix.api.atom_table import (atom_table_from_pdb_string,
+                                   atom_table_from_payload, string_columns)
+from phenix.api.model_columns import columns_from_table, table_from_columns
+
+default_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            "..", "tests", "1aba_pieces.pdb")
+
+number_formats = {"xyz": "%8.3f", "occ": "%6.2f", "b": "%6.2f"}
+
+
+def compare_tables(table, other):
+  """
+  The names of the columns that differ.
+  """
+  differ = []
+  for key in string_columns + ["hetero"]:
+    if not np.array_equal(table[key], other[key]):
+      differ.append(key)
+  for key, fmt in number_formats.items():
+    formatted = np.char.mod(fmt, table[key])
+    if not np.array_equal(formatted, np.char.mod(fmt, other[key])):
+      differ.append(key)
+  return differ
+
+
+def check_server(table, columns):
+  """
+  Error messages for a ".columns" payload added to a PhenixServer.
+  """
+  from phenix.api.phenix_server import PhenixServer
+  payload = {"id": "columns", "object": "model", "name": "columns",
+             "source": {"filestring": {"string": None, "suffix": ".columns"},
+                        "columns": columns}}
+  errors = []
+  payload_table = atom_table_from_payload(payload)
+  if payload_table is None:
+    errors.append("no atom table for the payload")
+  elif compare_tables(table, payload_table):
+    errors.append("atom table of the payload differs: " +
+                  ", ".join(compare_tables(table, payload_table)))
+  server = PhenixServer()
+  try:
+    server.add_data(payload)
+    xyz = tuple(table["xyz"][0])
+    nearest = server.nearest_to_xyz(xyz, expand="atom", ids=["columns"])
+    if nearest is None or nearest["distance"] > 1e-3:
+      errors.append("nearest_to_xyz does not find the first atom")
+    if server.atoms_within("columns", xyz, 1.) is None:
+      errors.append("atoms_within finds no atom table")
+  finally:
+    server.close()
+  return errors
+
+
+def check_cctbx(string):
+  """
+  Error messages for the columns made by ModelAPI from a model manager, None
+  if cctbx is not available.
+  """
+  try:
+    import iotbx.pdb
+    import mmtbx.model
+  except ImportError:
+    return None
+  from phenix.api.api_objects import ModelAPI
+  from phenix.api.atom_table import atom_table_from_model
+  model = mmtbx.model.manager(
+    model_input=iotbx.pdb.input(source_info=None, lines=string))
+  api = ModelAPI(model, payload_init={
+    "source": {"filestring": {"suffix": ".columns"}}})
+  columns = api.payload["source"]["columns"]
+  differ = compare_tables(atom_table_from_model(model),
+                          table_from_columns(columns))
+  if differ:
+    return ["columns_rep differs from the model: " + ", ".join(differ)]
+  return []
+
+
+def tiled_pdb_string(string, copies):
+  # the atoms of the file repeated in chains A, B, ... to make a large model
+  lines = [l for l in string.splitlines() if l.startswith(("ATOM", "HETATM"))]
+  chain_ids = "ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
+  tiled = []
+  for copy in range(copies):
+    chain_id = chain_ids[copy % len(chain_ids)]
+    tiled += [l[:21] + chain_id + l[22:] for l in lines]
+  return "\n".join(tiled) + "\n"
+
+
+def run(path, copies=1000, repeat=3):
+  with open(path) as fh:
+    string = fh.read()
+  table = atom_table_from_pdb_string(string)
+  columns = columns_from_table(table)
+  differ = compare_tables(table, table_from_columns(columns))
+  print("%s: %d atoms, %d bytes of text, %d bytes of columns" % (
+    os.path.basename(path), len(table["xyz"]), len(string),
+    len(columns["bytes"])))
+  if differ:
+    print("FAILED, columns differ:", ", ".join(differ))
+    return False
+  print("round trip ok")
+  errors = check_server(table, columns)
+  cctbx_errors = check_cctbx(string)
+  if cctbx_errors is None:
+    print("cctbx not available, columns_rep not checked")
+  else:
+    errors += cctbx_errors
+  if errors:
+    for error in errors:
+      print("FAILED,", error)
+    return False
+  print("server and columns_rep ok" if cctbx_errors is not None else
+        "server ok")
+
+  big = tiled_pdb_string(string, copies)
+  big_table = atom_table_from_pdb_string(big)
+  big_columns = columns_from_table(big_table)
+  if compare_tables(big_table, table_from_columns(big_columns)):
+    print("FAILED on the tiled model")
+    return False
+  t_parse = min(timeit.repeat(lambda: atom_table_from_pdb_string(big),
+                              number=1, repeat=repeat))
+  t_encode = min(timeit.repeat(lambda: columns_from_table(big_table),
+                               number=1, repeat=repeat))
+  t_decode = min(timeit.repeat(lambda: table_from_columns(big_columns),
+                               number=1, repeat=repeat))
+  print("%d copies, %d atoms: %.1f MB text, %.1f MB columns" % (
+    copies, len(big_table["xyz"]), len(big) / 1e6,
+    len(big_columns["bytes"]) / 1e6))
+  print("  parse text     %8.1f ms" % (t_parse * 1e3))
+  print("  encode columns %8.1f ms" % (t_encode * 1e3))
+  print("  decode columns %8.1f ms" % (t_decode * 1e3))
+  return True
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+  parser.add_argument("path", nargs="?", default=default_file)
+  parser.add_argument("--copies", type=int, default=1000)
+  parser.add_argument("--repeat", type=int, default=3)
+  args = parser.parse_args()
+  sys.exit(0 if run(args.path, copies=args.copies, repeat=args.repeat) else 1)
@@ -0,0 +1,106 @@
+"""
+Check that the binned levels of a map (PhenixServer.retrieve_data_level)
+line up with the full map, and time building them.
+
+The map holds a linear ramp of its Cartesian coordinates, on a grid whose
+origin and shape are not multiples of the levels. The average of a ramp over
+a bin is its value at the bin center, so every binned voxel away from the
+padded edges must hold the ramp value at its center, placed as a client
+places it: origin * pixel_sizes + lod["offset"] + index * pixel_sizes. The
+check fails (exit status 1) on the first level that is off.
+
+Usage:
+  python roundtrip_levels.py [--n N] [--repeat N]
+"""
+from __future__ import print_function
+
+import sys
+import argparse
+import timeit
+
+import numpy as np
+
+from phenix.api.map_index import MapIndex, array_from_payload
+
+slope = np.array([0.3, -0.7, 1.1])
+
+
+def ramp_payload(shape, origin, pixel_sizes, data_id="ramp"):
+  grid = np.indices(shape, dtype=np.float64)
+  xyz = [(grid[a] + origin[a]) * pixel_sizes[a] for a in range(3)]
+  array = sum(s * x for s, x in zip(slope, xyz)).astype(np.float32)
+  return {"id": data_id, "object": "map", "name": data_id,
+          "source": {"encoding": "binary",
+                     "binary": {"bytes": array.tobytes(), "dtype": "<f4",
+                                "shape": tuple(shape),
+                                "origin": tuple(origin),
+                                "pixel_sizes": tuple(pixel_sizes)}}}
+
+
+def check_levels(server, data_id, tolerance=1e-3):
+  """
+  Error messages for the levels of map data_id that are off.
+  """
+  errors = []
+  full = array_from_payload(server.retrieve_data(data_id))
+  fine_origin = full[1]
+  for level in MapIndex.levels:
+    payload = server.retrieve_data_level(data_id, level)
+    array, origin, pixel_sizes = array_from_payload(payload)
+    offset = payload["source"]["lod"]["offset"]
+    grid = np.indices(array.shape, dtype=np.float64)
+    centers = [(grid[a] + origin[a]) * pixel_sizes[a] + offset[a]
+               for a in range(3)]
+    expected = sum(s * x for s, x in zip(slope, centers))
+    # bins that hold padding (at the edges of the map) are not averages of
+    # the ramp over the whole bin
+    inside = np.ones(array.shape, dtype=bool)
+    for a in range(3):
+      first = (grid[a] + origin[a]) * level
+      inside &= (first >= fine_origin[a]) & (
+        first + level <= fine_origin[a] + full[0].shape[a])
+    if not inside.any():
+      continue
+    error = np.abs(array - expected)[inside].max()
+    if error > tolerance * np.abs(expected).max():
+      errors.append("level %d of %s is off by %.3f (origin %s)" % (
+        level, data_id, error, fine_origin))
+  return errors
+
+
+def run(n=256, repeat=3):
+  from phenix.api.phenix_server import PhenixServer
+  server = PhenixServer()
+  errors = []
+  try:
+    for origin in [(0, 0, 0), (3, -5, 7), (-13, 6, 1)]:
+      data_id = "ramp_%d_%d_%d" % origin
+      server.add_data(ramp_payload((37, 41, 29), origin, (0.8, 1.1, 1.3),
+                                   data_id=data_id))
+      errors += check_levels(server, data_id)
+  finally:
+    server.close()
+  if errors:
+    for error in errors:
+      print("FAILED,", error)
+    return False
+  print("levels line up with the full map")
+
+  payload = ramp_payload((n, n, n), (5, 5, 5), (1., 1., 1.))
+  def build():
+    map_index = MapIndex.from_payload(payload)
+    for level in MapIndex.levels:
+      map_index.level(level)
+  t = min(timeit.repeat(build, number=1, repeat=repeat))
+  print("%d^3 map: levels %s built in %.1f ms" % (
+    n, ", ".join(str(l) for l in MapIndex.levels), t * 1e3))
+  return True
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+  parser.add_argument("--n", type=int, default=256,
+                      help="map size for the timing (n^3 float32)")
+  parser.add_argument("--repeat", type=int, default=3)
+  args = parser.parse_args()
+  sys.exit(0 if run(n=args.n, repeat=args.repeat) else 1)
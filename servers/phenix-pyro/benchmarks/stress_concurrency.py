@@ -0,0 +1,285 @@
+"""
+Stress check of one PhenixServer used by several clients at once, over a
+local Pyro daemon.
+
+Phase 1, consistency: reader threads retrieve models, maps, headers and
+scene changes while writer threads replace the data (each version of a
+payload carries its version in the name and in the body), add scenes and
+add one large map now and then. Every payload read must be one whole
+version, scene versions must never go back, and reads should not wait for
+the large map being added.
+
+Phase 2, lost updates: threads add partial coordinate updates and change
+the focus of the current scene at the same time. The updates of each model
+are merged into one scene entry, which must hold the atoms of every update.
+
+Usage:
+  python stress_concurrency.py [--readers N] [--seconds S] [--big 256]
+                               [--updates N]
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+import random
+import argparse
+import threading
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import synthetic
+from bench_suite import start_server, proxy_for
+
+model_ids = ["model_%d" % i for i in range(4)]
+
+
+def model_version(data_id, version, n_atoms=500):
+  payload = synthetic.model_payload(n_atoms, data_id=data_id)
+  payload["name"] = "v%d" % version
+  filestring = payload["source"]["filestring"]
+  filestring["string"] = "REMARK v%d\n" % version + filestring["string"]
+  return payload
+
+
+def map_version(data_id, version, n=32):
+  values = np.full((n, n, n), float(version), dtype="<f4")
+  payload = synthetic.map_payload(n, data_id=data_id)
+  payload["name"] = "v%d" % version
+  payload["source"]["binary"]["bytes"] = values.tobytes()
+  return payload
+
+
+def check_payload(payload):
+  """
+  An error message if the body is not of the version in the name.
+  """
+  if payload is None:
+    return "missing payload"
+  version = int(payload["name"][1:])
+  if payload["object"] == "model":
+    string = payload["source"]["filestring"]["string"]
+    if not string.startswith("REMARK v%d\n" % version):
+      return "model %s body is not v%d" % (payload["id"], version)
+  else:
+    values = np.frombuffer(payload["source"]["binary"]["bytes"], dtype="<f4")
+    if values[0] != version or values[-1] != version:
+      return "map %s body is not v%d" % (payload["id"], version)
+  return None
+
+
+class Worker(threading.Thread):
+
+  def __init__(self, uri, stop, name):
+    threading.Thread.__init__(self, name=name)
+    self.daemon = True
+    self.uri = uri
+    self.stop = stop
+    self.errors = []
+    self.latencies = [] # (start time, seconds) of reads
+    self.count = 0
+
+  def run(self):
+    proxy = proxy_for(self.uri, "msgpack")
+    try:
+      while not self.stop.is_set():
+        self.step(proxy)
+        self.count += 1
+    except Exception as e:
+      self.errors.append("%s: %s" % (type(e).__name__, e))
+    finally:
+      proxy._pyroRelease()
+
+  def timed(self, call, *args, **kwargs):
+    t = time.perf_counter()
+    result = call(*args, **kwargs)
+    self.latencies.append((t, time.perf_counter() - t))
+    return result
+
+
+class Reader(Worker):
+  version = -1
+
+  def step(self, proxy):
+    data_id = random.choice(model_ids + ["map"])
+    error = check_payload(self.timed(proxy.retrieve_data, data_id))
+    if error:
+      self.errors.append(error)
+    header = self.timed(proxy.retrieve_data_header, data_id)
+    if header is None or "content_hash" not in header:
+      self.errors.append("header of %s without content_hash" % data_id)
+    changes = self.timed(proxy.scene_changes_since, self.version)
+    if changes["version"] < self.version:
+      self.errors.append("scene version went back from %d to %d" % (
+        self.version, changes["version"]))
+    self.version = changes["version"]
+
+
+class DataWriter(Worker):
+  n = 0
+
+  def step(self, proxy):
+    self.n += 1
+    proxy.add_data(model_version(random.choice(model_ids), self.n))
+    proxy.add_data(map_version("map", self.n))
+    if self.n % 5 == 0:
+      scene = {"id": "scene_%d" % (self.n % 3),
+               "data": [{"id": i, "object": "model"} for i in model_ids] +
+                       [{"id": "map", "object": "map"}]}
+      proxy.add_scene(scene)
+
+
+class BigWriter(Worker):
+
+  def __init__(self, uri, stop, name, n):
+    Worker.__init__(self, uri, stop, name)
+    self.payload = synthetic.map_payload(n, data_id="big")
+    self.adds = [] # (start time, seconds) of the adds
+
+  def step(self, proxy):
+    t = time.perf_counter()
+    proxy.add_data(self.payload)
+    self.adds.append((t, time.perf_counter() - t))
+    self.stop.wait(0.2)
+
+
+class CoordinateWriter(Worker):
+
+  def __init__(self, uri, stop, name, model_id, updates):
+    Worker.__init__(self, uri, stop, name)
+    self.model_id = model_id
+    self.updates = updates
+
+  def step(self, proxy):
+    if self.count >= self.updates:
+      self.stop.wait(0.01)
+      return
+    i = self.count
+    ok = proxy.update_coordinates({
+      "id": "%s_%s_%d" % (self.name, self.model_id, i),
+      "object": "coordinates", "name": "coordinates",
+      "model_id": self.model_id, "fields": ["xyz"],
+      "source": {"n_atoms": 1, "b": None, "occ": None,
+                 "xyz": np.zeros(3, dtype="<f4").tobytes(),
+                 "indices": np.array([i], dtype="<i4").tobytes()}})
+    if not ok:
+      self.errors.append("update_coordinates of %s failed" % self.model_id)
+
+
+class FocusWriter(Worker):
+
+  def step(self, proxy):
+    # an xyz focus is resolved to the nearest atom, which takes a while
+    xyz = [random.uniform(-10., 10.) for i in range(3)]
+    proxy.update_focus({"id": None, "xyz": xyz, "selection": None})
+
+
+def run_workers(workers, seconds):
+  for worker in workers:
+    worker.start()
+  time.sleep(seconds)
+  workers[0].stop.set()
+  for worker in workers:
+    worker.join(60)
+  return [e for w in workers for e in w.errors]
+
+
+def phase_consistency(server, uri, readers, seconds, big):
+  for i, data_id in enumerate(model_ids):
+    server.add_data(model_version(data_id, 0))
+  server.add_data(map_version("map", 0))
+  stop = threading.Event()
+  reader_threads = [Reader(uri, stop, "reader_%d" % i) for i in range(readers)]
+  writers = [DataWriter(uri, stop, "data_writer_%d" % i) for i in range(2)]
+  big_writer = BigWriter(uri, stop, "big_writer", big)
+  errors = run_workers(reader_threads + writers + [big_writer], seconds)
+
+  reads = [l for r in reader_threads for l in r.latencies]
+  during_big = [s for t, s in reads
+                if any(a <= t and t + s <= a + d for a, d in big_writer.adds)]
+  all_reads = [s for t, s in reads]
+  print("phase 1: %d reads, %d data writes, %d large adds (%d MB)" % (
+    len(all_reads), sum(w.count for w in writers), len(big_writer.adds),
+    4 * big ** 3 // 2 ** 20))
+  print("  read latency    median %.2f ms, max %.2f ms" % (
+    np.median(all_reads) * 1e3, max(all_reads) * 1e3))
+  if big_writer.adds:
+    print("  large add       median %.1f ms" % (
+      np.median([d for a, d in big_writer.adds]) * 1e3))
+  if during_big:
+    print("  reads during large adds: %d, median %.2f ms, max %.2f ms" % (
+      len(during_big), np.median(during_big) * 1e3, max(during_big) * 1e3))
+  return errors
+
+
+def phase_lost_updates(server, uri, updates):
+  scene = {"id": "stress_scene",
+           "data": [{"id": i, "object": "model"} for i in model_ids]}
+  server.add_scene(scene)
+  version = server.scene_version
+  stop = threading.Event()
+  writers = [CoordinateWriter(uri, stop, "coordinates_%d" % i, model_id,
+                              updates)
+             for i, model_id in enumerate(model_ids)]
+  focus_writers = [FocusWriter(uri, stop, "focus_%d" % i) for i in range(2)]
+  for worker in writers + focus_writers:
+    worker.start()
+  while any(w.count < updates for w in writers if w.is_alive()):
+    time.sleep(0.05)
+  stop.set()
+  for worker in writers + focus_writers:
+    worker.join(60)
+  errors = [e for w in writers + focus_writers for e in w.errors]
+
+  entries = [d for d in server.current_scene["data"]
+             if d["object"] == "coordinates"]
+  expected = updates * len(writers)
+  n_focus = sum(w.count for w in focus_writers)
+  changes = server.scene_version - version
+  print("phase 2: %d coordinate updates, %d focus changes" % (expected,
+                                                             n_focus))
+  print("  coordinate entries in the scene: %d" % len(entries))
+  if len(entries) != len(model_ids):
+    errors.append("%d coordinate entries in the scene for %d models" % (
+      len(entries), len(model_ids)))
+  updated = 0
+  for entry in entries:
+    source = server.retrieve_data(entry["id"])["source"]
+    indices = set(np.frombuffer(source["indices"], dtype="<i4").tolist())
+    updated += len(indices)
+    if indices != set(range(updates)):
+      errors.append("lost coordinate updates of %s: %d of %d atoms" % (
+        entry["model_id"], len(indices), updates))
+  print("  atoms updated in the merged entries: %d" % updated)
+  if changes != expected + n_focus:
+    errors.append("scene changed %d times for %d updates" % (
+      changes, expected + n_focus))
+  return errors
+
+
+def run(readers=8, seconds=10., big=256, updates=100):
+  manager, server, uri = start_server()
+  try:
+    errors = phase_consistency(server, uri, readers, seconds, big)
+    errors += phase_lost_updates(server, uri, updates)
+  finally:
+    server.close()
+    manager.__del__()
+  for error in sorted(set(errors)):
+    print("ERROR:", error, "(%d times)" % errors.count(error))
+  print("FAILED" if errors else "ok")
+  return not errors
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+  parser.add_argument("--readers", type=int, default=8)
+  parser.add_argument("--seconds", type=float, default=10.)
+  parser.add_argument("--big", type=int, default=256,
+                      help="size n of the large n^3 map")
+  parser.add_argument("--updates", type=int, default=100,
+                      help="coordinate updates per model in phase 2")
+  args = parser.parse_args()
+  sys.exit(0 if run(readers=args.readers, seconds=args.seconds, big=args.big,
+                    updates=args.updates) else 1)
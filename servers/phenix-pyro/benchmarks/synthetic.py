@@ -0,0 +1,98 @@
+"""
+Synthetic models and maps for the benchmarks, made from a fixed seed so
+runs on different commits see the same data.
+
+The payload functions need only numpy. model_manager and map_manager build
+the cctbx objects and need a cctbx installation.
+"""
+import numpy as np
+
+_residue = [(" N  ", "N"), (" CA ", "C"), (" C  ", "C"), (" O  ", "O"),
+            (" CB ", "C"), (" CG ", "C"), (" CD ", "C"), (" NE ", "N")]
+residues_per_chain = 500
+chain_ids = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+
+def model_xyz(n_atoms, seed=0):
+  # a random walk with 1.5 A steps, like a chain trace
+  rng = np.random.default_rng(seed)
+  steps = rng.normal(size=(n_atoms, 3))
+  steps *= 1.5 / np.linalg.norm(steps, axis=1)[:, None]
+  return np.cumsum(steps, axis=0)
+
+
+def pdb_string(n_atoms, seed=0):
+  """
+  A PDB string of n_atoms atoms, in residues of 8 atoms and chains of
+  residues_per_chain residues.
+  """
+  xyz = model_xyz(n_atoms, seed=seed)
+  lines = ["CRYST1  500.000  500.000  500.000  90.00  90.00  90.00 P 1"]
+  for i in range(n_atoms):
+    name, element = _residue[i % len(_residue)]
+    residue = i // len(_residue)
+    chain = chain_ids[(residue // residues_per_chain) % len(chain_ids)]
+    resseq = residue % residues_per_chain + 1
+    lines.append(
+      "ATOM  %5d %4s ARG %1s%4d    %8.3f%8.3f%8.3f  1.00%6.2f          %2s" % (
+        i % 100000, name, chain, resseq, xyz[i, 0], xyz[i, 1], xyz[i, 2],
+        20. + i % 50, element))
+  lines.append("END")
+  return "\n".join(lines) + "\n"
+
+
+def map_array(n, seed=0):
+  """
+  An n x n x n float32 map: smooth density blobs plus noise.
+  """
+  rng = np.random.default_rng(seed)
+  x = np.arange(n, dtype=np.float32)
+  values = 0.05 * rng.standard_normal((n, n, n), dtype=np.float32)
+  for center in rng.uniform(0, n, size=(16, 3)):
+    # gaussians are separable, one 1d profile per axis
+    gx, gy, gz = [np.exp(-(x - c) ** 2 / (2 * (n / 16.) ** 2)) for c in center]
+    values += gx[:, None, None] * gy[None, :, None] * gz[None, None, :]
+  return values
+
+
+def model_payload(n_atoms, seed=0, data_id=None):
+  return {"id": data_id or "model_%d" % n_atoms, "object": "model",
+          "name": "synthetic model",
+          "source": {"filestring": {"string": pdb_string(n_atoms, seed=seed),
+                                    "suffix": ".pdb"}}}
+
+
+def map_payload(n, seed=0, data_id=None, encoding="binary"):
+  array = map_array(n, seed=seed)
+  payload = {"id": data_id or "map_%d" % n, "object": "map",
+             "name": "synthetic map",
+             "source": {"encoding": encoding}}
+  if encoding == "binary":
+    payload["source"]["binary"] = {"bytes": array.tobytes(), "dtype": "<f4",
+                                   "shape": (n, n, n), "origin": (0, 0, 0),
+                                   "pixel_sizes": (1., 1., 1.)}
+  else:
+    payload["source"]["list"] = {"list_rep": array.ravel().tolist(),
+                                 "dtype": "float32", "shape": (n, n, n),
+                                 "pixel_sizes": (1., 1., 1.)}
+  return payload
+
+
+def model_manager(n_atoms, seed=0):
+  import iotbx.pdb
+  import mmtbx.model
+  model_input = iotbx.pdb.input(source_info=None,
+                                lines=pdb_string(n_atoms, seed=seed))
+  return mmtbx.model.manager(model_input=model_input)
+
+
+def map_manager(n, seed=0):
+  from cctbx import crystal
+  from scitbx.array_family import flex
+  from iotbx.map_manager import map_manager as cctbx_map_manager
+  map_data = flex.double(map_array(n, seed=seed).astype(np.float64).ravel())
+  map_data.reshape(flex.grid(n, n, n))
+  symmetry = crystal.symmetry((float(n),) * 3 + (90., 90., 90.), 1)
+  return cctbx_map_manager(map_data=map_data, unit_cell_grid=(n, n, n),
+                           unit_cell_crystal_symmetry=symmetry,
+                           wrapping=False)
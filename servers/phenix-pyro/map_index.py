@@ -0,0 +1,185 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+"""
+Server side access to the values of registered map payloads.
+
+A MapIndex wraps the array of one map payload and cuts it into cubic bricks
+on demand. Region requests are assembled from cached bricks, so repeated
+requests around the same area do not slice the full map again. Only the
+most recently used bricks are kept, up to max_brick_bytes per map. It also
+keeps the level-of-detail pyramid of the map (binned copies), built the first
+time a level is asked for. Bins are aligned on grid indices that are
+multiples of the level, so all levels of all maps on the same grid line up.
+
+Grid boxes are given as (i,j,k) grid indices in the same frame as the
+"origin" of the MapAPI binary block. box_min is inclusive, box_max is
+exclusive, like a Python slice.
+"""
+
+
+def array_from_payload(payload):
+  """
+  Return (array, origin, pixel_sizes) for a map payload that carries its
+  values, or None if the values are not part of the payload.
+  """
+  source = payload["source"]
+  if source.get("encoding", "list") == "binary":
+    binary = source["binary"]
+    if binary["bytes"] is None:
+      return None
+    buf = binary["bytes"]
+    if isinstance(buf, dict):  # bytes as sent by the serpent serializer
+      import serpent
+      buf = serpent.tobytes(buf)
+    array = np.frombuffer(buf, dtype=np.dtype(binary["dtype"]))
+    array = array.reshape(tuple(binary["shape"]))
+    origin = tuple(binary["origin"]) or (0, 0, 0)
+    return array, origin, tuple(binary["pixel_sizes"])
+  l = source["list"]
+  if l["list_rep"] is None:
+    return None
+  array = np.array(l["list_rep"], dtype=l["dtype"]).reshape(tuple(l["shape"]))
+  return array, (0, 0, 0), tuple(l["pixel_sizes"])
+
+
+def binary_payload(payload, array, origin, pixel_sizes, **fields):
+  """
+  A map payload carrying array in the binary encoding. The descriptive
+  fields (id, name, database...) are taken from payload, extra top level
+  fields can be passed as keywords.
+  """
+  array = np.ascontiguousarray(array, dtype=array.dtype.newbyteorder("<"))
+  source = {
+    "read_filepath": None,
+    "read_url": None,
+    "fetch": None,
+    "encoding": "binary",
+    "binary": {
+      "bytes": array.tobytes(),
+      "dtype": array.dtype.str,
+      "shape": tuple(array.shape),
+      "origin": tuple(int(i) for i in origin),
+      "pixel_sizes": tuple(pixel_sizes),
+    },
+    "shift_cart": payload["source"].get("shift_cart", tuple()),
+  }
+  new_payload = dict((k, v) for k, v in payload.items() if k != "source")
+  new_payload["source"] = source
+  new_payload.update(fields)
+  return new_payload
+
+
+def bin_array(array, factor, start=(0, 0, 0)):
+  """
+  Average array over cubes of factor**3 voxels. start is the position of the
+  first voxel in its cube, so cubes can be aligned on grid indices that are
+  multiples of factor. The edges are padded with their own values so no
+  voxels are dropped.
+  """
+  pad = [(s, -(s + n) % factor) for s, n in zip(start, array.shape)]
+  if any(p[0] or p[1] for p in pad):
+    array = np.pad(array, pad, mode="edge")
+  nx, ny, nz = [n // factor for n in array.shape]
+  binned = array.reshape(nx, factor, ny, factor, nz, factor)
+  return binned.mean(axis=(1, 3, 5), dtype=np.float64).astype(array.dtype)
+
+
+class MapIndex(object):
+  brick_size = 32
+  max_brick_bytes = 64 * 1024**2
+  levels = (1, 2, 4, 8)
+
+  def __init__(self, array, origin=(0, 0, 0), pixel_sizes=(1., 1., 1.),
+               brick_size=None, max_brick_bytes=None):
+    self.array = array
+    self.origin = tuple(int(i) for i in origin)
+    self.pixel_sizes = tuple(pixel_sizes)
+    if brick_size is not None:
+      self.brick_size = brick_size
+    if max_brick_bytes is not None:
+      self.max_brick_bytes = max_brick_bytes
+    self.bricks = OrderedDict() # key -> brick, least recently used first
+    self.brick_bytes = 0
+    self._lock = threading.Lock() # for bricks, not held to cut a brick
+    self.pyramid = {1: array}
+
+  @classmethod
+  def from_payload(cls, payload, brick_size=None):
+    result = array_from_payload(payload)
+    if result is None:
+      raise ValueError("Map payload does not carry its values:",
+                       payload["id"])
+    array, origin, pixel_sizes = result
+    return cls(array, origin=origin, pixel_sizes=pixel_sizes,
+               brick_size=brick_size)
+
+  def brick(self, key):
+    """
+    The brick with brick index key (bi,bj,bk), cached after the first cut.
+    """
+    with self._lock:
+      brick = self.bricks.pop(key, None)
+      if brick is not None:
+        self.bricks[key] = brick # most recently used last
+        return brick
+    b = self.brick_size
+    slices = tuple(slice(i * b, (i + 1) * b) for i in key)
+    brick = np.ascontiguousarray(self.array[slices])
+    with self._lock:
+      if key not in self.bricks:
+        self.bricks[key] = brick
+        self.brick_bytes += brick.nbytes
+      while self.brick_bytes > self.max_brick_bytes and len(self.bricks) > 1:
+        self.brick_bytes -= self.bricks.popitem(last=False)[1].nbytes
+    return brick
+
+  def region(self, box_min, box_max):
+    """
+    Return (array, box_min) for the voxels in the box. The box is clipped to
+    the map, the returned box_min is the clipped lower corner.
+    """
+    lo = [max(int(m), o) - o for m, o in zip(box_min, self.origin)]
+    hi = [min(int(m), o + n) - o for m, o, n in
+          zip(box_max, self.origin, self.array.shape)]
+    if any(h <= l for l, h in zip(lo, hi)):
+      raise ValueError("Region does not overlap the map:", box_min, box_max)
+    b = self.brick_size
+    out = np.empty([h - l for l, h in zip(lo, hi)], dtype=self.array.dtype)
+    ranges = [range(l // b, (h - 1) // b + 1) for l, h in zip(lo, hi)]
+    for bi in ranges[0]:
+      for bj in ranges[1]:
+        for bk in ranges[2]:
+          key = (bi, bj, bk)
+          brick = self.brick(key)
+          # overlap of the brick and the request, in map indices
+          start = [max(l, i * b) for l, i in zip(lo, key)]
+          stop = [min(h, i * b + n) for h, i, n in
+                  zip(hi, key, brick.shape)]
+          src = tuple(slice(s - i * b, e - i * b) for s, e, i in
+                      zip(start, stop, key))
+          dst = tuple(slice(s - l, e - l) for s, e, l in zip(start, stop, lo))
+          out[dst] = brick[src]
+    return out, tuple(l + o for l, o in zip(lo, self.origin))
+
+  def level(self, level):
+    """
+    Return (array, origin, pixel_sizes, offset) of the map binned by level.
+    Voxel i of the binned map averages the voxels i*level to i*level+level-1
+    of the map (in grid indices, origin included), so its center is offset
+    (in Cartesian units) past origin * pixel_sizes. Each level is made from
+    the next finer one, and cached.
+    """
+    if level not in self.levels:
+      raise ValueError("Level not supported:", level)
+    if level not in self.pyramid:
+      finer = max(l for l in list(self.pyramid) if l < level)
+      factor = level // finer
+      start = [o // finer % factor for o in self.origin]
+      self.pyramid[level] = bin_array(self.level(finer)[0], factor, start)
+    origin = tuple(o // level for o in self.origin)
+    pixel_sizes = tuple(p * level for p in self.pixel_sizes)
+    offset = tuple(0.5 * (level - 1) * p for p in self.pixel_sizes)
+    return self.pyramid[level], origin, pixel_sizes, offset
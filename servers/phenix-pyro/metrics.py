@@ -0,0 +1,169 @@
+import time
+import threading
+from bisect import bisect_left
+from functools import wraps
+
+"""
+Counters for the calls served by PhenixServer, cheap enough to leave on.
+
+Each call of a timed method costs two clock reads, one lock and a walk over
+the dicts of its arguments and result to estimate their size (bodies are
+measured by length, lists by their first element), no serialization. The
+time is the time spent in the method, so a slow update on the client that
+does not show up here was spent in serialization, the network or the
+client.
+
+Latencies are counted in fixed buckets, latency_bounds are their upper
+bounds in seconds (the last bucket has no bound).
+"""
+
+latency_bounds = [1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2,
+                  0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30.]
+
+clock = getattr(time, "perf_counter", time.time) # no perf_counter on Python 2
+
+
+def approx_nbytes(value):
+  """
+  Estimate of the size of a value once serialized.
+  """
+  if isinstance(value, (bytes, bytearray, str)):
+    return len(value)
+  if value is None or isinstance(value, (bool, int, float)):
+    return 8
+  if isinstance(value, dict):
+    return sum(len(str(k)) + approx_nbytes(v) for k, v in value.items())
+  if isinstance(value, (list, tuple)):
+    if len(value) == 0:
+      return 2
+    first = value[0]
+    if isinstance(first, (bool, int, float)):
+      return 8 * len(value) # list_rep of maps, coordinates
+    if len(value) > 64: # long lists of payloads, sampled
+      return len(value) * approx_nbytes(first)
+    return sum(approx_nbytes(v) for v in value)
+  nbytes = getattr(value, "nbytes", None) # numpy arrays
+  if nbytes is not None:
+    return nbytes
+  return 64 # api objects and other objects of in-process calls
+
+
+class MethodStats(object):
+
+  def __init__(self):
+    self.calls = 0
+    self.errors = 0
+    self.seconds = 0.
+    self.max_seconds = 0.
+    self.histogram = [0] * (len(latency_bounds) + 1)
+    self.bytes_in = 0
+    self.bytes_out = 0
+
+  def add(self, seconds, bytes_in, bytes_out, error):
+    self.calls += 1
+    self.errors += error
+    self.seconds += seconds
+    if seconds > self.max_seconds:
+      self.max_seconds = seconds
+    self.histogram[bisect_left(latency_bounds, seconds)] += 1
+    self.bytes_in += bytes_in
+    self.bytes_out += bytes_out
+
+  def percentile(self, fraction):
+    # the upper bound of the bucket holding the fraction-th call
+    count = 0
+    for i, n in enumerate(self.histogram):
+      count += n
+      if count >= fraction * self.calls and n > 0:
+        if i < len(latency_bounds):
+          return latency_bounds[i]
+        return self.max_seconds
+    return None
+
+  def as_dict(self):
+    return {"calls": self.calls,
+            "errors": self.errors,
+            "seconds": self.seconds,
+            "mean_seconds": self.seconds / self.calls if self.calls else None,
+            "max_seconds": self.max_seconds,
+            "p50_seconds": self.percentile(0.5),
+            "p95_seconds": self.percentile(0.95),
+            "histogram": list(self.histogram),
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out}
+
+
+class Metrics(object):
+  """
+  Per method call statistics and cache hit counts.
+  """
+
+  def __init__(self):
+    self.started = time.time()
+    self.methods = {} # method name -> MethodStats
+    self.caches = {} # cache name -> [hits, misses]
+    self._lock = threading.Lock()
+    self._local = threading.local() # depth of nested timed calls
+
+  def record(self, name, seconds, bytes_in=0, bytes_out=0, error=False):
+    with self._lock:
+      if name not in self.methods:
+        self.methods[name] = MethodStats()
+      self.methods[name].add(seconds, bytes_in, bytes_out, error)
+
+  def cache(self, name, hit):
+    with self._lock:
+      counts = self.caches.setdefault(name, [0, 0])
+      counts[0 if hit else 1] += 1
+
+  def snapshot(self, reset=False):
+    with self._lock:
+      methods = dict((name, stats.as_dict())
+                     for name, stats in self.methods.items())
+      caches = dict((name, cache_dict(hits, misses))
+                    for name, (hits, misses) in self.caches.items())
+      since = self.started
+      if reset:
+        self.started = time.time()
+        self.methods = {}
+        self.caches = {}
+    return {"since": since, "latency_bounds": list(latency_bounds),
+            "methods": methods, "caches": caches}
+
+
+def cache_dict(hits, misses):
+  total = hits + misses
+  return {"hits": hits, "misses": misses,
+          "hit_rate": float(hits) / total if total else None}
+
+
+def timed(method):
+  """
+  Decorator for methods of objects with a Metrics in self._metrics. Calls
+  made from inside another timed method are not counted again.
+  """
+  name = method.__name__
+
+  @wraps(method)
+  def wrapper(self, *args, **kwargs):
+    metrics = self._metrics
+    local = metrics._local
+    depth = getattr(local, "depth", 0)
+    if depth > 0:
+      return method(self, *args, **kwargs)
+    local.depth = 1
+    error = True
+    t = clock()
+    try:
+      result = method(self, *args, **kwargs)
+      error = False
+      return result
+    finally:
+      seconds = clock() - t
+      local.depth = 0
+      bytes_in = approx_nbytes(args)
+      if kwargs:
+        bytes_in += approx_nbytes(kwargs)
+      bytes_out = 0 if error else approx_nbytes(result)
+      metrics.record(name, seconds, bytes_in, bytes_out, error)
+  return wrapper
@@ -0,0 +1,122 @@
+import numpy as np
+
+from phenix.api.atom_table import run_starts
+
+"""
+The columnar model encoding of ModelAPI (filestring suffix ".columns").
+
+The atom table of the model (see atom_table) is stored as packed arrays in
+one buffer, source["columns"]["bytes"]. Labels shared by the atoms of a
+residue or a chain are stored once per residue or chain, with offset arrays
+marking where each residue and chain starts. source["columns"]["arrays"]
+lists (name, dtype, shape, offset) of each array in the buffer:
+
+  atoms:    xyz (n,3) "<i4" in 1/1000 A, b "<f4", occ "<f4", name,
+            altloc, element, charge, hetero "|u1"
+  residues: residue_starts "<i4" (first atom), resname, resseq, icode
+  chains:   chain_starts "<i4" (first residue), chain, model
+
+Labels are ASCII byte strings ("S<width>", "S4" for atom names), as wide as
+the longest label of the column.
+
+Coordinates are kept to 0.001 A and B-factors and occupancies as float32,
+more than the precision of PDB files: a table made from a PDB string comes
+back with the same values when written with the PDB formats.
+"""
+
+# (name, dtype) of the arrays, "S" for labels
+atom_arrays = [("xyz", "<i4"), ("b", "<f4"), ("occ", "<f4"), ("name", "S"),
+               ("altloc", "S"), ("element", "S"), ("charge", "S"),
+               ("hetero", "|u1")]
+residue_arrays = [("residue_starts", "<i4"), ("resname", "S"),
+                  ("resseq", "S"), ("icode", "S")]
+chain_arrays = [("chain_starts", "<i4"), ("chain", "S"), ("model", "S")]
+
+
+def columns_from_table(table, crystal_symmetry=None):
+  """
+  The source["columns"] block of a ModelAPI payload for an atom table.
+  crystal_symmetry: None, or {"unit_cell": (a, b, c, alpha, beta, gamma),
+    "space_group": "P 21 21 21"}
+  """
+  # residue runs also break on resname, so no label is lost
+  residue_starts = run_starts(table["model"], table["chain"],
+                              table["resseq"], table["icode"],
+                              table["resname"])
+  chain_starts_atoms = run_starts(table["model"], table["chain"])
+  chain_starts = np.searchsorted(residue_starts, chain_starts_atoms)
+  arrays = {
+    "xyz": np.round(table["xyz"] * 1000.),
+    "b": table["b"],
+    "occ": table["occ"],
+    "hetero": table["hetero"],
+    "residue_starts": residue_starts,
+    "chain_starts": chain_starts,
+  }
+  for key in ["name", "altloc", "element", "charge"]:
+    arrays[key] = table[key]
+  for key in ["resname", "resseq", "icode"]:
+    arrays[key] = table[key][residue_starts]
+  for key in ["chain", "model"]:
+    arrays[key] = table[key][chain_starts_atoms]
+
+  layout = []
+  buffers = []
+  offset = 0
+  for name, dtype in atom_arrays + residue_arrays + chain_arrays:
+    if dtype == "S":
+      # unicode to ASCII bytes of the same width, raises for other text
+      column = np.asarray(arrays[name], dtype=np.str_)
+      dtype = "S%d" % max(column.dtype.itemsize // 4, 1)
+      array = column.astype(dtype)
+    else:
+      array = np.ascontiguousarray(arrays[name], dtype=dtype)
+    buf = array.tobytes()
+    layout.append((name, dtype, tuple(array.shape), offset))
+    buffers.append(buf)
+    offset += len(buf)
+  return {"bytes": b"".join(buffers), "arrays": tuple(layout),
+          "crystal_symmetry": crystal_symmetry}
+
+
+def unpack_columns(columns):
+  """
+  The arrays of a columns block by name, as read-only views of its buffer.
+  """
+  buf = columns["bytes"]
+  arrays = {}
+  for name, dtype, shape, offset in columns["arrays"]:
+    dtype = np.dtype(dtype)
+    count = int(np.prod(shape)) if len(shape) > 0 else 1
+    array = np.frombuffer(buf, dtype=dtype, count=count, offset=offset)
+    arrays[name] = array.reshape(tuple(shape))
+  return arrays
+
+
+def table_from_columns(columns):
+  """
+  The atom table (see atom_table) of a columns block.
+  """
+  arrays = unpack_columns(columns)
+  n_atoms = len(arrays["b"])
+  residue_starts = arrays["residue_starts"].astype(np.int64)
+  chain_starts = arrays["chain_starts"].astype(np.int64)
+  # atoms per residue and per chain
+  residue_sizes = np.diff(np.append(residue_starts, n_atoms))
+  chain_atoms = np.add.reduceat(residue_sizes, chain_starts) \
+    if len(chain_starts) > 0 else np.zeros(0, dtype=np.int64)
+
+  table = {"xyz": arrays["xyz"].astype(np.float64) / 1000.,
+           "b": arrays["b"].astype(np.float64),
+           "occ": arrays["occ"].astype(np.float64),
+           "hetero": arrays["hetero"].astype(bool)}
+  for key in ["name", "altloc", "element", "charge"]:
+    table[key] = arrays[key]
+  for key in ["resname", "resseq", "icode"]:
+    table[key] = np.repeat(arrays[key], residue_sizes)
+  for key in ["chain", "model"]:
+    table[key] = np.repeat(arrays[key], chain_atoms)
+  for key, column in list(table.items()):
+    if column.dtype.kind == "S":
+      table[key] = column.astype(np.str_)
+  return table
@@ -0,0 +1,141 @@
+import sys
+import zlib
+import threading
+from collections import OrderedDict
+
+try:
+  import lz4.frame as lz4_frame
+except ImportError:
+  lz4_frame = None
+
+if sys.version_info.major == 2:
+  text_type = unicode
+else:
+  text_type = str
+
+from phenix.api.payload_store import body_path, get_body, set_body, \
+  normalize_body, sendable
+
+"""
+Compression of payload bodies, chosen per payload instead of Pyro's global
+COMPRESSION (which also compresses every small control message).
+
+Bodies smaller than min_nbytes are sent as they are. Larger ones are
+compressed with a fast codec for clients on the same machine and a stronger
+one for remote clients, out of the codecs the client says it can decode.
+The compressed body replaces the body in the payload, and the codec is
+recorded in source["codec"]:
+
+  {"name": "zlib",     # one of known_codecs
+   "level": 1,
+   "path": ["source", "binary", "bytes"],  # where the body is
+   "nbytes": 1048576,  # size of the body before compression
+   "text": False}      # True if the body is a str (utf-8 encoded)
+"""
+
+known_codecs = ["zlib", "lz4"]
+min_nbytes = 64 * 1024
+
+# (name, level) to try in order, for local and for remote clients
+local_codecs = [("lz4", 0), ("zlib", 1)]
+remote_codecs = [("zlib", 6)]
+
+
+def available_codecs():
+  if lz4_frame is None:
+    return ["zlib"]
+  return ["zlib", "lz4"]
+
+
+def choose_codec(nbytes, codecs, local):
+  """
+  (name, level) of the codec for a body of nbytes, or None to not compress.
+  codecs: the codecs the client can decode
+  """
+  if not codecs or nbytes < min_nbytes:
+    return None
+  for name, level in (local_codecs if local else remote_codecs):
+    if name in codecs and name in available_codecs():
+      return name, level
+  return None
+
+
+def compress(data, name, level):
+  if name == "zlib":
+    return zlib.compress(data, level)
+  elif name == "lz4":
+    return lz4_frame.compress(data)
+  raise ValueError("Codec not supported:", name)
+
+
+def decompress(data, name):
+  if name == "zlib":
+    return zlib.decompress(data)
+  elif name == "lz4":
+    return lz4_frame.decompress(data)
+  raise ValueError("Codec not supported:", name)
+
+
+class PayloadCodecs(object):
+  """
+  Compresses payload bodies, keeping the most recently used compressed
+  bodies, up to max_cached_bytes in total, so repeated requests for the same
+  data are not compressed again.
+  """
+
+  def __init__(self, max_cached_bytes=256 * 1024**2):
+    self.max_cached_bytes = max_cached_bytes
+    self.cache = OrderedDict()  # (content hash, name, level) -> body
+    self.cached_bytes = 0
+    self.hits = 0
+    self.misses = 0
+    self._lock = threading.Lock() # for the cache, not held to compress
+
+  def cache_sizes(self):
+    with self._lock:
+      return {"entries": len(self.cache), "nbytes": self.cached_bytes}
+
+  def encode(self, payload, codecs, local):
+    """
+    The payload with its body compressed for a client that decodes codecs,
+    or the payload itself (see sendable) if compressing does not pay.
+    """
+    path = body_path(payload)
+    if path is None:
+      return payload
+    body = normalize_body(get_body(payload))
+    text = isinstance(body, text_type) # str is bytes on Python 2
+    if text:
+      body = body.encode("utf-8")
+    elif hasattr(body, "nbytes"): # memory-mapped, restored from a snapshot
+      body = memoryview(body)
+    elif not isinstance(body, bytes):
+      return payload # list bodies and missing bodies
+    codec = choose_codec(len(body), codecs, local)
+    if codec is None:
+      return sendable(payload)
+    name, level = codec
+    key = (payload.get("content_hash"), name, level)
+    with self._lock:
+      compressed = self.cache.get(key) if key[0] is not None else None
+      if compressed is not None:
+        self.cache[key] = self.cache.pop(key) # most recently used last
+        self.hits += 1
+      else:
+        self.misses += 1
+    if compressed is None:
+      compressed = compress(body, name, level)
+      if key[0] is not None and len(compressed) <= self.max_cached_bytes:
+        with self._lock:
+          if key not in self.cache:
+            self.cache[key] = compressed
+            self.cached_bytes += len(compressed)
+          while self.cached_bytes > self.max_cached_bytes:
+            self.cached_bytes -= len(self.cache.popitem(last=False)[1])
+    if len(compressed) >= len(body):
+      return sendable(payload)
+    new_payload = set_body(payload, compressed) # copies payload["source"]
+    new_payload["source"]["codec"] = {"name": name, "level": level,
+                                      "path": list(path),
+                                      "nbytes": len(body), "text": text}
+    return new_payload
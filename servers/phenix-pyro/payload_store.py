@@ -0,0 +1,321 @@
+import sys
+import hashlib
+import threading
+
+import numpy as np
+
+if sys.version_info.major == 2:
+  from collections import MutableMapping
+else:
+  from collections.abc import MutableMapping
+
+"""
+A content-addressed store for data payloads.
+
+The body of a payload (the model file string or the map values) is hashed
+and stored once, no matter how many ids refer to it. Everything else in the
+payload (the header) is stored per id. Reading an id gives back the full
+payload, with the hash of its body in payload["content_hash"], so clients
+can skip downloading bodies they already hold.
+
+Api objects (see api_objects, usually made with lazy=True) can be stored as
+well. They are materialized and hashed the first time their id is read, and
+their source object (cctbx model or map) stays available in objects.
+
+Payloads restored from a snapshot (see snapshot) keep their body, and the
+large bytes values of their header (coordinates arrays), on disk until their
+id is first read.
+"""
+
+
+def body_path(payload):
+  """
+  The keys leading to the body of a payload, or None if the payload type has
+  no body.
+  """
+  if payload.get("object") == "model":
+    if payload["source"]["filestring"]["suffix"] == ".columns":
+      return ("source", "columns", "bytes")
+    return ("source", "filestring", "string")
+  elif payload.get("object") == "map":
+    if payload["source"].get("encoding", "list") == "binary":
+      return ("source", "binary", "bytes")
+    return ("source", "list", "list_rep")
+  return None
+
+
+def get_body(payload):
+  path = body_path(payload)
+  if path is None:
+    return None
+  value = payload
+  for key in path:
+    value = value[key]
+  return value
+
+
+def set_body(payload, body):
+  """
+  Return a copy of payload with the body replaced. Only the dictionaries on
+  the path to the body are copied.
+  """
+  path = body_path(payload)
+  new_payload = dict(payload)
+  d = new_payload
+  for key in path[:-1]:
+    d[key] = dict(d[key])
+    d = d[key]
+  d[path[-1]] = body
+  return new_payload
+
+
+def normalize_body(body):
+  if isinstance(body, dict) and body.get("encoding") == "base64":
+    import serpent  # bytes as sent by the serpent serializer
+    body = serpent.tobytes(body)
+  return body
+
+
+def sendable(payload):
+  """
+  The payload with a body restored from a snapshot (a memory-mapped array)
+  copied to bytes, which the Pyro serializers can send.
+  """
+  body = get_body(payload)
+  if not hasattr(body, "nbytes"):
+    return payload
+  return set_body(payload, memoryview(body).tobytes())
+
+
+def body_nbytes(body):
+  if body is None:
+    return 0
+  if hasattr(body, "nbytes"): # bodies not read from a snapshot yet
+    return body.nbytes
+  if isinstance(body, (list, tuple)):
+    return 8 * len(body)
+  return len(body)
+
+
+def has_mapped(value):
+  # whether a header restored from a snapshot holds values still on disk
+  if hasattr(value, "load"):
+    return True
+  if isinstance(value, dict):
+    return any(has_mapped(v) for v in value.values())
+  if isinstance(value, (list, tuple)):
+    return any(has_mapped(v) for v in value)
+  return False
+
+
+def load_mapped(value):
+  """
+  A copy of value with the values still on disk (snapshot.MappedBody) read
+  as bytes.
+  """
+  if hasattr(value, "load"):
+    return memoryview(value.load()).tobytes()
+  if isinstance(value, dict):
+    return dict((k, load_mapped(v)) for k, v in value.items())
+  if isinstance(value, (list, tuple)):
+    return [load_mapped(v) for v in value]
+  return value
+
+
+def content_hash(body):
+  body = normalize_body(body)
+  if isinstance(body, (list, tuple)):
+    body = np.asarray(body, dtype=np.float64).tobytes()
+  elif not isinstance(body, bytes) and hasattr(body, "encode"):
+    body = body.encode("utf-8")
+  return hashlib.sha1(body).hexdigest() # bytes or a memory-mapped array
+
+
+class PayloadStore(MutableMapping):
+  """
+  A dict of id -> payload that stores each distinct body once.
+
+  Safe to use from several threads. The lock is only held to update or look
+  up the dicts: bodies are hashed and lazy api objects are materialized
+  without it, so reads never wait for a large payload being added.
+  """
+
+  def __init__(self):
+    self.headers = {}  # id -> payload with the body removed
+    self.bodies = {}  # content hash -> body
+    self.refcounts = {}  # content hash -> number of ids using the body
+    self.lazy = {}  # id -> api object, not materialized yet
+    self.objects = {}  # id -> source object (cctbx) of api objects
+    self.mapped = set()  # ids whose header has values on disk (snapshot)
+    self._lock = threading.RLock()
+    self._materialize_locks = {}  # id -> lock held while id is encoded
+
+  def add_api_object(self, api_object):
+    id = api_object.payload["id"]
+    with self._lock:
+      self._remove(id)
+      self.lazy[id] = api_object
+
+  def _materialize(self, id):
+    if id not in self.lazy:
+      return
+    # each id is encoded once, other ids are encoded at the same time
+    with self._lock:
+      lock = self._materialize_locks.setdefault(id, threading.Lock())
+    with lock:
+      try:
+        api_object = self.lazy.get(id)
+        if api_object is None: # materialized while waiting for the lock
+          return
+        prepared = self._prepare(api_object.materialize())
+        with self._lock:
+          if self.lazy.get(id) is not api_object: # replaced meanwhile
+            return
+          del self.lazy[id]
+          self._add(id, *prepared)
+          if api_object.obj is not None:
+            self.objects[id] = api_object.obj
+      finally:
+        with self._lock:
+          if self._materialize_locks.get(id) is lock:
+            del self._materialize_locks[id]
+
+  def _load_header(self, id, header):
+    # read the values of header still on disk, without holding the lock
+    loaded = load_mapped(header)
+    with self._lock:
+      if self.headers.get(id) is header:
+        self.headers[id] = loaded
+        self.mapped.discard(id)
+
+  def __getitem__(self, id):
+    self._materialize(id)
+    while True:
+      with self._lock:
+        header = self.headers[id]
+        if id not in self.mapped:
+          content_hash = header.get("content_hash")
+          if content_hash is None:
+            return header
+          body = self.bodies[content_hash]
+          break
+      self._load_header(id, header)
+    if hasattr(body, "load"): # restored from a snapshot, read on first use
+      mapped, body = body, body.load()
+      with self._lock:
+        if self.bodies.get(content_hash) is mapped:
+          self.bodies[content_hash] = body
+    return set_body(header, body)
+
+  @staticmethod
+  def _prepare(payload):
+    # (header, content hash, body), the expensive part of adding a payload
+    body = normalize_body(get_body(payload))
+    if body is None:
+      return payload, None, None
+    h = content_hash(body)
+    header = set_body(payload, None)
+    header["content_hash"] = h
+    return header, h, body
+
+  def _add(self, id, header, h, body):
+    self._remove(id)
+    if h is not None:
+      if h not in self.bodies:
+        self.bodies[h] = body
+        self.refcounts[h] = 0
+      self.refcounts[h] += 1
+    self.headers[id] = header
+
+  def _remove(self, id):
+    self.objects.pop(id, None)
+    self.mapped.discard(id)
+    if id in self.lazy:
+      del self.lazy[id]
+      return
+    header = self.headers.pop(id, None)
+    h = None if header is None else header.get("content_hash")
+    if h is not None:
+      self.refcounts[h] -= 1
+      if self.refcounts[h] == 0:
+        del self.refcounts[h]
+        del self.bodies[h]
+
+  def restore(self, id, header, body):
+    """
+    Add a payload from a snapshot. header has the "content_hash" of body,
+    body (and values in header) can be a snapshot.MappedBody that is read
+    when first used.
+    """
+    with self._lock:
+      self._add(id, header, header.get("content_hash"), body)
+      if has_mapped(header):
+        self.mapped.add(id)
+
+  def snapshot_items(self):
+    """
+    (id, header, body) of every payload, as they are at the time of the
+    call. Lazy api objects are materialized first.
+    """
+    for id in list(self.lazy.keys()):
+      self._materialize(id)
+    with self._lock:
+      return [(id, header, self.bodies.get(header.get("content_hash")))
+              for id, header in self.headers.items()]
+
+  def __setitem__(self, id, payload):
+    prepared = self._prepare(payload)
+    with self._lock:
+      self._add(id, *prepared)
+
+  def __delitem__(self, id):
+    with self._lock:
+      if id not in self:
+        raise KeyError(id)
+      self._remove(id)
+
+  def __iter__(self):
+    with self._lock:
+      ids = list(self.headers.keys()) + list(self.lazy.keys())
+    for id in ids:
+      yield id
+
+  def __len__(self):
+    return len(self.headers) + len(self.lazy)
+
+  def __contains__(self, id):
+    return id in self.headers or id in self.lazy
+
+  def header(self, id):
+    """
+    The payload without its body, including the "content_hash".
+    """
+    self._materialize(id)
+    while True:
+      with self._lock:
+        header = self.headers[id]
+        if id not in self.mapped:
+          return header
+      self._load_header(id, header)
+
+  def source_object(self, id):
+    """
+    The cctbx object the payload was made from, if it was added as an api
+    object in this process, else None.
+    """
+    with self._lock:
+      if id in self.lazy:
+        return self.lazy[id].obj
+      return self.objects.get(id)
+
+  def content_hash(self, id):
+    return self.header(id).get("content_hash")
+
+  def nbytes(self):
+    """
+    The total size of the distinct bodies in the store (lazy api objects not
+    counted until materialized).
+    """
+    with self._lock:
+      bodies = list(self.bodies.values())
+    return sum(body_nbytes(body) for body in bodies)
@@ -1,7 +1,22 @@
 import sys
 import time
+import itertools
+import threading
+from collections import deque
 
-from phenix.api.api_objects import SceneAPI
+import numpy as np
+
+from phenix.api.api_objects import ObjectAPI, SceneAPI, CoordinatesAPI
+from phenix.api.map_index import MapIndex, binary_payload
+from phenix.api.shm_transport import SharedMemoryStore
+from phenix.api.payload_store import PayloadStore, normalize_body, sendable
+from phenix.api.spatial_index import SpatialIndex, index_ranges
+from phenix.api.atom_table import (atom_table_from_model,
+                                   atom_table_from_payload)
+from phenix.api.task_engine import TaskEngine
+from phenix.api.payload_codecs import PayloadCodecs
+from phenix.api.metrics import Metrics, approx_nbytes, cache_dict, timed
+from phenix.api.snapshot import write_snapshot, read_snapshot
 
 if sys.version_info.major == 2:
   import Pyro4
@@ -19,34 +34,489 @@ class PhenixServer:
 
   Each time chimerax is launched, a new instance of this class is made, and
   ChimeraX connects to it.
+
+  Pyro serves each client connection in its own thread, so several viewers
+  can use one server at once. Reads never wait for a slow write: payloads
+  are hashed, and indices built, without holding a lock, and scenes are
+  replaced, never modified. Derived indices remember the generation of the
+  data they were made from, and are only kept if that is still current.
   """
   def __init__(self ,*args, **kwargs):
     self.id = str(time.time()).replace(".","")
     # program attributes
-    self.tasks = {}
-    self.results = {}
-    self._current_task = None
+    self._task_engine = TaskEngine() # runs programs in worker processes
+    self.tasks = self._task_engine.tasks # id -> task record
+    self.results = self._task_engine.results # id -> result of done tasks
 
     # data attributes
-    self.data = {}
+    self.data = PayloadStore() # id -> payload, each distinct body kept once
+    self._map_indices = {} # brick indices of map payloads, made on request
+    self._shared_memory = SharedMemoryStore() # segments for local clients
+    self._spatial_indices = {} # cell lists of model payloads, made on request
+    self._codecs = PayloadCodecs() # compresses bodies for retrieve_data
+    self._generations = {} # id -> generation, changed on every add/remove
+    self._next_generation = itertools.count()
+    self._data_lock = threading.Lock() # generations and index caches
+    self._index_lock = threading.Lock() # spatial index moves and queries
+    self._coordinates = {} # model id -> ids of its coordinates, oldest first
+    self._indexing = set() # ids whose spatial index is built in background
 
     # scene attributes
     self.scenes = {}
     self._current_scene = None
+    self._scene_version = 0 # incremented on every change of current_scene
+    self._scene_changed = threading.Condition()
+    self._scene_history = deque(maxlen=64) # (version, scene) for deltas
+
+    self._metrics = Metrics() # call latencies and sizes, see get_metrics
 
   # program properties/methods
   @property
   def current_task(self):
-    return self._current_task
+    return self._task_engine.current_task
+
+  @timed
+  def submit_task(self ,program ,args=()):
+    """
+    Run a Phenix program in a worker process, returns the task id.
+    program: a short name (task_engine.programs, e.g. "real_space_refine")
+      or the module of a program template, e.g. "phenix.programs.ligandfit"
+    args: the command line arguments of the program
+    """
+    return self._task_engine.submit(program ,args)
+
+  @timed
+  def task_status(self ,task_id=None):
+    """
+    The record of a task (see task_engine), or of all tasks if task_id is
+    None.
+    """
+    return self._task_engine.status(task_id)
+
+  @timed
+  def cancel_task(self ,task_id):
+    return self._task_engine.cancel(task_id)
+
+  @timed
+  def task_result(self ,task_id ,timeout=0.):
+    """
+    The result of a done task, waiting up to timeout seconds for it. None if
+    the task is not done (see task_status for failures).
+    """
+    return self._task_engine.result(task_id ,timeout=timeout)
+
+  @timed
+  def task_events(self ,task_id ,since_seq=-1 ,timeout=30.):
+    """
+    Long poll for the intermediate results a task published after
+    since_seq (see TaskEngine.wait_for_events). Pass the returned "seq" as
+    since_seq of the next call.
+    """
+    return self._task_engine.wait_for_events(task_id ,since_seq=since_seq ,
+                                             timeout=timeout)
+
+  def __del__(self):
+    try:
+      self.close()
+    except Exception:
+      pass
+
+  def close(self):
+    """
+    Free the resources held for data entries (shared memory segments), and
+    stop running tasks.
+    """
+    self._shared_memory.release_all()
+    self._task_engine.close()
+
+  def get_metrics(self ,reset=False):
+    """
+    Call and cache statistics since the server started (or the last reset):
+      {"since": time the counting started,
+       "latency_bounds": upper bounds of the histogram buckets, in seconds,
+       "methods": {name: {"calls", "errors", "seconds", "mean_seconds",
+                          "max_seconds", "p50_seconds", "p95_seconds",
+                          "histogram", "bytes_in", "bytes_out"}},
+       "caches": {name: {"hits", "misses", "hit_rate"}}, with "entries" and
+         "nbytes" for the compressed bodies kept by "codec",
+       "data": {"entries", "bodies", "lazy", "nbytes"},
+       "scenes": {"entries", "nbytes", "version"},
+       "tasks": {state: number of tasks}}
+    Times are spent in the server methods, sizes are estimates of the
+    serialized arguments and results (see metrics).
+    """
+    metrics = self._metrics.snapshot(reset=reset)
+    for name ,store in [("codec" ,self._codecs) ,
+                        ("shared_memory" ,self._shared_memory)]:
+      metrics["caches"][name] = cache_dict(store.hits ,store.misses)
+      if reset:
+        store.hits ,store.misses = 0 ,0
+    metrics["caches"]["codec"].update(self._codecs.cache_sizes())
+    metrics["data"] = {"entries": len(self.data) ,
+                       "bodies": len(self.data.bodies) ,
+                       "lazy": len(self.data.lazy) ,
+                       "nbytes": self.data.nbytes()}
+    metrics["scenes"] = {"entries": len(self.scenes) ,
+                         "nbytes": approx_nbytes(list(self.scenes.values())) ,
+                         "version": self._scene_version}
+    tasks = {}
+    for task in list(self.tasks.values()):
+      tasks[task["state"]] = tasks.get(task["state"] ,0) + 1
+    metrics["tasks"] = tasks
+    return metrics
+
+  @timed
+  def save_snapshot(self ,path ,prune=True):
+    """
+    Save the data payloads and scenes to the directory path (see snapshot),
+    for restore_snapshot after a restart. Lazy api objects are encoded
+    first, tasks and derived indices are not saved. Returns
+    {"path", "data", "bodies_written", "scenes"}.
+    """
+    items = self.data.snapshot_items()
+    with self._scene_changed:
+      scenes = dict(self.scenes)
+      current = self._current_scene
+      version = self._scene_version
+    written = write_snapshot(path ,items ,scenes ,
+                             current_scene=current["id"] if current else None,
+                             scene_version=version ,prune=prune)
+    return {"path": path ,"data": len(items) ,"bodies_written": written ,
+            "scenes": len(scenes)}
+
+  @timed
+  def restore_snapshot(self ,path ,set_current=True):
+    """
+    Add the payloads and scenes of a snapshot saved with save_snapshot,
+    with the same ids. Only the manifest is read, bodies are read (memory
+    mapped) when their payload is first requested. The current scene of the
+    snapshot becomes current, with a scene_version above the saved one, so
+    reconnecting clients get the whole scene.
+    Returns {"path", "data", "scenes"}.
+    """
+    manifest = read_snapshot(path)
+    for id ,header in manifest["data"].items():
+      self.data.restore(id ,header ,
+                        manifest["bodies"].get(header.get("content_hash")))
+      self._release_data(id)
+      if header.get("object") == "coordinates":
+        with self._scene_changed:
+          self._coordinates.setdefault(header["model_id"] ,[]).append(id)
+    with self._scene_changed:
+      self.scenes.update(manifest["scenes"])
+      current = manifest["current_scene"]
+      if set_current and current in self.scenes:
+        self._scene_version = max(self._scene_version ,
+                                  manifest["scene_version"])
+        self._set_current_scene(self.scenes[current])
+    return {"path": path ,"data": len(manifest["data"]) ,
+            "scenes": len(manifest["scenes"])}
 
   # data properties/methods
-  def retrieve_data(self ,id):
-    if id in self.data:
-      return self.data[id]
+  @timed
+  def retrieve_data(self ,id ,transport=None ,codecs=None):
+    """
+    transport: None to send the payload as is, or "shared_memory" for
+      clients on the same machine. The body is then placed in a shared
+      memory segment and only a handle is sent (see shm_transport).
+    codecs: the compression codecs the client can decode (see
+      payload_codecs), None for uncompressed bodies. Large bodies are then
+      compressed, with a faster codec for local clients.
+    """
+    payload = self.data.get(id) # None if unknown (or removed meanwhile)
+    if payload is None:
+      return None
+    if transport == "shared_memory":
+      return self._shared_memory.export(payload)
+    elif transport is not None:
+      raise ValueError("Transport not supported:", transport)
+    if codecs:
+      return self._codecs.encode(payload ,codecs ,
+                                 local=self._client_is_local())
+    return sendable(payload)
+
+  @staticmethod
+  def _client_is_local():
+    # whether the Pyro call being served comes from this machine
+    if sys.version_info.major == 2:
+      context = Pyro4.current_context
+    else:
+      context = Pyro5.api.current_context
+    address = getattr(context ,"client_sock_addr" ,None)
+    if address is None or not isinstance(address ,tuple):
+      return True # not a Pyro call, or a Unix domain socket
+    host = address[0]
+    return host.startswith("127.") or host in ["::1" ,"localhost"]
+
+  @timed
+  def retrieve_data_header(self ,id):
+    """
+    The payload without its body, with the hash of the body in
+    "content_hash". Clients holding a body with that hash can skip
+    retrieve_data.
+    """
+    try:
+      return self.data.header(id)
+    except KeyError:
+      return None
+
+  @timed
+  def retrieve_data_many(self ,ids ,fields=None ,transport=None ,codecs=None):
+    """
+    Retrieve several payloads in one call. Returns a list in the order of
+    ids, with None for unknown ids.
+
+    fields: None for the whole payloads, "header" for the payloads without
+      their bodies (see retrieve_data_header), or a list of top level keys to
+      return.
+    transport, codecs: as for retrieve_data
+    """
+    payloads = []
+    for id in ids:
+      if fields is None:
+        payloads.append(self.retrieve_data(id ,transport=transport ,
+                                           codecs=codecs))
+      elif fields == "header":
+        payloads.append(self.retrieve_data_header(id))
+      else:
+        if "source" in fields:
+          payload = self.retrieve_data(id ,transport=transport ,codecs=codecs)
+        else:
+          payload = self.retrieve_data_header(id)
+        if payload is not None:
+          payload = dict((k ,payload[k]) for k in fields if k in payload)
+        payloads.append(payload)
+    return payloads
 
+  @timed
+  def has_data_many(self ,ids):
+    return [id in self.data for id in ids]
+
+  def shared_memory_available(self):
+    return self._shared_memory.available()
+
+  @timed
   def add_data(self ,data_payload):
-    self.data[data_payload["id"]] = data_payload
+    """
+    data_payload: a payload dict, or (in the same process only) an api object.
+      The body of an api object made with lazy=True is encoded when the data
+      is first retrieved.
+    """
+    if isinstance(data_payload, ObjectAPI):
+      id = data_payload.payload["id"]
+      self.data.add_api_object(data_payload)
+    else:
+      id = data_payload["id"]
+      self.data[id] = data_payload
+    self._release_data(id)
+
+  @timed
+  def remove_data(self ,id):
+    self.data.pop(id, None)
+    self._release_data(id)
+
+  def _release_data(self ,id):
+    # drop everything derived from a data entry, after it changed
+    with self._data_lock:
+      self._generations[id] = next(self._next_generation)
+      self._map_indices.pop(id, None)
+      self._spatial_indices.pop(id, None)
+    self._shared_memory.release(id)
+
+  def _cached_index(self ,name ,cache ,id ,build):
+    """
+    The index of data id in cache (id -> (generation, index)), made with
+    build() if missing or made from an older generation of the data. It is
+    built without holding a lock, and only kept if the data did not change
+    meanwhile.
+    """
+    generation = self._generations.get(id)
+    entry = cache.get(id)
+    self._metrics.cache(name ,entry is not None and entry[0] == generation)
+    if entry is not None and entry[0] == generation:
+      return entry[1]
+    index = build()
+    if index is not None:
+      with self._data_lock:
+        if self._generations.get(id) == generation:
+          cache[id] = (generation ,index)
+    return index
 
+  @timed
+  def retrieve_data_region(self ,id ,box_min ,box_max):
+    """
+    Return a map payload with only the voxels inside a box of grid indices.
+    box_min is inclusive, box_max exclusive. The payload uses the binary
+    encoding, its origin is the (clipped) lower corner of the box.
+    """
+    header = self.retrieve_data_header(id)
+    if header is None:
+      return None
+    if header["object"] != "map":
+      raise ValueError("Regions can only be retrieved from maps, not:",
+                       header["object"])
+    map_index = self._map_index(id)
+    if map_index is None:
+      raise ValueError("Map payload does not carry its values:", id)
+    array, origin = map_index.region(box_min, box_max)
+    region = {"box_min": origin,
+              "box_max": tuple(o + n for o, n in zip(origin, array.shape))}
+    return binary_payload(header, array, origin, map_index.pixel_sizes,
+                          region=region)
+
+  @timed
+  def retrieve_data_level(self ,id ,level):
+    """
+    Return a map payload binned by level (one of the payload "lod" levels),
+    for a fast first display of large maps. Levels are made on first request
+    and cached with the map index. Returns None if the payload does not carry
+    its values (read from file instead).
+    """
+    header = self.retrieve_data_header(id)
+    if header is None:
+      return None
+    if header["object"] != "map":
+      raise ValueError("Levels can only be retrieved from maps, not:",
+                       header["object"])
+    map_index = self._map_index(id)
+    if map_index is None:
+      return None
+    array, origin, pixel_sizes, offset = map_index.level(level)
+    lod = {"level": level, "levels": MapIndex.levels, "offset": offset}
+    new_payload = binary_payload(header, array, origin, pixel_sizes)
+    new_payload["source"]["lod"] = lod
+    return new_payload
+
+  @timed
+  def retrieve_data_level_many(self ,ids ,level):
+    """
+    retrieve_data_level for several maps in one call. Returns a list in the
+    order of ids, with None for unknown ids, payloads that are not maps and
+    maps that do not carry their values.
+    """
+    payloads = []
+    for id in ids:
+      header = self.retrieve_data_header(id)
+      if header is None or header["object"] != "map":
+        payloads.append(None)
+      else:
+        payloads.append(self.retrieve_data_level(id ,level))
+    return payloads
+
+  def _map_index(self ,id):
+    def build():
+      payload = self.data.get(id)
+      if payload is None:
+        return None
+      try:
+        return MapIndex.from_payload(payload)
+      except ValueError: # values not in the payload
+        return None
+    return self._cached_index("map_index" ,self._map_indices ,id ,build)
+
+  def _spatial_index(self ,id):
+    def build():
+      obj = self.data.source_object(id)
+      if obj is not None:
+        table = atom_table_from_model(obj)
+      else:
+        payload = self.data.get(id)
+        if payload is None:
+          return None
+        table = atom_table_from_payload(payload)
+      if table is None:
+        return None
+      return SpatialIndex(table)
+    return self._cached_index("spatial_index" ,self._spatial_indices ,id ,
+                              build)
+
+  def _spatial_index_ready(self ,id):
+    entry = self._spatial_indices.get(id)
+    return entry is not None and entry[0] == self._generations.get(id)
+
+  def _index_in_background(self ,ids):
+    # build the spatial indices of models in a thread, so resolving an xyz
+    # focus never waits for models to be parsed (see _resolve_focus)
+    with self._data_lock:
+      ids = [id for id in ids if id not in self._indexing and
+             not self._spatial_index_ready(id)]
+      self._indexing.update(ids)
+    if len(ids) > 0:
+      threading.Thread(target=self._build_spatial_indices ,args=(ids ,) ,
+                       daemon=True).start()
+
+  def _build_spatial_indices(self ,ids):
+    for id in ids:
+      try:
+        self._spatial_index(id)
+      except Exception:
+        pass # unparsable model, left to the client
+      finally:
+        with self._data_lock:
+          self._indexing.discard(id)
+
+  @timed
+  def atoms_within(self ,id ,xyz ,radius):
+    """
+    The atoms of model id within radius of xyz, as [start, stop) ranges of
+    atom indices: {"id": id, "atom_ranges": [[start, stop], ...]}
+    """
+    header = self.retrieve_data_header(id)
+    if header is None or header["object"] != "model":
+      return None
+    spatial_index = self._spatial_index(id)
+    if spatial_index is None:
+      return None
+    with self._index_lock:
+      indices = spatial_index.atoms_within(xyz ,radius)
+    return {"id": id, "atom_ranges": index_ranges(indices)}
+
+  @timed
+  def atom_labels(self ,id):
+    """
+    The labels of the atoms of model id in hierarchy order, the order of the
+    atom indices of coordinates updates. Clients that merge alternate
+    conformers into one atom use them to match their atoms:
+    {"id": id, "chain": [...], "resseq": [...], "icode": [...],
+     "name": [...], "altloc": [...]}, stripped strings, one per atom.
+    """
+    header = self.retrieve_data_header(id)
+    if header is None or header["object"] != "model":
+      return None
+    spatial_index = self._spatial_index(id)
+    if spatial_index is None:
+      return None
+    labels = {"id": id}
+    for key in ["chain" ,"resseq" ,"icode" ,"name" ,"altloc"]:
+      labels[key] = np.char.strip(spatial_index.table[key]).tolist()
+    return labels
+
+  @timed
+  def nearest_to_xyz(self ,xyz ,expand="residue" ,ids=None):
+    """
+    The model entity nearest to xyz, over the models in ids (default: the
+    models of the current scene). See SpatialIndex.nearest for the result,
+    which also has the "id" of the model.
+    """
+    if ids is None:
+      scene = self.current_scene or {"data": []}
+      ids = [d["id"] for d in scene["data"] if d["object"] == "model"]
+    best = None
+    for id in ids:
+      if id not in self.data:
+        continue
+      spatial_index = self._spatial_index(id)
+      if spatial_index is None:
+        continue
+      with self._index_lock:
+        result = spatial_index.nearest(xyz ,expand=expand)
+      if result is not None and (best is None or
+                                 result["distance"] < best["distance"]):
+        result["id"] = id
+        best = result
+    return best
+
+  @timed
   def has_data(self ,id=None):
     if id is None:
       return len(self.data ) >0
@@ -60,37 +530,217 @@ class PhenixServer:
 
   @current_scene.setter
   def current_scene(self ,scene_payload):
-    if scene_payload["id"] not in self.scenes:
-      self.add_scene(scene_payload ,set_current=True)
-    else:
+    with self._scene_changed:
+      if scene_payload["id"] not in self.scenes:
+        self.add_scene(scene_payload ,set_current=True)
+      else:
+        self._set_current_scene(scene_payload)
+
+  @property
+  def scene_version(self):
+    return self._scene_version
+
+  def _set_current_scene(self ,scene_payload):
+    with self._scene_changed:
       self._current_scene = scene_payload
+      self._scene_version += 1
+      self._scene_history.append((self._scene_version, scene_payload))
+      self._scene_changed.notify_all()
+    self._index_in_background([d["id"] for d in scene_payload["data"]
+                               if d["object"] == "model"])
+
+  @timed
+  def wait_for_scene_change(self ,since_version ,timeout=30. ,delta=False):
+    """
+    Long poll for scene changes. Returns as soon as scene_version is larger
+    than since_version, or after timeout seconds.
+
+    Returns {"version": scene_version, "scene": current_scene}, where scene is
+    None if nothing changed before the timeout. With delta=True the result of
+    scene_changes_since(since_version) is returned instead.
+    """
+    deadline = time.time() + timeout
+    with self._scene_changed:
+      while self._scene_version <= since_version:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          break
+        self._scene_changed.wait(remaining)
+      changed = self._scene_version > since_version
+      version, scene = self._scene_version, self._current_scene
+    if delta:
+      return self.scene_changes_since(since_version)
+    if not changed:
+      scene = None
+    return {"version": version, "scene": scene}
+
+  @timed
+  def scene_changes_since(self ,since_version):
+    """
+    The changes of the current scene since since_version:
+      {"version": scene_version,
+       "full": False,
+       "changes": SceneAPI.delta(old scene, current scene),
+       "scene": None}
+    If the scene at since_version is no longer known (or there was none),
+    "full" is True and "scene" is the whole current scene.
+    """
+    with self._scene_changed:
+      version, current = self._scene_version, self._current_scene
+      old = None
+      for v, scene in self._scene_history:
+        if v == since_version:
+          old = scene
+    if since_version == version:
+      return {"version": version, "full": False, "changes": {}, "scene": None}
+    if old is None or current is None:
+      return {"version": version, "full": True, "changes": None,
+              "scene": current}
+    return {"version": version, "full": False,
+            "changes": SceneAPI.delta(old, current), "scene": None}
 
 
+  @timed
   def retrieve_scene(self ,scene_id):
     if scene_id in self.scenes:
       return self.scenes[scene_id]
 
 
+  @timed
   def add_scene(self ,scene_payload ,set_current=True):
     failed = False
     data = scene_payload["data"]
 
 
     scene_id = scene_payload["id"]
-    self.scenes[scene_id ] =scene_payload
+    with self._scene_changed:
+      self.scenes[scene_id ] =scene_payload
 
-    for d in data:
-      if d["id"] not in self.data:
-        return False
-    if set_current:
-      self._current_scene = self.scenes[scene_id]
+      for d in data:
+        if d["id"] not in self.data:
+          return False
+      if set_current:
+        self._set_current_scene(self.scenes[scene_id])
     return True
 
+  @timed
   def update_focus(self,focus):
-    new_scene = SceneAPI.from_copy(self.current_scene).payload
-    new_scene["focus"]=focus
-    self.add_scene(new_scene)
-    self._current_scene = new_scene
+    """
+    Change the focus of the current scene. The scene keeps its id, the old
+    payload is replaced (not modified) so it stays valid for deltas.
+    """
+    focus = self._resolve_focus(focus)
+    with self._scene_changed: # no scene change between the copy and the set
+      new_scene = dict(self.current_scene)
+      new_scene["focus"]=focus
+      self.scenes[new_scene["id"]] = new_scene
+      self._set_current_scene(new_scene)
+
+  @timed
+  def update_coordinates(self ,coordinates_payload):
+    """
+    Move the atoms of a model in data without sending the model again.
+    coordinates_payload: a CoordinatesAPI payload (or, in the same process,
+      object) with the model_id of the model.
+
+    The coordinates are stored as a data entry and added to the current
+    scene, where clients apply them to the model they already have. Earlier
+    coordinates of the model are not kept once they have no effect: a
+    partial update (indices set) is merged into the previous one if that is
+    a partial update of the same arrays, and updates covered by the new one
+    (e.g. every update before a full one) are removed.
+    Returns False if the model is unknown.
+    """
+    if isinstance(coordinates_payload, ObjectAPI):
+      coordinates_payload = coordinates_payload.materialize()
+    model_id = coordinates_payload["model_id"]
+    if model_id not in self.data:
+      return False
+    source = dict(coordinates_payload["source"])
+    for key in ["xyz" ,"b" ,"occ" ,"indices"]:
+      if source.get(key) is not None: # bytes as sent by serpent
+        source[key] = normalize_body(source[key])
+    coordinates_payload = dict(coordinates_payload ,source=source)
+    self._move_atoms(coordinates_payload)
+
+    with self._scene_changed:
+      id = coordinates_payload["id"]
+      earlier = [d for d in self._coordinates.get(model_id ,[])
+                 if d != id and d in self.data]
+      replaced = []
+      if len(earlier) > 0:
+        merged = CoordinatesAPI.merge(self.data[earlier[-1]] ,
+                                      coordinates_payload)
+        if merged is not None:
+          coordinates_payload = merged
+          replaced.append(earlier[-1])
+      replaced += [d for d in earlier if d not in replaced and
+                   CoordinatesAPI.covers(coordinates_payload ,self.data[d])]
+      self._coordinates[model_id] = [d for d in earlier
+                                     if d not in replaced] + [id]
+      self.add_data(coordinates_payload)
+      scene = self.current_scene
+      if scene is not None and model_id in [d["id"] for d in scene["data"]]:
+        new_scene = dict(scene)
+        new_scene["data"] = [d for d in scene["data"]
+                             if d["id"] not in replaced and d["id"] != id]
+        new_scene["data"].append({"id": id,
+                                  "object": "coordinates",
+                                  "model_id": model_id})
+        self.scenes[new_scene["id"]] = new_scene
+        self._set_current_scene(new_scene)
+    for d in replaced:
+      self.remove_data(d)
+    return True
+
+  def _move_atoms(self ,coordinates_payload):
+    # keep the spatial index of the model in step with its coordinates
+    source = coordinates_payload["source"]
+    if source["xyz"] is None:
+      return
+    try:
+      spatial_index = self._spatial_index(coordinates_payload["model_id"])
+    except Exception:
+      return # unparsable model, no index
+    if spatial_index is None:
+      return
+    xyz = np.frombuffer(normalize_body(source["xyz"]) ,dtype="<f4")
+    indices = None
+    if source["indices"] is not None:
+      indices = np.frombuffer(normalize_body(source["indices"]) ,dtype="<i4")
+    try:
+      with self._index_lock:
+        spatial_index.move_atoms(xyz.reshape(-1 ,3) ,indices=indices)
+    except (ValueError, IndexError): # atoms don't match the model
+      with self._data_lock:
+        self._spatial_indices.pop(coordinates_payload["model_id"] ,None)
+
+  def _resolve_focus(self ,focus):
+    """
+    Add the nearest model entity to an xyz focus as focus["resolved"]. Only
+    done once the spatial indices of all models in the scene are built
+    (in background, see _index_in_background): until then the focus is
+    left for the client to resolve, so update_focus never parses models.
+    """
+    xyz = focus.get("xyz")
+    if xyz is None or len(xyz) != 3 or focus.get("id") is not None:
+      return focus
+    scene = self.current_scene or {"data": []}
+    ids = [d["id"] for d in scene["data"]
+           if d["object"] == "model" and d["id"] in self.data]
+    with self._data_lock:
+      pending = [id for id in ids if not self._spatial_index_ready(id)]
+    if len(pending) > 0:
+      self._index_in_background(pending)
+      return focus
+    try:
+      resolved = self.nearest_to_xyz(xyz ,expand=focus.get("xyz_expand") ,
+                                     ids=ids)
+    except Exception:
+      resolved = None # unparsable model, let the client resolve it
+    if resolved is not None:
+      focus = dict(focus ,resolved=resolved)
+    return focus
 
 # conditional expose
 if sys.version_info.major ==2:
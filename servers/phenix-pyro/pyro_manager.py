@@ -1,4 +1,7 @@
+import os
 import sys
+import json
+import tempfile
 import threading
 import socket
 import logging
@@ -79,50 +82,182 @@ def get_ns_daemon(host=None,
   return daemon, bcserver
 
 
+def private_dir():
+  """
+  The directory of this user (mode 0700) for the rendezvous file and the
+  Unix domain sockets: $XDG_RUNTIME_DIR/phenix-pyro if set, else
+  ~/.phenix/pyro. Files with known names in the shared temporary directory
+  could be made first by another user, to send clients to their server.
+  """
+  runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+  if runtime_dir:
+    path = os.path.join(runtime_dir, "phenix-pyro")
+  else:
+    path = os.path.join(os.path.expanduser("~"), ".phenix", "pyro")
+  if not os.path.isdir(path):
+    os.makedirs(path, 0o700)
+  if not sys.platform.startswith("win"):
+    os.chmod(path, 0o700) # makedirs applies the umask
+  return path
+
+
+def rendezvous_path():
+  """
+  The file listing the services of the running PyroManager, so clients can
+  connect without looking for the name server (see write_rendezvous).
+  Set PHENIX_PYRO_RENDEZVOUS to use another path.
+  """
+  path = os.environ.get("PHENIX_PYRO_RENDEZVOUS")
+  if path:
+    return path
+  return os.path.join(private_dir(), "rendezvous.json")
+
+
+def unix_socket_path(name="server"):
+  """
+  A Unix domain socket path of this process for PyroManager(local=True), in
+  private_dir unless that path is too long for a socket address.
+  """
+  filename = "phenix_pyro_%s_%d.sock" % (name, os.getpid())
+  try:
+    path = os.path.join(private_dir(), filename)
+  except OSError:
+    path = None
+  if path is None or len(path) > 100: # sun_path holds 104 to 108 bytes
+    path = os.path.join(tempfile.gettempdir(), filename)
+  return path
+
+
+def _prepare_unix_socket(path):
+  # a socket left by a process that did not exit cleanly blocks bind
+  if path is not None and os.path.exists(path):
+    import stat
+    if stat.S_ISSOCK(os.stat(path).st_mode):
+      os.remove(path)
+  return path
+
+
+def _replace(src, dst):
+  # os.replace is Python 3 only, rename replaces dst on POSIX but not Windows
+  if sys.version_info.major == 2:
+    try:
+      os.rename(src, dst)
+    except OSError:
+      os.remove(dst)
+      os.rename(src, dst)
+  else:
+    os.replace(src, dst)
+
+
+def _open_private(path):
+  # mode 0600 whatever the umask, clients do not read rendezvous files that
+  # others can write
+  fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+  if hasattr(os, "fchmod"):
+    os.fchmod(fd, 0o600)
+  return os.fdopen(fd, "w")
+
+
+def write_rendezvous(ns_uri, services):
+  """
+  services: name -> uri
+  The file is replaced, not rewritten in place, so clients never read half
+  of it.
+  """
+  path = None
+  rendezvous = {"pyro_version": PYRO_VERSION,
+                "ns_uri": str(ns_uri),
+                "pid": os.getpid(),
+                "services": dict((name, str(uri))
+                                 for name, uri in services.items())}
+  try:
+    path = rendezvous_path()
+    new_path = "%s.%d" % (path, os.getpid())
+    with _open_private(new_path) as fh:
+      json.dump(rendezvous, fh)
+    _replace(new_path, path)
+  except (IOError, OSError):
+    log.warning("Unable to write the rendezvous file %s", path)
+
+
+def remove_rendezvous():
+  # only if it is the file of this process
+  try:
+    path = rendezvous_path()
+    with open(path) as fh:
+      pid = json.load(fh).get("pid")
+    if pid == os.getpid():
+      os.remove(path)
+  except (IOError, OSError, ValueError):
+    pass
+
+
 class PyroManager:
   """
   The top level class to manage Pyro Services for Phenix.
   This should be a singleton, which is deleted upon GUI exit.
 
   If not deleted properly (calling the __del__ method), it will block GUI exit.
+
+  local=True: for sessions where ChimeraX runs on the same machine. The server
+  daemon listens on a Unix domain socket (unixsocket, default
+  unix_socket_path()) instead of TCP, and with local_ns=True so does a name
+  server of its own, which is then found through the rendezvous file only
+  (no broadcast). Falls back to TCP where Unix domain sockets are not
+  available.
   """
 
-  def __init__(self):
+  def __init__(self, local=False, unixsocket=None, local_ns=False):
+    if local and not hasattr(socket, "AF_UNIX"):
+      log.warning("Unix domain sockets are not available, using TCP")
+      local = False
+    if not local:
+      unixsocket, local_ns = None, False
+    elif unixsocket is None:
+      unixsocket = unix_socket_path("server")
+    self.unixsocket = unixsocket
+    self.ns_unixsocket = unix_socket_path("ns") if local_ns else None
+    self.ns_uri = None # known if this manager runs a local name server
     self._ns_thread = None
     self._daemon_thread = None
     self.services = {}
+    self.service_names = {} # name -> uri, written to the rendezvous file
     self.daemon = None
     self._ns_daemon = None
     self._bcserver = None
     # Pyro config
     if sys.version_info.major == 2:
-      Pyro4.config.COMPRESSION = True
+      Pyro4.config.COMPRESSION = False # bodies are compressed per payload
       Pyro4.config.SERIALIZERS_ACCEPTED.add("msgpack")
       Pyro4.config.SERIALIZER = "msgpack"
     else:
-      Pyro5.config.COMPRESSION = True
+      Pyro5.config.COMPRESSION = False # bodies are compressed per payload
       Pyro5.config.SERIALIZER = "msgpack"
 
     # Start nameserver thread
-    if not self.ns_visible():
+    if self.ns_unixsocket is not None or not self.ns_visible():
+      unixsocket = _prepare_unix_socket(self.ns_unixsocket)
       if sys.version_info.major == 2:
-        self._ns_daemon, self._bcserver = get_ns_daemon()
+        self._ns_daemon, self._bcserver = get_ns_daemon(unixsocket=unixsocket)
         t = threading.Thread(target=self._ns_daemon.requestLoop)  # py2
         t.setDaemon(True)
       else:
-        self._ns_daemon, self._bcserver = get_ns_daemon()
+        self._ns_daemon, self._bcserver = get_ns_daemon(unixsocket=unixsocket)
         t = threading.Thread(target=self._ns_daemon.requestLoop,
                              daemon=True)  # py3
       t.start()
       self._ns_thread = t
+      if unixsocket is not None:
+        self.ns_uri = self._ns_daemon.uriFor(self._ns_daemon.nameserver)
 
     # Start server daemon thread
+    unixsocket = _prepare_unix_socket(self.unixsocket)
     if sys.version_info.major == 2:
-      self.daemon = Pyro4.Daemon()  # py2
+      self.daemon = Pyro4.Daemon(unixsocket=unixsocket)  # py2
       t = threading.Thread(target=self.daemon.requestLoop)
       t.setDaemon(True)
     else:
-      self.daemon = Pyro5.server.Daemon()  # py3
+      self.daemon = Pyro5.server.Daemon(unixsocket=unixsocket)  # py3
       t = threading.Thread(target=self.daemon.requestLoop, daemon=True)
     t.start()
     self._daemon_thread = t
@@ -130,6 +265,8 @@ class PyroManager:
   def __del__(self):
     with redirect_stdout(StringIO()) as out:
       with redirect_stderr(StringIO()) as err: # py2 try to supress errors
+        if getattr(self,"service_names",None):
+          remove_rendezvous()
         if hasattr(self,"daemon") and self.daemon is not None:
             self.daemon.shutdown()
             del self.daemon
@@ -147,13 +284,22 @@ class PyroManager:
     """
     service_uri = self.daemon.register(service)
     self.services[service_uri] = service
+    with self._name_server() as ns:
+      ns.register(prefix, service_uri)
+      ns_uri = ns._pyroUri
+    self.service_names[prefix] = service_uri
+    write_rendezvous(ns_uri, self.service_names)
+    return service_uri
+
+  def _name_server(self):
     if sys.version_info.major == 2:
-      with Pyro4.locateNS() as ns:
-        ns.register(prefix, service_uri)
+      if self.ns_uri is not None:
+        return Pyro4.Proxy(self.ns_uri)
+      return Pyro4.locateNS()
     else:
-      with Pyro5.api.locate_ns() as ns:
-        ns.register(prefix, service_uri)
-    return service_uri
+      if self.ns_uri is not None:
+        return Pyro5.api.Proxy(self.ns_uri)
+      return Pyro5.api.locate_ns()
 
   @staticmethod
   def ns_visible():
@@ -172,43 +318,42 @@ class PyroManager:
 
   @staticmethod
   def find_server(prefix="", uri=None, return_index=None, try_most_recent=True):
+    """
+    Look up services in the name server. Names are listed without making
+    proxies, the proxy is made for the chosen service only (for all of them
+    only if neither uri, try_most_recent nor return_index pick one).
+    """
     failed = False
-    services = []
-    service_names = []
-    service_uris = []
     service, service_name, service_uri = None, None, None
 
     if uri is not None:
       prefix = ""
 
     if PYRO_VERSION == 4:
+      make_proxy = Pyro4.Proxy
       with Pyro4.naming.locateNS() as ns:
-        for service, service_uri in ns.list(prefix=prefix).items():
-          # print("found service:", service)
-          services.append(Pyro4.Proxy(service_uri))
-          service_names.append(service)
-          service_uris.append(service_uri)
+        listed = ns.list(prefix=prefix)
     else:
+      make_proxy = Pyro5.api.Proxy
       with Pyro5.api.locate_ns() as ns:
-        for service, service_uri in ns.list(prefix=prefix).items():
-          # print("found service:", service)
-          services.append(Pyro5.api.Proxy(service_uri))
-          service_names.append(service)
-          service_uris.append(service_uri)
+        listed = ns.list(prefix=prefix)
+    service_names = list(listed.keys())
+    service_uris = [listed[name] for name in service_names]
 
-    if len(services) == 0:
+    if len(service_names) == 0:
       failed = True
 
     if uri != None:
       service_uri_strings = [str(service_uri) for service_uri in service_uris]
-      try:
+      if uri in service_uri_strings:
         service_index = service_uri_strings.index(uri)
-        service = services[service_index]
         service_name = service_names[service_index]
         service_uri = service_uris[service_index]
-        return service, service_name, service_uri, failed
-      except:
-        pass
+        service = make_proxy(service_uri)
+      return service, service_name, service_uri, failed
+
+    elif failed:
+      return service, service_name, service_uri, failed
 
     elif try_most_recent:
       times = []
@@ -223,13 +368,13 @@ class PyroManager:
       sorted_names = [x for _, x in
                       sorted(zip(times, service_names), reverse=True)]
       name = sorted_names[0]
-      name_index = service_names.index(name)
-      service = services[name_index]
-      service_uri = service_uris[name_index]
-      return service, name, service_uri, failed
+      service_uri = listed[name]
+      return make_proxy(service_uri), name, service_uri, failed
 
     elif return_index is not None:
-      return services[return_index], service_names[return_index], service_uris[
-        return_index], failed
+      service_uri = service_uris[return_index]
+      return make_proxy(service_uri), service_names[return_index], \
+        service_uri, failed
     else:
+      services = [make_proxy(u) for u in service_uris]
       return services, service_names, service_uris, failed
@@ -0,0 +1,147 @@
+import sys
+import threading
+
+import numpy as np
+
+from phenix.api.map_index import array_from_payload
+
+if sys.version_info.major == 2:
+  shared_memory = None
+else:
+  try:
+    from multiprocessing import shared_memory
+  except ImportError: # python < 3.8
+    shared_memory = None
+
+"""
+Shared memory transport for clients on the same machine as the server.
+
+The body of a payload (the model file string or the map values) is copied
+once into a named shared memory segment. The payload sent over Pyro only
+carries a small handle in source["shared_memory"]:
+
+  {"name": "psm_1234abcd",  # segment name to attach to
+   "nbytes": 1024,          # bytes of the body at the start of the segment
+   "field": "binary"}       # "binary" for map values, "filestring" or
+                            # "columns" for models
+
+Map bodies are always sent in the binary encoding. The client attaches to
+the segment, copies the body out and detaches. Segments belong to the
+SharedMemoryStore and live as long as the data entry on the server.
+"""
+
+
+def _copy_source(payload):
+  new_payload = dict(payload)
+  new_payload["source"] = dict(payload["source"])
+  return new_payload
+
+
+class SharedMemoryStore(object):
+
+  def __init__(self):
+    self.segments = {} # data id -> (SharedMemory, handle payload, hash)
+    self.hits = 0
+    self.misses = 0
+    self._lock = threading.RLock()
+
+  @staticmethod
+  def available():
+    return shared_memory is not None
+
+  def export(self, payload):
+    """
+    Return payload with its body moved to a shared memory segment. The
+    segment is made on the first export of an id and reused afterwards, as
+    long as the body (its content_hash) is the same.
+    Payloads without a body are returned unchanged.
+    """
+    if not self.available():
+      raise RuntimeError("Shared memory is not available on this platform")
+    data_id = payload["id"]
+    content_hash = payload.get("content_hash")
+    with self._lock:
+      current = self.segments.get(data_id)
+      if current is not None and current[2] == content_hash:
+        self.hits += 1
+        return current[1]
+      self.misses += 1
+    # the body is copied without the lock, so other exports do not wait
+    if payload["object"] == "model":
+      segment = self._export_model(payload)
+    elif payload["object"] == "map":
+      segment = self._export_map(payload)
+    else:
+      segment = None
+    if segment is None:
+      return payload
+    with self._lock:
+      current = self.segments.get(data_id)
+      if current is not None and current[2] == content_hash:
+        unused, segment = segment, current # exported meanwhile, keep that one
+      else:
+        unused = current
+        self.segments[data_id] = segment + (content_hash,)
+    if unused is not None:
+      unused[0].close()
+      unused[0].unlink()
+    return segment[1]
+
+  def _export_model(self, payload):
+    if payload["source"]["filestring"]["suffix"] == ".columns":
+      field, key = "columns", "bytes"
+      body = payload["source"]["columns"]["bytes"]
+    else:
+      field, key = "filestring", "string"
+      body = payload["source"]["filestring"]["string"]
+      if body is not None:
+        body = body.encode("utf-8")
+    if body is None:
+      return None
+    shm = shared_memory.SharedMemory(create=True, size=max(len(body), 1))
+    shm.buf[:len(body)] = body
+    new_payload = _copy_source(payload)
+    new_payload["source"][field] = dict(payload["source"][field])
+    new_payload["source"][field][key] = None
+    new_payload["source"]["shared_memory"] = {"name": shm.name,
+                                              "nbytes": len(body),
+                                              "field": field}
+    return shm, new_payload
+
+  def _export_map(self, payload):
+    result = array_from_payload(payload)
+    if result is None:
+      return None
+    array, origin, pixel_sizes = result
+    dtype = array.dtype.newbyteorder("<")
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    shared = np.ndarray(array.shape, dtype=dtype, buffer=shm.buf)
+    shared[...] = array
+    del shared # no exported pointers may remain when the segment is closed
+    new_payload = _copy_source(payload)
+    new_payload["source"]["encoding"] = "binary"
+    new_payload["source"]["list"] = dict(payload["source"].get("list", {}),
+                                         list_rep=None)
+    new_payload["source"]["binary"] = {
+      "bytes": None,
+      "dtype": dtype.str,
+      "shape": tuple(array.shape),
+      "origin": tuple(int(i) for i in origin),
+      "pixel_sizes": tuple(pixel_sizes),
+    }
+    new_payload["source"]["shared_memory"] = {"name": shm.name,
+                                              "nbytes": array.nbytes,
+                                              "field": "binary"}
+    return shm, new_payload
+
+  def release(self, data_id):
+    with self._lock:
+      segment = self.segments.pop(data_id, None)
+    if segment is not None:
+      shm = segment[0]
+      shm.close()
+      shm.unlink()
+
+  def release_all(self):
+    for data_id in list(self.segments.keys()):
+      self.release(data_id)
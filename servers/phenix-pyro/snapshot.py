@@ -0,0 +1,225 @@
+import os
+import sys
+import json
+import time
+import base64
+
+import numpy as np
+
+from phenix.api.payload_store import body_path, content_hash
+
+if sys.version_info.major == 2:
+  text_type = unicode
+else:
+  text_type = str
+
+"""
+Snapshots of PhenixServer state (data payloads and scenes) on disk, so a
+restarted server can serve the same ids without rebuilding the payloads
+from cctbx objects.
+
+A snapshot is a directory:
+
+  manifest.json       # everything but the bodies
+  bodies/<hash>.npy   # one file per distinct body, named by content hash
+
+Bodies are saved as 1d numpy arrays (uint8 for bytes and strings, float64
+for lists), which np.load can memory-map. Restoring only reads the manifest,
+each body is mapped when its payload is first requested, and bytes bodies
+are used from the mapping without a copy (see MappedBody.load). Body files
+are content-addressed, so saving again to the same directory only writes the
+bodies that are new, and the manifest is replaced last, so a snapshot
+interrupted while saving leaves the previous one intact.
+
+The manifest:
+  {"format": 1,
+   "created": 1700000000.0,
+   "data": {id: payload header (see PayloadStore.header)},
+   "bodies": {content hash: {"kind": "bytes", "str" or "list",
+                             "nbytes": size of the body}},
+   "scenes": {id: scene payload},
+   "current_scene": id of the current scene or None,
+   "scene_version": scene_version when saved}
+bytes values in headers (the arrays of coordinates payloads) of
+min_body_nbytes or more are saved as body files as well, and stored as
+{"body": content hash}. They are restored as MappedBody values, which the
+PayloadStore reads when the payload is first requested. Smaller ones are
+stored as {"data": base64 string, "encoding": "base64"}, as serpent sends
+them, and turned back into bytes on restore.
+"""
+
+snapshot_format = 1
+min_body_nbytes = 1024
+
+
+class MappedBody(object):
+  """
+  A body in a snapshot, read when first used (see PayloadStore).
+  """
+
+  def __init__(self, path, kind, nbytes):
+    self.path = path
+    self.kind = kind
+    self.nbytes = nbytes
+
+  def array(self):
+    if self.nbytes == 0: # empty files can not be mapped
+      return np.load(self.path)
+    return np.load(self.path, mmap_mode="r")
+
+  def load(self):
+    """
+    The body: the mapped array itself for bytes (read from the file as it is
+    used, copied to bytes only to be sent, see payload_store.sendable), a
+    str or a list otherwise.
+    """
+    array = self.array()
+    if self.kind == "bytes":
+      return array
+    elif self.kind == "str":
+      return array.tobytes().decode("utf-8")
+    elif self.kind == "list":
+      return array.tolist()
+    raise ValueError("Body kind not supported:", self.kind)
+
+
+def body_array(body, text=False):
+  """
+  (kind, 1d array) to save a body as.
+  text: the body is a model file string (str is bytes on Python 2)
+  """
+  if isinstance(body, MappedBody):
+    return body.kind, body.array()
+  if isinstance(body, text_type):
+    return "str", np.frombuffer(body.encode("utf-8"), dtype=np.uint8)
+  if isinstance(body, bytes):
+    return ("str" if text else "bytes"), np.frombuffer(body, dtype=np.uint8)
+  if isinstance(body, (list, tuple)):
+    return "list", np.asarray(body, dtype=np.float64)
+  if hasattr(body, "nbytes"): # a mapped body, already loaded
+    return "bytes", np.frombuffer(body, dtype=np.uint8)
+  raise ValueError("Body type not supported:", type(body))
+
+
+def to_json(value, save_body=None):
+  """
+  save_body: a function saving a bytes value (or a MappedBody) of
+    min_body_nbytes or more as a body file and returning its content hash,
+    None to store all bytes as base64
+  """
+  if save_body is not None and isinstance(value, (bytes, MappedBody)):
+    nbytes = value.nbytes if isinstance(value, MappedBody) else len(value)
+    if nbytes >= min_body_nbytes:
+      return {"body": save_body(value)}
+  if isinstance(value, bytes):
+    return {"data": base64.b64encode(value).decode("ascii"),
+            "encoding": "base64"}
+  if isinstance(value, dict):
+    return dict((k, to_json(v, save_body)) for k, v in value.items())
+  if isinstance(value, (list, tuple)):
+    return [to_json(v, save_body) for v in value]
+  if isinstance(value, np.generic):
+    return value.item()
+  return value
+
+
+def from_json(value, bodies=None):
+  """
+  bodies: content hash -> MappedBody, for the values saved as body files
+  """
+  if isinstance(value, dict):
+    if value.get("encoding") == "base64" and set(value) == {"data",
+                                                           "encoding"}:
+      return base64.b64decode(value["data"])
+    if bodies is not None and set(value) == {"body"}:
+      return bodies[value["body"]]
+    return dict((k, from_json(v, bodies)) for k, v in value.items())
+  if isinstance(value, list):
+    return [from_json(v, bodies) for v in value]
+  return value
+
+
+def _replace(src, dst):
+  # os.replace on Python 2 as well, as pyro_manager does
+  if sys.version_info.major == 2:
+    try:
+      os.rename(src, dst)
+    except OSError:
+      os.remove(dst)
+      os.rename(src, dst)
+  else:
+    os.replace(src, dst)
+
+
+def body_file(path, content_hash):
+  return os.path.join(path, "bodies", content_hash + ".npy")
+
+
+def write_snapshot(path, items, scenes, current_scene=None, scene_version=0,
+                   prune=True):
+  """
+  Save a snapshot to the directory path.
+  items: (id, header, body) of every payload (PayloadStore.snapshot_items)
+  prune: remove the body files no longer used by the snapshot
+  Returns the number of body files written.
+  """
+  if not os.path.isdir(os.path.join(path, "bodies")):
+    os.makedirs(os.path.join(path, "bodies"))
+  manifest = {"format": snapshot_format, "created": time.time(), "data": {},
+              "bodies": {}, "scenes": to_json(scenes),
+              "current_scene": current_scene, "scene_version": scene_version}
+  written = [0]
+
+  def save_body(body, h=None, text=False):
+    if h is None:
+      h = content_hash(body.array() if isinstance(body, MappedBody) else body)
+    if h in manifest["bodies"]:
+      return h
+    kind, array = body_array(body, text=text)
+    manifest["bodies"][h] = {"kind": kind, "nbytes": int(array.nbytes)}
+    filename = body_file(path, h)
+    if not os.path.exists(filename):
+      new_filename = filename + ".%d.tmp" % os.getpid()
+      with open(new_filename, "wb") as fh:
+        np.save(fh, array)
+      _replace(new_filename, filename)
+      written[0] += 1
+    return h
+
+  for id, header, body in items:
+    manifest["data"][id] = to_json(header, save_body)
+    h = header.get("content_hash")
+    if h is not None:
+      save_body(body, h, text=body_path(header)[-1] == "string")
+
+  filename = os.path.join(path, "manifest.json")
+  new_filename = filename + ".%d.tmp" % os.getpid()
+  with open(new_filename, "w") as fh:
+    json.dump(manifest, fh)
+  _replace(new_filename, filename)
+
+  if prune:
+    for name in os.listdir(os.path.join(path, "bodies")):
+      h = name.split(".")[0]
+      if name.endswith(".npy") and h not in manifest["bodies"]:
+        os.remove(os.path.join(path, "bodies", name))
+  return written[0]
+
+
+def read_snapshot(path):
+  """
+  The manifest of the snapshot in directory path, with the headers and
+  scenes decoded, and "bodies" as content hash -> MappedBody. Header values
+  saved as body files are MappedBody objects as well, none is read here.
+  """
+  with open(os.path.join(path, "manifest.json")) as fh:
+    manifest = json.load(fh)
+  if manifest.get("format") != snapshot_format:
+    raise ValueError("Snapshot format not supported:", manifest.get("format"))
+  manifest["bodies"] = dict(
+    (h, MappedBody(body_file(path, h), body["kind"], body["nbytes"]))
+    for h, body in manifest["bodies"].items())
+  manifest["data"] = dict((id, from_json(header, manifest["bodies"]))
+                          for id, header in manifest["data"].items())
+  manifest["scenes"] = from_json(manifest["scenes"])
+  return manifest
@@ -0,0 +1,178 @@
+import numpy as np
+
+from phenix.api.atom_table import residue_starts, chain_starts
+
+"""
+A cell list over the atoms of one model, to resolve focus requests on the
+server (SceneAPI._focus_template "xyz" and "xyz_expand").
+
+Atoms are binned into cubic cells and sorted by cell, so the atoms of a cell
+are one slice of the sorted order. A query only looks at the cells its
+search sphere overlaps.
+
+Query results are compact selections: the matching atoms as [start, stop)
+ranges of atom indices (hierarchy order), and for the nearest entity its
+labels and a selection string in Phenix syntax.
+"""
+
+
+def index_ranges(indices):
+  """
+  Sorted atom indices as a list of [start, stop) ranges.
+  """
+  indices = np.unique(indices)
+  if len(indices) == 0:
+    return []
+  breaks = np.flatnonzero(np.diff(indices) != 1) + 1
+  starts = np.concatenate([[indices[0]], indices[breaks]])
+  stops = np.concatenate([indices[breaks - 1] + 1, [indices[-1] + 1]])
+  return [[int(a), int(b)] for a, b in zip(starts, stops)]
+
+
+class SpatialIndex(object):
+  cell_size = 6.
+
+  def __init__(self, table, cell_size=None):
+    self.table = table
+    if cell_size is not None:
+      self.cell_size = cell_size
+    self.residue_starts = residue_starts(table)
+    self.chain_starts = chain_starts(table)
+    self._build()
+
+  def _build(self):
+    xyz = self.table["xyz"]
+    if len(xyz) == 0:
+      self.lower = np.zeros(3)
+      self.dims = np.ones(3, dtype=np.int64)
+    else:
+      self.lower = xyz.min(axis=0)
+      self.dims = np.floor(
+        (xyz.max(axis=0) - self.lower) / self.cell_size).astype(np.int64) + 1
+    keys = self._keys(self._cells(xyz))
+    self.order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[self.order]
+    self.cell_keys, self.cell_starts = np.unique(sorted_keys,
+                                                 return_index=True)
+    self.cell_stops = np.append(self.cell_starts[1:], len(sorted_keys))
+
+  def move_atoms(self, xyz, indices=None):
+    """
+    New coordinates for all atoms, or for the atoms at indices. The cells
+    are rebuilt, the residue and chain runs stay.
+    """
+    new_xyz = self.table["xyz"].copy()
+    if indices is None:
+      new_xyz[:] = np.asarray(xyz).reshape(-1, 3)
+    else:
+      new_xyz[indices] = np.asarray(xyz).reshape(-1, 3)
+    self.table = dict(self.table, xyz=new_xyz)
+    self._build()
+
+  def _cells(self, xyz):
+    return np.floor((xyz - self.lower) / self.cell_size).astype(np.int64)
+
+  def _keys(self, cells):
+    return (cells[:, 0] * self.dims[1] + cells[:, 1]) * self.dims[2] + \
+      cells[:, 2]
+
+  def _candidates(self, xyz, radius):
+    # atom indices in the cells overlapped by the sphere
+    lo = np.maximum(self._cells(xyz - radius)[0], 0)
+    hi = np.minimum(self._cells(xyz + radius)[0], self.dims - 1)
+    if np.any(hi < lo):
+      return np.zeros(0, dtype=np.int64)
+    grid = np.mgrid[lo[0]:hi[0] + 1, lo[1]:hi[1] + 1, lo[2]:hi[2] + 1]
+    keys = self._keys(grid.reshape(3, -1).T)
+    found = np.searchsorted(self.cell_keys, keys)
+    inside = found < len(self.cell_keys)
+    found, keys = found[inside], keys[inside]
+    found = found[self.cell_keys[found] == keys]
+    slices = [self.order[a:b] for a, b in
+              zip(self.cell_starts[found], self.cell_stops[found])]
+    if len(slices) == 0:
+      return np.zeros(0, dtype=np.int64)
+    return np.concatenate(slices)
+
+  def atoms_within(self, xyz, radius):
+    """
+    Sorted indices of the atoms within radius of xyz.
+    """
+    xyz = np.asarray(xyz, dtype=np.float64).reshape(1, 3)
+    candidates = self._candidates(xyz, radius)
+    d2 = ((self.table["xyz"][candidates] - xyz) ** 2).sum(axis=1)
+    return np.sort(candidates[d2 <= radius ** 2])
+
+  def nearest_atom(self, xyz):
+    """
+    Return (atom index, distance) of the atom nearest to xyz, or (None, None)
+    for an empty model. The search radius grows until an atom is found, any
+    atom found within the radius is the true nearest one.
+    """
+    n = len(self.table["xyz"])
+    if n == 0:
+      return None, None
+    xyz = np.asarray(xyz, dtype=np.float64).reshape(1, 3)
+    extent = self.dims * self.cell_size
+    max_radius = np.sqrt(((np.abs(xyz - self.lower) + extent) ** 2).sum())
+    radius = self.cell_size
+    while True:
+      if radius >= max_radius:
+        candidates = np.arange(n)
+      else:
+        candidates = self._candidates(xyz, radius)
+      if len(candidates) > 0:
+        d2 = ((self.table["xyz"][candidates] - xyz) ** 2).sum(axis=1)
+        i = np.argmin(d2)
+        if d2[i] <= radius ** 2 or radius >= max_radius:
+          return int(candidates[i]), float(np.sqrt(d2[i]))
+      radius *= 2
+
+  def _run(self, starts, i):
+    # [start, stop) of the run (residue or chain) containing atom i
+    k = np.searchsorted(starts, i, side="right") - 1
+    stop = starts[k + 1] if k + 1 < len(starts) else len(self.table["xyz"])
+    return int(starts[k]), int(stop)
+
+  def nearest(self, xyz, expand="residue"):
+    """
+    The entity nearest to xyz as a compact selection:
+      {"expand": expand, "distance": d, "atom_ranges": [[start, stop]],
+       "model": "", "chain": "A", "resseq": "   5", "icode": " ",
+       "resname": "LYS", "name": " CA ", "selection": "chain A and resseq 5"}
+    expand is one of [None,"model","chain","residue","atom"], None is treated
+    as "residue", the default of the scene focus. Labels below the expand
+    level are left out.
+    """
+    if expand is None:
+      expand = "residue"
+    i, distance = self.nearest_atom(xyz)
+    if i is None:
+      return None
+    t = self.table
+    result = {"expand": expand, "distance": distance,
+              "model": t["model"][i], "chain": t["chain"][i]}
+    selection = ["chain %s" % t["chain"][i]]
+    if expand == "model":
+      result["atom_ranges"] = [[0, len(t["xyz"])]]
+      del result["chain"]
+      selection = ["all"]
+    elif expand == "chain":
+      result["atom_ranges"] = [list(self._run(self.chain_starts, i))]
+    else:
+      result.update(resseq=t["resseq"][i], icode=t["icode"][i],
+                    resname=t["resname"][i])
+      selection.append("resseq %s" % t["resseq"][i].strip())
+      if t["icode"][i].strip():
+        selection.append("icode %s" % t["icode"][i].strip())
+      if expand == "residue":
+        result["atom_ranges"] = [list(self._run(self.residue_starts, i))]
+      else:
+        result["name"] = t["name"][i]
+        result["atom_ranges"] = [[i, i + 1]]
+        selection.append("name %s" % t["name"][i].strip())
+    result["selection"] = " and ".join(selection)
+    for key, value in result.items():
+      if isinstance(value, np.generic):
+        result[key] = value.item()
+    return result
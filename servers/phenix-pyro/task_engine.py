@@ -0,0 +1,373 @@
+import sys
+import time
+import uuid
+import traceback
+import importlib
+import threading
+import multiprocessing
+from collections import deque
+from io import StringIO
+
+if sys.version_info.major == 2:
+  wait = None
+else:
+  from multiprocessing.connection import wait
+
+"""
+Run Phenix programs in worker processes, off the Pyro request threads.
+
+Each task runs in its own process (spawned, so no locks or threads of the
+server are inherited), which keeps long cctbx jobs from holding the GIL of
+the server process and lets a running task be cancelled by terminating its
+process. At most max_workers tasks run at once, up to max_queued more wait
+in a FIFO queue.
+
+A task record in TaskEngine.tasks:
+
+  {"id": "9b1c...",
+   "program": "phenix.programs.real_space_refine",
+   "args": ["model.pdb", "map.mrc", "resolution=3"],
+   "state": "queued",   # "running", "done", "failed" or "cancelled"
+   "submitted": 1700000000.0,  # time.time() of each state change, or None
+   "started": None,
+   "finished": None,
+   "error": None,       # traceback of a failed task
+   "log": None}         # program output of a finished task
+
+The return value of the program (Program.get_results()) is put in
+TaskEngine.results[id] when the task is done. A result that can not be
+pickled is None, with the pickling error at the end of the task log.
+
+While it runs, a program can publish intermediate results (ModelAPI/MapAPI
+objects or payloads) with publish(). They become result events of the task:
+
+  {"task_id": "9b1c...",
+   "seq": 3,            # 0, 1, 2, ... per task
+   "object": "model",   # payload["object"]
+   "payload": {...}}
+
+Only the last max_events events of each task are kept, so a client that
+reads slower than the program publishes skips events instead of making the
+server buffer them.
+
+Finished tasks (record, result and events) are kept for finished_ttl
+seconds, and only the max_finished most recent ones, after that the task is
+unknown to status, result and wait_for_events.
+"""
+
+# short names for the programs clients can run
+programs = {
+  "real_space_refine": "phenix.programs.real_space_refine",
+  "ligandfit": "phenix.programs.ligandfit",
+  "molprobity": "mmtbx.programs.molprobity",
+  "validation_cryoem": "phenix.programs.validation_cryoem",
+}
+
+# other programs must be a module in one of these packages
+program_packages = ("phenix.programs.", "mmtbx.programs.")
+
+task_states = ["queued", "running", "done", "failed", "cancelled"]
+
+_connection = None  # pipe to the server, in task processes only
+
+
+def publish(data):
+  """
+  Send an intermediate result of the running task to the server: an api
+  object or a payload. Returns False (and does nothing) outside a task.
+  """
+  if _connection is None:
+    return False
+  if hasattr(data, "materialize"):
+    data = data.materialize()
+  _connection.send(("event", data, None))
+  return True
+
+
+def program_module(program):
+  """
+  The module name of a program: a key of programs, or the full module name
+  of a program template (a module with a Program class).
+  """
+  if program in programs:
+    return programs[program]
+  if program.startswith(program_packages):
+    return program
+  raise ValueError("Program not supported:", program)
+
+
+def run_program(module_name, args, logger):
+  # the cctbx imports happen here, in the worker process
+  from iotbx.cli_parser import run_program as cli_run_program
+  module = importlib.import_module(module_name)
+  return cli_run_program(program_class=module.Program, args=list(args),
+                         logger=logger)
+
+
+def _worker(connection, module_name, args):
+  # entry point of the task process, sends ("event", payload, None) for each
+  # publish() and finally one ("done"|"failed", value, log)
+  global _connection
+  _connection = connection
+  log = StringIO()
+  try:
+    result = run_program(module_name, args, log)
+    message = ("done", result, log.getvalue())
+  except BaseException:
+    message = ("failed", traceback.format_exc(), log.getvalue())
+  try:
+    connection.send(message)
+  except Exception:
+    if message[0] != "done":
+      raise
+    # the program ran, only its result can't be pickled
+    connection.send(("done", None, log.getvalue() +
+                     "\nThe result could not be sent to the server:\n" +
+                     traceback.format_exc()))
+  connection.close()
+
+
+class TaskEngine(object):
+
+  def __init__(self, max_workers=2, max_queued=16, max_events=8,
+               max_finished=32, finished_ttl=600., context="spawn"):
+    self.max_workers = max_workers
+    self.max_queued = max_queued
+    self.max_events = max_events
+    self.max_finished = max_finished
+    self.finished_ttl = finished_ttl
+    self.tasks = {}  # id -> task record
+    self.results = {}  # id -> program result of done tasks
+    self.events = {}  # id -> deque of the last max_events result events
+    self._next_seq = {}  # id -> seq of the next event
+    self.current_task = None  # id of the last started task
+    self._queue = deque()  # ids of queued tasks
+    self._running = {}  # id -> (process, connection)
+    self._stopping = {}  # id -> (process, connection) of cancelled tasks
+    self._lock = threading.RLock()
+    self._changed = threading.Condition(self._lock)
+    self._mp = None if wait is None else multiprocessing.get_context(context)
+    self._thread = None
+    self._closed = False
+    # wakes the monitor thread from waiting on the task connections
+    self._wakeup = None if self._mp is None else self._mp.Pipe(duplex=False)
+    self._wakeup_pending = False
+
+  @staticmethod
+  def available():
+    return wait is not None
+
+  def submit(self, program, args=()):
+    """
+    Queue a program run, returns the task id. Raises RuntimeError if
+    max_queued tasks are already waiting.
+    """
+    if not self.available():
+      raise RuntimeError("Tasks are not available on this platform")
+    module_name = program_module(program)
+    with self._lock:
+      if self._closed:
+        raise RuntimeError("Task engine is closed")
+      if len(self._queue) >= self.max_queued:
+        raise RuntimeError("Task queue is full:", self.max_queued)
+      self._prune()
+      task_id = uuid.uuid4().hex
+      self.tasks[task_id] = {
+        "id": task_id, "program": module_name, "args": list(args),
+        "state": "queued", "submitted": time.time(), "started": None,
+        "finished": None, "error": None, "log": None}
+      self.events[task_id] = deque(maxlen=self.max_events)
+      self._next_seq[task_id] = 0
+      self._queue.append(task_id)
+      self._start_queued()
+      if self._thread is None:
+        self._thread = threading.Thread(target=self._monitor, daemon=True)
+        self._thread.start()
+    return task_id
+
+  def status(self, task_id=None):
+    """
+    A copy of the task record, or of all records if task_id is None.
+    """
+    with self._lock:
+      if task_id is None:
+        return dict((k, dict(v)) for k, v in self.tasks.items())
+      if task_id in self.tasks:
+        return dict(self.tasks[task_id])
+
+  def cancel(self, task_id):
+    """
+    Cancel a queued or running task. Returns False if the task had already
+    finished.
+    """
+    with self._lock:
+      task = self.tasks.get(task_id)
+      if task is None or task["state"] not in ["queued", "running"]:
+        return False
+      if task["state"] == "queued":
+        self._queue.remove(task_id)
+      else:
+        # the monitor thread closes the connection once the process is gone
+        self._stopping[task_id] = self._running.pop(task_id)
+        self._stopping[task_id][0].terminate()
+      self._finish(task_id, "cancelled")
+      self._start_queued()
+    return True
+
+  def result(self, task_id, timeout=0.):
+    """
+    The program result of a done task. Waits up to timeout seconds for the
+    task to finish, returns None if it is not done by then.
+    """
+    deadline = time.time() + timeout
+    with self._changed:
+      while self.tasks.get(task_id, {}).get("state") in ["queued", "running"]:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          break
+        self._changed.wait(remaining)
+      return self.results.get(task_id)
+
+  def wait_for_events(self, task_id, since_seq=-1, timeout=30.):
+    """
+    Long poll for the result events of a task with seq > since_seq. Returns
+    as soon as there are any or the task has finished, or after timeout
+    seconds:
+
+      {"task_id": task_id,
+       "state": "running",  # task state, stop polling once it is finished
+       "seq": 7,            # seq of the last event so far, -1 if none
+       "dropped": 2,        # events after since_seq no longer buffered
+       "events": [...]}     # the buffered events after since_seq
+
+    None for an unknown task.
+    """
+    deadline = time.time() + timeout
+    with self._changed:
+      if task_id not in self.tasks:
+        return None
+      while (self._next_seq[task_id] - 1 <= since_seq and
+             self.tasks[task_id]["state"] in ["queued", "running"]):
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          break
+        self._changed.wait(remaining)
+      events = [e for e in self.events[task_id] if e["seq"] > since_seq]
+      seq = self._next_seq[task_id] - 1
+      first = events[0]["seq"] if events else seq + 1
+      return {"task_id": task_id, "state": self.tasks[task_id]["state"],
+              "seq": seq, "dropped": first - since_seq - 1, "events": events}
+
+  def _publish(self, task_id, payload):
+    # lock held
+    event = {"task_id": task_id, "seq": self._next_seq[task_id],
+             "object": payload.get("object"), "payload": payload}
+    self._next_seq[task_id] += 1
+    self.events[task_id].append(event)
+    self._changed.notify_all()
+
+  def close(self):
+    """
+    Cancel all tasks and stop the monitor thread.
+    """
+    with self._lock:
+      self._closed = True
+      for task_id in list(self._queue) + list(self._running):
+        self.cancel(task_id)
+      self._wake()
+
+  def _wake(self):
+    # lock held, makes the monitor thread look at the connections again
+    self._changed.notify_all()
+    if self._wakeup is not None and not self._wakeup_pending:
+      self._wakeup_pending = True
+      self._wakeup[1].send_bytes(b"")
+
+  def _start_queued(self):
+    # start queued tasks while there are free workers, lock held
+    started = False
+    while not self._closed and self._queue and len(self._running) < self.max_workers:
+      task_id = self._queue.popleft()
+      task = self.tasks[task_id]
+      receiver, sender = self._mp.Pipe(duplex=False)
+      process = self._mp.Process(target=_worker, name="phenix-task-" + task_id,
+                                 args=(sender, task["program"], task["args"]))
+      process.daemon = True
+      process.start()
+      sender.close() # the child holds the only sender, EOF when it exits
+      self._running[task_id] = (process, receiver)
+      task["state"] = "running"
+      task["started"] = time.time()
+      self.current_task = task_id
+      started = True
+    if started:
+      self._wake()
+
+  def _finish(self, task_id, state, result=None, error=None, log=None):
+    # lock held
+    task = self.tasks[task_id]
+    task.update(state=state, finished=time.time(), error=error, log=log)
+    if state == "done":
+      self.results[task_id] = result
+    self._prune()
+    self._changed.notify_all()
+
+  def _prune(self):
+    # forget finished tasks past finished_ttl or max_finished, lock held
+    finished = sorted((task["finished"], task_id)
+                      for task_id, task in self.tasks.items()
+                      if task["state"] not in ["queued", "running"])
+    expired = time.time() - self.finished_ttl
+    n_extra = len(finished) - self.max_finished
+    for i, (t, task_id) in enumerate(finished):
+      if i < n_extra or t < expired:
+        for d in [self.tasks, self.results, self.events, self._next_seq]:
+          d.pop(task_id, None)
+
+  def _monitor(self):
+    # background thread, collects the messages of the task processes. It
+    # blocks on their connections, or on _changed while there are none, and
+    # joins exited processes without the lock.
+    wakeup = self._wakeup[0]
+    while True:
+      with self._changed:
+        while not (self._running or self._stopping or self._closed):
+          self._changed.wait()
+        if self._closed and not self._running and not self._stopping:
+          return
+        connections = dict((connection, task_id) for task_id, (_, connection)
+                           in list(self._running.items()) +
+                           list(self._stopping.items()))
+      exited = []
+      for connection in wait(list(connections) + [wakeup]):
+        if connection is wakeup:
+          with self._lock:
+            while wakeup.poll():
+              wakeup.recv_bytes()
+            self._wakeup_pending = False
+          continue
+        task_id = connections[connection]
+        try:
+          message = connection.recv()
+        except (EOFError, OSError): # exited without a message, or cancelled
+          message = ("failed", "Task process exited unexpectedly", None)
+        with self._lock:
+          if task_id in self._stopping:
+            process, _ = self._stopping.pop(task_id)
+            connection.close()
+            exited.append(process)
+            continue
+          state, value, log = message
+          if state == "event":
+            self._publish(task_id, value)
+            continue
+          process, _ = self._running.pop(task_id)
+          connection.close()
+          exited.append(process)
+          if state == "done":
+            self._finish(task_id, "done", result=value, log=log)
+          else:
+            self._finish(task_id, "failed", error=value, log=log)
+          self._start_queued()
+      for process in exited:
+        process.join(1.)